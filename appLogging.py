@@ -0,0 +1,118 @@
+import collections
+import logging
+import logging.handlers
+import sys
+import threading
+
+LOGGER_NAME = "folder_backup_creator"
+DEFAULT_VIEW_MESSAGES = 1000
+LOG_FILE_MAX_BYTES = 1024 * 1024
+LOG_FILE_BACKUPS = 3
+# The window and the command line always called them like this
+LOG_TYPES = {
+    "INFO": logging.INFO,
+    "WARN": logging.WARNING,
+    "ERROR": logging.ERROR,
+}
+LEVEL_NAMES = {level: name for name, level in LOG_TYPES.items()}
+
+
+class LogFormatter(logging.Formatter):
+    '''
+    "[INFO](2024-01-01 10:00:00): message", with the WARN/ERROR names the app
+    always used instead of logging's WARNING.
+    '''
+
+    def __init__(self, template="[%(log_type)s](%(asctime)s): %(message)s"):
+        super().__init__(template, "%Y-%m-%d %H:%M:%S")
+
+    def format(self, record):
+        record.log_type = LEVEL_NAMES.get(record.levelno, record.levelname)
+        return super().format(record)
+
+
+class RingBufferHandler(logging.Handler):
+    '''
+    Keeps the last `capacity` formatted records and the ones nobody took yet,
+    both bounded, so a backup logging for hours costs the same memory as one
+    logging for seconds. `on_pending` is called once when records start
+    waiting after a drain(), from whatever thread logged them, the window
+    uses it to schedule a single flush for the whole batch.
+    '''
+
+    def __init__(self, capacity=DEFAULT_VIEW_MESSAGES, on_pending=None):
+        super().__init__()
+        self.capacity = max(1, capacity)
+        self.records = collections.deque(maxlen=self.capacity)
+        self.pending = collections.deque(maxlen=self.capacity)
+        self.dropped = 0
+        self.on_pending = on_pending
+        self.buffer_lock = threading.Lock()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        with self.buffer_lock:
+            was_empty = not self.pending and not self.dropped
+            if len(self.pending) == self.capacity:
+                self.dropped += 1
+            self.records.append(line)
+            self.pending.append(line)
+        if was_empty and self.on_pending:
+            self.on_pending()
+
+    def drain(self):
+        '''
+        Returns (lines logged since the last drain, how many of them did not
+        fit and were dropped).
+        '''
+        with self.buffer_lock:
+            lines = list(self.pending)
+            dropped = self.dropped
+            self.pending.clear()
+            self.dropped = 0
+        return lines, dropped
+
+    def snapshot(self):
+        with self.buffer_lock:
+            return list(self.records)
+
+
+def setup_logging(capacity=DEFAULT_VIEW_MESSAGES, on_pending=None, log_file=None, stream=sys.stdout):
+    '''
+    Configures the app logger with a RingBufferHandler for the window, a
+    stream handler and, when `log_file` is given, a rotating file. Returns
+    the ring buffer handler.
+    '''
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+    formatter = LogFormatter()
+    ring = RingBufferHandler(capacity, on_pending)
+    ring.setFormatter(LogFormatter("\n[%(log_type)s](%(asctime)s):\n%(message)s\n"))
+    logger.addHandler(ring)
+    if stream is not None:
+        stream_handler = logging.StreamHandler(stream)
+        stream_handler.setFormatter(formatter)
+        logger.addHandler(stream_handler)
+    if log_file:
+        try:
+            file_handler = logging.handlers.RotatingFileHandler(
+                log_file, maxBytes=LOG_FILE_MAX_BYTES, backupCount=LOG_FILE_BACKUPS,
+                encoding="utf-8", delay=True)
+        except OSError as excp:
+            logger.warning("Can't write the log file %s: %s", log_file, excp)
+        else:
+            file_handler.setFormatter(formatter)
+            logger.addHandler(file_handler)
+    return ring
+
+
+def get_logger():
+    return logging.getLogger(LOGGER_NAME)
@@ -0,0 +1,449 @@
+import errno
+import os
+import stat
+import sys
+
+from configLibrary import BoolField, Field, IntField, SettingsSection, SettingsController
+from backupEngine import DEFAULT_COPY_WORKERS, BACKUP_MODES, ARCHIVE_EXTENSIONS
+from backupCatalog import BackupCatalog
+from backupRetention import RETENTION_POLICIES
+from appLogging import DEFAULT_VIEW_MESSAGES
+from backupVerify import VERIFY_LEVELS
+from backupSpace import LOW_SPACE_ACTIONS
+from fastCopy import Pipeline
+from backupFilter import FilterRules
+
+
+ERROR_INVALID_NAME = 123
+def getDirs(path):
+    def innerIsDir(name):
+        return os.path.isdir(os.path.join(path, name))
+    return innerIsDir, os.listdir(path)
+
+_UNSET = object()
+
+class ValidPath(str):
+    '''
+    Absolute path string that knows whether it is valid, exists and what it
+    is. Nothing touches the filesystem until one of those is asked for, and
+    then everything comes from a single cached os.stat, call invalidate() when
+    the path may have changed on disk.
+    '''
+    __slots__ = ("path", "absolute_path", "_stat", "_valid", "_exists_or_creatable")
+
+    def __new__(cls, content):
+        self = str.__new__(cls, os.path.abspath(content))
+        self.path = content
+        self.absolute_path = str.__str__(self)
+        self.invalidate()
+        return self
+
+    def invalidate(self):
+        self._stat = _UNSET
+        self._valid = _UNSET
+        self._exists_or_creatable = _UNSET
+
+    @property
+    def stat(self):
+        if self._stat is _UNSET:
+            try:
+                self._stat = os.stat(self.absolute_path)
+            except (OSError, ValueError):
+                self._stat = None
+        return self._stat
+
+    @property
+    def valid(self):
+        if self._valid is _UNSET:
+            # Anything that can be stat'ed is a valid pathname, the slow per
+            # component check is only needed for paths that do not exist yet
+            self._valid = self.stat is not None or self.is_pathname_valid(self.path)
+        return self._valid
+
+    @property
+    def exists_or_creatable(self):
+        if self._exists_or_creatable is _UNSET:
+            self._exists_or_creatable = self.valid and (
+                self.stat is not None or self.is_path_creatable(self.absolute_path))
+        return self._exists_or_creatable
+
+    @property
+    def exists(self):
+        return self.stat is not None
+
+    @property
+    def type(self):
+        if self.stat is None:
+            return False
+        return "dir" if stat.S_ISDIR(self.stat.st_mode) else "file"
+
+    def __abs__(self):
+        return self.absolute_path
+
+    def __str__(self):
+        return self.absolute_path
+
+    def __repr__(self):
+        return self.absolute_path
+
+    def get_folder_list(self,path):
+        filter_method, iterable = getDirs(path)
+        return list(map(ValidPath,map(lambda x: os.path.join(path,x),iterable)))
+
+    def getContent(self):
+        if not self.exists:
+            return False
+        if self.type == "dir":
+            return self.get_folder_list(self.absolute_path)
+        else:
+            file = open(self.absolute_path)
+            data = file.read()
+            file.close()
+            return data
+
+    def create(self, path_type, default=False):
+        if self.exists_or_creatable and not self.exists:
+            if path_type == "dir":
+                try:
+                    os.mkdir(self.absolute_path)
+                    self.invalidate()
+                except Exception as excp:
+                    raise excp
+            elif path_type == "file":
+                try:
+                    newfile = open(self.absolute_path, 'a+')  # open file in append mode
+                    if default:
+                        newfile.write(default)
+                    else:
+                        newfile.write("")
+                    newfile.close()
+                    self.invalidate()
+                except Exception as excp:
+                    raise excp
+
+    def is_pathname_valid(self,pathname):
+        '''
+        `True` if the passed pathname is a valid pathname for the current OS;
+        `False` otherwise.
+        '''
+        try:
+            if not isinstance(pathname, str) or not pathname:
+                return False
+            _, pathname = os.path.splitdrive(pathname)
+            root_dirname = os.environ.get('HOMEDRIVE', 'C:') \
+                if sys.platform == 'win32' else os.path.sep
+            assert os.path.isdir(root_dirname)
+            root_dirname = root_dirname.rstrip(os.path.sep) + os.path.sep
+            for pathname_part in pathname.split(os.path.sep):
+                try:
+                    os.lstat(root_dirname + pathname_part)
+                except OSError as exc:
+                    if hasattr(exc, 'winerror'):
+                        if exc.winerror == ERROR_INVALID_NAME:
+                            return False
+                    elif exc.errno in {errno.ENAMETOOLONG, errno.ERANGE}:
+                        return False
+        except TypeError as exc:
+            return False
+        else:
+            return True
+
+    def is_path_creatable(self,pathname):
+        '''
+        `True` if the current user has sufficient permissions to create the passed
+        pathname; `False` otherwise.
+        '''
+        dirname = os.path.dirname(pathname) or os.getcwd()
+        return os.access(dirname, os.W_OK)
+
+    def is_path_exists_or_creatable(self,pathname):
+        '''
+        `True` if the passed pathname is a valid pathname for the current OS _and_
+        either currently exists or is hypothetically creatable; `False` otherwise.
+
+        This function is guaranteed to _never_ raise exceptions.
+        '''
+        try:
+            return self.is_pathname_valid(pathname) and (
+                os.path.exists(pathname) or self.is_path_creatable(pathname))
+        except OSError:
+            return False
+
+
+CONFIG_FILE_NAME = "folder_backup_creator.ini"
+CONFIG_FILE_PATH = ValidPath(CONFIG_FILE_NAME)
+# [PROFILE:games] sections add more folders to back up, the PATHS section is
+# the profile called "default"
+PROFILE_PREFIX = "PROFILE:"
+DEFAULT_PROFILE_NAME = "default"
+# backups_directory_path can list several folders (a local disk and a USB
+# or network one), every backup is made in all of them
+DESTINATION_SEPARATOR = ";"
+
+class PathSettings(SettingsSection):
+    save_directory_path = Field(default="None")
+    backups_directory_path = Field(default="./saveBackups")
+    # What not to back up, see backupFilter.FilterRules
+    exclude = Field(default="")
+    include = Field(default="")
+    max_file_size_mb = IntField(default=0)
+    max_age_days = IntField(default=0)
+
+class CopySettings(SettingsSection):
+    copy_workers = IntField(default=DEFAULT_COPY_WORKERS)
+    backup_mode = Field(default="full")
+    archive_format = Field(default="zip")
+    compression_threads = IntField(default=0)
+    verify = Field(default="none")
+    # How many backups may read or write the same disk at the same time
+    jobs_per_device = IntField(default=1)
+    # Files of this many MB or more only get their changed parts written,
+    # see backupDelta, 0 is off
+    delta_min_size_mb = IntField(default=0)
+    # What to do when the backups disk is too full for the next backup,
+    # "refuse" or "prune" (apply the RETENTION policy first)
+    low_space = Field(default="refuse")
+    # Files of this many MB or more are read and written at the same time
+    # when the backups are on another disk, 0 is off
+    pipeline_min_size_mb = IntField(default=64)
+    # Size and number of the buffers used for that, 0 picks them from the
+    # free memory
+    pipeline_buffer_mb = IntField(default=0)
+    pipeline_buffers = IntField(default=0)
+    # Keep big backed up files from filling the page cache
+    page_cache_hints = BoolField(default="true")
+
+class RetentionSettings(SettingsSection):
+    policy = Field(default="none")
+    keep_last = IntField(default=10)
+    keep_daily = IntField(default=7)
+    keep_weekly = IntField(default=4)
+    keep_monthly = IntField(default=12)
+
+class MetricsSettings(SettingsSection):
+    prometheus_textfile = Field(default="")
+
+class LogSettings(SettingsSection):
+    file = Field(default="")
+    view_messages = IntField(default=DEFAULT_VIEW_MESSAGES)
+
+class ProfilePathSettings(SettingsSection):
+    save_directory_path = Field()
+    backups_directory_path = Field()
+    exclude = Field()
+    include = Field()
+    max_file_size_mb = IntField(default=0)
+    max_age_days = IntField(default=0)
+
+class PathsMixin:
+    '''
+    Everything that depends on the PATHS section, shared by Settings and
+    each Profile. Needs `PATHS` and a `_paths` dict.
+    '''
+    _catalog = None
+    _rules = None
+    destination_index = 0
+
+    def _memoized_path(self, configured):
+        path = self._paths.get(configured)
+        if path is None:
+            path = self._paths[configured] = ValidPath(configured)
+        return path
+
+    def invalidate_paths(self):
+        '''
+        Forget the cached filesystem state of the configured paths, call it
+        before an operation that needs them to be up to date.
+        '''
+        for path in self._paths.values():
+            path.invalidate()
+
+    @property
+    def catalog(self):
+        backup_path = str(self.backup_path)
+        if self._catalog is None or self._catalog.backup_path != backup_path:
+            self._catalog = BackupCatalog(backup_path)
+        return self._catalog
+
+    @property
+    def save_path(self):
+        return self._memoized_path(self.PATHS.save_directory_path)
+
+    @property
+    def backup_paths(self):
+        configured = [path.strip() for path in self.PATHS.backups_directory_path.split(DESTINATION_SEPARATOR)]
+        return [self._memoized_path(path) for path in configured if path] or [self._memoized_path("")]
+
+    @property
+    def backup_path(self):
+        '''
+        The first backups folder, the one backups are listed, restored and
+        verified from when there are several.
+        '''
+        return self.backup_paths[0]
+
+    @property
+    def filter_rules(self):
+        '''
+        The FilterRules of the PATHS section, None when it has none. Only
+        compiled again when those settings change.
+        '''
+        paths = self.PATHS
+        key = (paths.exclude or "", paths.include or "", paths.max_file_size_mb or 0, paths.max_age_days or 0)
+        if self._rules is None or self._rules[0] != key:
+            self._rules = (key, FilterRules.from_settings(*key))
+        return self._rules[1]
+
+    def destinations(self):
+        '''
+        One Destination per backups folder, or just this when there is one.
+        '''
+        backup_paths = self.backup_paths
+        if len(backup_paths) == 1:
+            return [self]
+        return [Destination(self, index, path) for index, path in enumerate(backup_paths)]
+
+    def init_paths(self):
+        for backup_path in self.backup_paths:
+            if backup_path.exists_or_creatable and not backup_path.exists:
+                backup_path.create("dir")
+        if self.paths_configured_correctly:
+            return True, ""
+        elif not self.save_path.exists:
+            return False, "Save directory path does not exists"
+        else:
+            return False, "Unknown error"
+
+    @property
+    def paths_configured_correctly(self):
+        return self.save_path.exists and self.save_path.type == "dir" and self.backup_path.exists and self.backup_path.type == "dir"
+
+
+class Destination(PathsMixin):
+    '''
+    One of the backups folders of a profile that has several, behaves like
+    the profile with only that folder.
+    '''
+
+    def __init__(self, profile, index, backup_path):
+        self.profile = profile
+        self.destination_index = index
+        self._backup_path = backup_path
+        self._paths = {}
+
+    @property
+    def save_path(self):
+        return self.profile.save_path
+
+    @property
+    def backup_paths(self):
+        return [self._backup_path]
+
+    def invalidate_paths(self):
+        self.profile.invalidate_paths()
+
+    def __getattr__(self, name):
+        return getattr(self.profile, name)
+
+
+class Profile(PathsMixin):
+    '''
+    The folders of a [PROFILE:name] section, everything else (COPY,
+    RETENTION...) comes from the Settings it belongs to.
+    '''
+
+    def __init__(self, settings, name, section):
+        self.settings = settings
+        self.name = name
+        self.PATHS = section
+        self._paths = {}
+
+    def __getattr__(self, name):
+        return getattr(self.settings, name)
+
+
+class Settings(PathsMixin, SettingsController):
+    PATHS = PathSettings()
+    COPY = CopySettings()
+    RETENTION = RetentionSettings()
+    METRICS = MetricsSettings()
+    LOG = LogSettings()
+    name = DEFAULT_PROFILE_NAME
+
+    def __init__(self, configuration_file):
+        # ValidPath objects by the configured string they were built from, so
+        # they are only rebuilt when the setting changes
+        self._paths = {}
+        self._profiles = {}
+        super().__init__(configuration_file)
+
+    def profiles(self):
+        '''
+        The Settings itself when PATHS has a folder to back up, followed by a
+        Profile for every [PROFILE:name] section of the file that has both
+        paths set.
+        '''
+        profiles = []
+        if self.PATHS.save_directory_path not in ("", "None"):
+            profiles.append(self)
+        for section_name in self.section_names(PROFILE_PREFIX):
+            name = section_name[len(PROFILE_PREFIX):]
+            if "." in name:
+                continue
+            if name not in self._profiles:
+                section = self.add_section(section_name, ProfilePathSettings())
+                self._profiles[name] = Profile(self, name, section)
+            profile = self._profiles[name]
+            if profile.PATHS.save_directory_path and profile.PATHS.backups_directory_path:
+                profiles.append(profile)
+        return profiles
+
+    def profile(self, name):
+        for profile in self.profiles():
+            if profile.name == name:
+                return profile
+        return None
+
+    @property
+    def copy_workers(self):
+        return max(1, self.COPY.copy_workers)
+
+    @property
+    def backup_mode(self):
+        mode = self.COPY.backup_mode
+        return mode if mode in BACKUP_MODES else "full"
+
+    @property
+    def archive_format(self):
+        archive_format = self.COPY.archive_format
+        return archive_format if archive_format in ARCHIVE_EXTENSIONS else "zip"
+
+    @property
+    def verify_level(self):
+        level = self.COPY.verify
+        return level if level in VERIFY_LEVELS else "none"
+
+    @property
+    def retention_policy(self):
+        policy = self.RETENTION.policy
+        return policy if policy in RETENTION_POLICIES else "none"
+
+    @property
+    def delta_min_size(self):
+        return max(0, self.COPY.delta_min_size_mb) * 1024 * 1024
+
+    @property
+    def pipeline(self):
+        copy = self.COPY
+        return Pipeline(max(0, copy.pipeline_min_size_mb) * 1024 * 1024,
+                        max(0, copy.pipeline_buffer_mb) * 1024 * 1024,
+                        max(0, copy.pipeline_buffers), copy.page_cache_hints)
+
+    @property
+    def low_space_action(self):
+        action = self.COPY.low_space
+        return action if action in LOW_SPACE_ACTIONS else "refuse"
+
+    @property
+    def jobs_per_device(self):
+        return max(1, self.COPY.jobs_per_device)
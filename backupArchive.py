@@ -0,0 +1,232 @@
+import os
+import queue
+import tarfile
+import threading
+import time
+import zipfile
+
+from backupEngine import BackupCancelled, ARCHIVE_EXTENSIONS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ZIP_EPOCH = 315532800
+READ_CHUNK_SIZE = 1024 * 1024
+# How many chunks the reader thread can get ahead of the compressor
+READ_AHEAD_CHUNKS = 16
+# Compressing these again only burns cpu, zip stores them as they are
+COMPRESSED_EXTENSIONS = frozenset((
+    ".7z", ".zip", ".rar", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".cab",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".avif", ".heic",
+    ".mp3", ".ogg", ".opus", ".flac", ".aac", ".m4a", ".wma",
+    ".mp4", ".mkv", ".avi", ".webm", ".mov", ".wmv",
+    ".pdf", ".docx", ".xlsx", ".pptx", ".odt", ".epub", ".jar", ".apk",
+))
+
+
+def available_formats():
+    return [name for name in ARCHIVE_EXTENSIONS if name != "tar.zst" or zstandard is not None]
+
+
+def is_compressed(relative_path):
+    return os.path.splitext(relative_path)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def zip_date_time(mtime):
+    # zip can not store dates before 1980
+    return time.localtime(max(mtime, ZIP_EPOCH))[:6]
+
+
+def archive_name(relative_path, folder_name):
+    return "/".join([folder_name] + relative_path.split(os.sep))
+
+
+class ReadAhead(threading.Thread):
+    '''
+    Reads the files of a SourceTree in order on its own thread and hands
+    (relative_path, stat, chunks) to the archive writer, so reading the next
+    file overlaps with compressing the current one. Memory use is bounded by
+    READ_AHEAD_CHUNKS * READ_CHUNK_SIZE.
+    '''
+
+    def __init__(self, tree, cancel_event=None):
+        super().__init__(name="ReadAhead", daemon=True)
+        self.tree = tree
+        self.cancel_event = cancel_event
+        self.queue = queue.Queue(READ_AHEAD_CHUNKS)
+        self.stopped = threading.Event()
+        self.skipped = []
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(self):
+        try:
+            for relative_path, size, mtime_ns in self.tree.files:
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    break
+                try:
+                    file = open(os.path.join(self.tree.root, relative_path), "rb")
+                except FileNotFoundError:
+                    # Deleted since the scan, left out of the archive
+                    self.skipped.append(relative_path)
+                    continue
+                with file:
+                    stat = os.fstat(file.fileno())
+                    if not self.put(("file", relative_path, stat)):
+                        return
+                    remaining = stat.st_size
+                    while remaining:
+                        data = file.read(min(READ_CHUNK_SIZE, remaining))
+                        if not data:
+                            # The file shrank while reading it, tar needs the
+                            # size announced in the header so pad it
+                            data = bytes(min(READ_CHUNK_SIZE, remaining))
+                        remaining -= len(data)
+                        if not self.put(("data", data)):
+                            return
+            self.put(("end",))
+        except Exception as excp:
+            self.put(("error", excp))
+
+    def stop(self):
+        self.stopped.set()
+
+    def __iter__(self):
+        '''
+        Yields (relative_path, stat, chunks) where chunks is an iterator that
+        must be consumed before asking for the next file.
+        '''
+        def chunks(message):
+            while True:
+                message[0] = self.queue.get()
+                if message[0][0] != "data":
+                    return
+                yield message[0][1]
+
+        message = [self.queue.get()]
+        while True:
+            kind = message[0][0]
+            if kind == "end":
+                return
+            if kind == "error":
+                raise message[0][1]
+            _, relative_path, stat = message[0]
+            file_chunks = chunks(message)
+            yield relative_path, stat, file_chunks
+            # Whatever the writer did not read (tarfile does not read empty
+            # files at all) is skipped to get to the next file
+            for _ in file_chunks:
+                pass
+
+
+class ArchiveWriter:
+    '''
+    Streams a SourceTree into a single archive file, no staging copy is made.
+    zip compresses on one thread while a second one reads ahead, tar.zst (when
+    the zstandard package is installed) compresses on `threads` threads, 0
+    meaning one per cpu. zstd already stores blocks it can not shrink as raw
+    blocks, so only zip needs COMPRESSED_EXTENSIONS.
+    '''
+
+    def __init__(self, archive_format="zip", threads=0):
+        if archive_format not in available_formats():
+            raise ValueError("Archive format %s is not available" % archive_format)
+        self.archive_format = archive_format
+        self.threads = threads if threads > 0 else -1
+        self.stored_files = 0
+        self.compressed_files = 0
+        self.skipped = []
+
+    def write(self, tree, archive_path, folder_name, progress=None, cancel_event=None):
+        reader = ReadAhead(tree, cancel_event)
+        reader.start()
+        try:
+            if self.archive_format == "zip":
+                self.write_zip(tree, reader, archive_path, folder_name, progress)
+            else:
+                self.write_tar_zst(tree, reader, archive_path, folder_name, progress)
+        finally:
+            reader.stop()
+            reader.join()
+            self.skipped.extend(reader.skipped)
+        if cancel_event is not None and cancel_event.is_set():
+            raise BackupCancelled()
+
+    def write_zip(self, tree, reader, archive_path, folder_name, progress):
+        with zipfile.ZipFile(archive_path, "w", zipfile.ZIP_DEFLATED, allowZip64=True) as archive:
+            for relative_dir in [""] + tree.dirs:
+                stat = os.stat(os.path.join(tree.root, relative_dir))
+                info = zipfile.ZipInfo(archive_name(relative_dir, folder_name).rstrip("/") + "/",
+                                       zip_date_time(stat.st_mtime))
+                info.external_attr = (stat.st_mode & 0xFFFF) << 16 | 0x10
+                archive.writestr(info, b"")
+            for relative_path, stat, chunks in reader:
+                info = zipfile.ZipInfo(archive_name(relative_path, folder_name),
+                                       zip_date_time(stat.st_mtime))
+                info.external_attr = (stat.st_mode & 0xFFFF) << 16
+                info.file_size = stat.st_size
+                if is_compressed(relative_path):
+                    info.compress_type = zipfile.ZIP_STORED
+                    self.stored_files += 1
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    self.compressed_files += 1
+                with archive.open(info, "w") as member:
+                    for data in chunks:
+                        member.write(data)
+                if progress:
+                    progress.advance(1, stat.st_size)
+
+    def write_tar_zst(self, tree, reader, archive_path, folder_name, progress):
+        compressor = zstandard.ZstdCompressor(threads=self.threads)
+        with open(archive_path, "wb") as raw, compressor.stream_writer(raw) as compressed:
+            with tarfile.open(fileobj=compressed, mode="w|", format=tarfile.PAX_FORMAT,
+                              dereference=True) as archive:
+                for relative_dir in [""] + tree.dirs:
+                    path = os.path.join(tree.root, relative_dir)
+                    archive.add(path, archive_name(relative_dir, folder_name).rstrip("/"), recursive=False)
+                for relative_path, stat, chunks in reader:
+                    info = tarfile.TarInfo(archive_name(relative_path, folder_name))
+                    info.size = stat.st_size
+                    info.mtime = stat.st_mtime
+                    info.mode = stat.st_mode & 0o7777
+                    archive.addfile(info, ChunkReader(chunks))
+                    self.compressed_files += 1
+                    if progress:
+                        progress.advance(1, stat.st_size)
+
+
+class ChunkReader:
+    '''
+    Minimal file object over an iterator of byte chunks, what tarfile needs
+    to read a member's contents.
+    '''
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.chunk = b""
+        self.offset = 0
+
+    def read(self, size=-1):
+        parts = []
+        while size:
+            if self.offset >= len(self.chunk):
+                self.chunk = next(self.chunks, b"")
+                self.offset = 0
+                if not self.chunk:
+                    break
+            end = len(self.chunk) if size < 0 else min(len(self.chunk), self.offset + size)
+            parts.append(self.chunk[self.offset:end])
+            if size > 0:
+                size -= end - self.offset
+            self.offset = end
+        return b"".join(parts)
@@ -0,0 +1,248 @@
+import json
+import os
+import threading
+import time
+
+from backupEngine import META_DIR_NAME, ARCHIVE_EXTENSIONS, parse_backup_name
+from backupJournal import JOURNAL_SUFFIX, lock_file, staging_path
+
+CATALOG_NAME = "catalog.json"
+CATALOG_VERSION = 1
+# A locked <n>.lock file in there means backup n is still being written
+WRITERS_DIR_NAME = "writers"
+
+
+class NumberTaken(Exception):
+    '''
+    Another process reserved the same backup number first.
+    '''
+
+
+class BackupCatalog:
+    '''
+    Index of the numbered backups kept in META_DIR_NAME/catalog.json inside
+    the backups directory, so finding the last backup or the next free number
+    does not need to list and sort the whole directory every time.
+
+    The catalog stores the mtime of the backups directory it was built from,
+    if somebody adds or removes numbered folders by hand that mtime changes
+    and the catalog is rebuilt with a single os.scandir pass.
+    '''
+
+    def __init__(self, backup_path):
+        self.backup_path = str(backup_path)
+        self.meta_path = os.path.join(self.backup_path, META_DIR_NAME)
+        self.path = os.path.join(self.meta_path, CATALOG_NAME)
+        self.lock = threading.RLock()
+        self.data = None
+        self.file_mtime_ns = None
+        self.writers = {}
+
+    def directory_mtime_ns(self):
+        return os.stat(self.backup_path).st_mtime_ns
+
+    def load(self, check_directory=True):
+        '''
+        Makes sure self.data is up to date, costs two stats when nothing changed.
+        `check_directory` is turned off by the callers that just changed the
+        backups directory themselves and are about to save the catalog.
+        '''
+        with self.lock:
+            try:
+                file_mtime_ns = os.stat(self.path).st_mtime_ns
+            except FileNotFoundError:
+                return self.rebuild()
+            if self.data is None or file_mtime_ns != self.file_mtime_ns:
+                try:
+                    with open(self.path, encoding="utf-8") as file:
+                        data = json.load(file)
+                except ValueError:
+                    return self.rebuild()
+                if data.get("version") != CATALOG_VERSION:
+                    return self.rebuild()
+                self.data = data
+                self.file_mtime_ns = file_mtime_ns
+            if check_directory and self.data["directory_mtime_ns"] != self.directory_mtime_ns():
+                return self.rebuild()
+            return self.data
+
+    def rebuild(self):
+        with self.lock:
+            previous = self.data["backups"] if self.data else {}
+            backups = {}
+            with os.scandir(self.backup_path) as entries:
+                for entry in entries:
+                    number = parse_backup_name(entry.name)
+                    if number is None or (number == entry.name) != entry.is_dir():
+                        continue
+                    backups[number] = previous.get(number) or {
+                        "created": entry.stat().st_mtime,
+                        "size": None,
+                    }
+                    if number != entry.name:
+                        backups[number]["entry"] = entry.name
+                    # Folders and archives only appear once complete (store
+                    # backups fill their folder in place), one whose process
+                    # ended before saying so is complete all the same
+                    backup = backups[number]
+                    if (not backup.get("complete", True) and backup.get("mode") != "store"
+                            and not self.writing(number)
+                            and not os.path.exists(staging_path(self.backup_path, number) + JOURNAL_SUFFIX)):
+                        backup["complete"] = True
+            # Backups still being written may not be on disk yet (the folder is
+            # made after the scan, archives are renamed in place at the end),
+            # their reservation is kept while they are or can be resumed, the
+            # others were killed before writing anything
+            for number, entry in previous.items():
+                if number not in backups and not entry.get("complete", True) and (
+                        self.writing(number) or os.path.exists(staging_path(self.backup_path, number) + JOURNAL_SUFFIX)):
+                    backups[number] = entry
+            self.data = {
+                "version": CATALOG_VERSION,
+                "backups": backups,
+            }
+            self.update_pointers()
+            self.save()
+            return self.data
+
+    def update_pointers(self):
+        backups = self.data["backups"]
+        numbers = [int(number) for number in backups]
+        complete = [int(number) for number in backups if backups[number].get("complete", True)]
+        self.data["latest"] = str(max(complete)) if complete else None
+        self.data["next"] = max(numbers) + 1 if numbers else 0
+
+    def save(self):
+        '''
+        Atomically replaces the catalog file, the file lives in a subdirectory
+        so writing it does not change the mtime of the backups directory.
+        '''
+        with self.lock:
+            os.makedirs(self.meta_path, exist_ok=True)
+            self.data["directory_mtime_ns"] = self.directory_mtime_ns()
+            temporary = self.path + ".tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump(self.data, file, separators=(",", ":"))
+            os.replace(temporary, self.path)
+            self.file_mtime_ns = os.stat(self.path).st_mtime_ns
+
+    def path_of(self, number):
+        '''
+        Path of the numbered folder, or of the archive for archive backups.
+        '''
+        entry = self.load()["backups"].get(str(number)) or {}
+        return os.path.join(self.backup_path, entry.get("entry", str(number)))
+
+    def number_taken(self, number):
+        names = [str(number)] + [str(number) + extension for extension in ARCHIVE_EXTENSIONS.values()]
+        return any(os.path.exists(os.path.join(self.backup_path, name)) for name in names)
+
+    @property
+    def next_number(self):
+        with self.lock:
+            data = self.load()
+            if self.number_taken(data["next"]):
+                # A folder the catalog did not see, directory mtimes are not
+                # reliable on every filesystem
+                data = self.rebuild()
+            return str(data["next"])
+
+    @property
+    def latest(self):
+        with self.lock:
+            data = self.load()
+            if data["latest"] is not None and not os.path.exists(self.path_of(data["latest"])):
+                data = self.rebuild()
+            return data["latest"]
+
+    def numbers(self):
+        '''
+        Numbers of the complete backups, newest first.
+        '''
+        backups = self.load()["backups"]
+        complete = [int(number) for number in backups if backups[number].get("complete", True)]
+        return [str(number) for number in sorted(complete, reverse=True)]
+
+    def get(self, number):
+        return self.load()["backups"].get(str(number))
+
+    def writer_path(self, number):
+        return os.path.join(self.meta_path, WRITERS_DIR_NAME, "%s.lock" % number)
+
+    def writing(self, number):
+        '''
+        True while some process, this one or another, is writing backup
+        `number`, the lock of its writer file goes away with the process.
+        '''
+        if str(number) in self.writers:
+            return True
+        path = self.writer_path(number)
+        if not os.path.exists(path):
+            return False
+        with open(path, "a+") as file:
+            alive = not lock_file(file)
+        if not alive:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return alive
+
+    def release(self, number):
+        '''
+        Tells the other processes backup `number` is no longer being written.
+        '''
+        file = self.writers.pop(str(number), None)
+        if file is not None:
+            file.close()
+            try:
+                os.remove(file.name)
+            except OSError:
+                pass
+
+    def add(self, number, **info):
+        '''
+        Reserves `number` for a backup that is about to be written, before
+        its folder exists, so the number is not handed out again. The
+        backup is not listed until complete() is called, until then or
+        release() its writer file stays locked. Raises NumberTaken when
+        another process holds it.
+        '''
+        with self.lock:
+            if str(number) not in self.writers:
+                path = self.writer_path(number)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                file = open(path, "a+")
+                if not lock_file(file):
+                    file.close()
+                    raise NumberTaken("Backup %s is being written by another process" % number)
+                self.writers[str(number)] = file
+            data = self.load(check_directory=False)
+            entry = data["backups"].setdefault(str(number), {"created": time.time(), "size": None})
+            entry["complete"] = False
+            entry.update(info)
+            self.update_pointers()
+            self.save()
+
+    def update(self, number, **info):
+        with self.lock:
+            entry = self.load()["backups"].get(str(number))
+            if entry is not None:
+                entry.update(info)
+                self.update_pointers()
+                self.save()
+
+    def complete(self, number, **info):
+        self.update(number, complete=True, **info)
+        self.release(number)
+
+    def remove(self, number):
+        '''
+        Forgets a numbered backup, call it after deleting its folder.
+        '''
+        self.release(number)
+        with self.lock:
+            data = self.load(check_directory=False)
+            if data["backups"].pop(str(number), None) is not None:
+                self.update_pointers()
+                self.save()
@@ -0,0 +1,176 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+from backupEngine import format_bytes
+from fastCopy import UnsupportedCopy, copy_reflink, unsupported
+
+CHUNK_INDEX_NAME = "chunks.json.gz"
+DELTA_CHUNK_SIZE = 1024 * 1024
+CHUNK_HASH_SIZE = 16
+
+
+def chunk_key(relative_path):
+    return relative_path.replace(os.sep, "/")
+
+
+def read_chunk_index(backup_dir):
+    '''
+    The chunk hashes saved with the backup in `backup_dir` by relative path,
+    empty when there are none or they were made with another chunk size.
+    '''
+    try:
+        with gzip.open(os.path.join(str(backup_dir), CHUNK_INDEX_NAME), "rt", encoding="utf-8") as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        return {}
+    if index.get("chunk_size") != DELTA_CHUNK_SIZE:
+        return {}
+    return index.get("files", {})
+
+
+def write_chunk_index(backup_dir, files):
+    path = os.path.join(str(backup_dir), CHUNK_INDEX_NAME)
+    temporary = path + ".tmp"
+    with gzip.open(temporary, "wt", encoding="utf-8") as file:
+        json.dump({"version": 1, "chunk_size": DELTA_CHUNK_SIZE, "files": files}, file, separators=(",", ":"))
+    os.replace(temporary, path)
+    return path
+
+
+def read_chunks(file):
+    '''
+    Yields (offset, chunk) reading `file` with a single reused buffer, the
+    chunk is only valid until the next one is read.
+    '''
+    buffer = bytearray(DELTA_CHUNK_SIZE)
+    view = memoryview(buffer)
+    offset = 0
+    while True:
+        read = file.readinto(buffer)
+        if not read:
+            return
+        yield offset, view[:read]
+        offset += read
+
+
+def chunk_hash(chunk):
+    return hashlib.blake2b(chunk, digest_size=CHUNK_HASH_SIZE).hexdigest()
+
+
+def hash_chunks(path):
+    with open(path, "rb") as file:
+        return [chunk_hash(chunk) for offset, chunk in read_chunks(file)]
+
+
+class DeltaCopier:
+    '''
+    Copies big files by only writing the fixed size chunks that changed
+    since the previous backup: the previous copy is reflinked to the new
+    backup and the changed chunks are written over it. Without reflinks
+    (ext4, NTFS...) patching a full copy would cost more than copying, so
+    the file is copied whole instead.
+    Either way the chunk hashes of every big file are saved with the new
+    backup, the next one compares against them without reading the
+    previous copy again.
+    '''
+
+    def __init__(self, min_size, previous_dir=None, target_name=""):
+        self.min_size = min_size
+        self.base_root = os.path.join(str(previous_dir), target_name) if previous_dir else None
+        self.previous_index = read_chunk_index(previous_dir) if previous_dir else {}
+        self.reflink = True
+        self.index = {}
+        self.lock = threading.Lock()
+        self.patched_files = 0
+        self.copied_files = 0
+        self.total_bytes = 0
+        self.written_bytes = 0
+
+    def wants(self, size):
+        return 0 < self.min_size <= size
+
+    def carry_over(self, relative_path):
+        '''
+        For a file hardlinked from the previous backup, its hashes are the same.
+        '''
+        key = chunk_key(relative_path)
+        entry = self.previous_index.get(key)
+        if entry is not None:
+            with self.lock:
+                self.index[key] = entry
+
+    def previous_hashes(self, relative_path, base):
+        '''
+        The chunk hashes of `base`, the previous copy of the file, from the
+        previous index when it still describes that copy, hashed otherwise.
+        '''
+        entry = self.previous_index.get(chunk_key(relative_path))
+        stat = os.stat(base)
+        if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+            return entry["hashes"]
+        return hash_chunks(base)
+
+    def clone(self, base, destination):
+        '''
+        Reflinks `base` to `destination`, False when the filesystem can't.
+        '''
+        if not self.reflink:
+            return False
+        with open(base, "rb") as base_file, open(destination, "wb") as destination_file:
+            try:
+                copy_reflink(base_file.fileno(), destination_file.fileno(), 0)
+            except (UnsupportedCopy, OSError) as excp:
+                if not isinstance(excp, UnsupportedCopy) and not unsupported(excp):
+                    raise
+                self.reflink = False
+                return False
+        return True
+
+    def copy(self, source, destination, relative_path, mtime_ns):
+        base = os.path.join(self.base_root, relative_path) if self.base_root else None
+        previous = None
+        if base is not None and os.path.isfile(base) and self.clone(base, destination):
+            previous = self.previous_hashes(relative_path, base)
+        hashes = []
+        written = 0
+        try:
+            with open(source, "rb") as source_file, \
+                    open(destination, "wb" if previous is None else "r+b") as destination_file:
+                for offset, chunk in read_chunks(source_file):
+                    digest = chunk_hash(chunk)
+                    index = len(hashes)
+                    hashes.append(digest)
+                    if previous is not None and index < len(previous) and previous[index] == digest:
+                        continue
+                    destination_file.seek(offset)
+                    destination_file.write(chunk)
+                    written += len(chunk)
+                size = source_file.tell()
+                destination_file.truncate(size)
+        except BaseException:
+            # Never leave the clone of the previous version behind
+            if os.path.lexists(destination):
+                os.remove(destination)
+            raise
+        with self.lock:
+            self.index[chunk_key(relative_path)] = {"size": size, "mtime_ns": mtime_ns, "hashes": hashes}
+            if previous is not None:
+                self.patched_files += 1
+            else:
+                self.copied_files += 1
+            self.total_bytes += size
+            self.written_bytes += written
+        return destination
+
+    def write_index(self, backup_dir):
+        if self.index:
+            return write_chunk_index(backup_dir, self.index)
+        return None
+
+    def __str__(self):
+        return "Delta copied %d large files (%s), patched %d of them in place, wrote %s" % (
+            self.patched_files + self.copied_files, format_bytes(self.total_bytes), self.patched_files,
+            format_bytes(self.written_bytes))
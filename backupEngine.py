@@ -0,0 +1,798 @@
+import hashlib
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from fastCopy import CopyBackend
+
+DEFAULT_COPY_WORKERS = 8
+BACKUP_MODES = ("full", "incremental", "store", "archive")
+ARCHIVE_EXTENSIONS = {
+    "zip": ".zip",
+    "tar.zst": ".tar.zst",
+}
+# Everything the app keeps inside the backups directory that is not a
+# numbered backup lives in here
+META_DIR_NAME = ".folder_backup_creator"
+
+
+class BackupCancelled(Exception):
+    pass
+
+
+class BackupSkipped(Exception):
+    pass
+
+
+class SourceTree:
+    '''
+    Result of a pre-scan of the folder being backed up, directories are stored
+    parents first and files as (relative path, size, mtime_ns) tuples.
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.dirs = []
+        self.files = []
+        self.total_bytes = 0
+        # What filter rules left out, the contents of excluded folders are
+        # not known as they are never looked into and the bytes are only
+        # those of files left out by size or age, the others are not stat'ed
+        self.excluded_dirs = 0
+        self.excluded_files = 0
+        self.excluded_bytes = 0
+        # Files that could not be stat'ed, deleted since they were listed or
+        # broken symlinks, and folders deleted before they were scanned
+        self.skipped = []
+
+    @property
+    def total_files(self):
+        return len(self.files)
+
+    def fingerprint(self):
+        '''
+        Hash of every path, size and mtime in the tree, equal fingerprints
+        mean there is nothing new to back up. Does not depend on the order
+        the directories were scanned in.
+        '''
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(os.fsencode(os.path.abspath(self.root)))
+        for relative_dir in sorted(self.dirs):
+            digest.update(b"\0d" + os.fsencode(relative_dir))
+        for relative_path, size, mtime_ns in sorted(self.files):
+            digest.update(b"\0f%s\t%d\t%d" % (os.fsencode(relative_path), size, mtime_ns))
+        return digest.hexdigest()
+
+
+def scan_directory(root, relative_dir, rules=None):
+    '''
+    One level of scan_tree, returns (subdirectories, files, bytes, excluded,
+    skipped) with excluded the (folders, files, bytes) `rules` left out and
+    skipped the files that could not be stat'ed. Subdirectories are None
+    when the folder itself is gone.
+    '''
+    dirs = []
+    files = []
+    skipped = []
+    total_bytes = 0
+    excluded_dirs = excluded_files = excluded_bytes = 0
+    try:
+        entries = os.scandir(os.path.join(root, relative_dir))
+    except (FileNotFoundError, NotADirectoryError):
+        if not relative_dir:
+            raise
+        # Deleted since its parent was listed, left out like a deleted file
+        return None, files, total_bytes, (0, 0, 0), [relative_dir]
+    with entries:
+        for entry in entries:
+            relative_path = os.path.join(relative_dir, entry.name)
+            if entry.is_dir():
+                if rules is not None and rules.excludes_dir(relative_path):
+                    excluded_dirs += 1
+                else:
+                    dirs.append(relative_path)
+            else:
+                # Patterns first, files they exclude are never stat'ed
+                if rules is not None and not rules.keeps_path(relative_path):
+                    excluded_files += 1
+                    continue
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Deleted since it was listed or a broken symlink, the
+                    # copy would skip it as well
+                    skipped.append(relative_path)
+                    continue
+                if rules is not None and not rules.keeps_stat(stat.st_size, stat.st_mtime_ns):
+                    excluded_files += 1
+                    excluded_bytes += stat.st_size
+                    continue
+                files.append((relative_path, stat.st_size, stat.st_mtime_ns))
+                total_bytes += stat.st_size
+    return dirs, files, total_bytes, (excluded_dirs, excluded_files, excluded_bytes), skipped
+
+
+def scan_tree(root, cancel_event=None, workers=1, rules=None):
+    '''
+    Walks `root` once with os.scandir and returns a SourceTree, symlinks are
+    followed the same way shutil.copytree follows them by default. With more
+    than one worker directories are scanned in parallel, scandir and stat
+    release the GIL so big trees and network shares scan a lot faster.
+    Files and folders `rules` (a backupFilter.FilterRules) exclude are left
+    out as the walk goes, excluded folders are never opened.
+    '''
+    tree = SourceTree(root)
+
+    def add(result):
+        dirs, files, total_bytes, excluded, skipped = result
+        tree.skipped.extend(skipped)
+        if dirs is None:
+            tree.dirs.remove(skipped[0])
+            return []
+        tree.dirs.extend(dirs)
+        tree.files.extend(files)
+        tree.total_bytes += total_bytes
+        tree.excluded_dirs += excluded[0]
+        tree.excluded_files += excluded[1]
+        tree.excluded_bytes += excluded[2]
+        return dirs
+
+    if workers <= 1:
+        pending = [""]
+        while pending:
+            if cancel_event is not None and cancel_event.is_set():
+                raise BackupCancelled()
+            pending.extend(add(scan_directory(root, pending.pop(), rules)))
+        return tree
+    with ThreadPoolExecutor(workers, thread_name_prefix="scan") as executor:
+        # A directory is only added when its parent's scan is done, so
+        # tree.dirs still lists parents first
+        pending = {executor.submit(scan_directory, root, "", rules)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            if cancel_event is not None and cancel_event.is_set():
+                for future in pending:
+                    future.cancel()
+                raise BackupCancelled()
+            for future in done:
+                for relative_dir in add(future.result()):
+                    pending.add(executor.submit(scan_directory, root, relative_dir, rules))
+    return tree
+
+
+def parse_backup_name(name):
+    '''
+    Number of the backup stored in the backups directory entry `name`, that
+    is either a numbered folder or a numbered archive, None for anything else.
+    '''
+    if name.isdigit():
+        return name
+    for extension in ARCHIVE_EXTENSIONS.values():
+        if name.endswith(extension) and name[:-len(extension)].isdigit():
+            return name[:-len(extension)]
+    return None
+
+
+def format_bytes(amount):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(amount) < 1024:
+            return "%.1f %s" % (amount, unit)
+        amount /= 1024
+    return "%.1f TB" % amount
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "--:--:--"
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class BackupProgress:
+    def __init__(self, phase, files_done, files_total, bytes_done, bytes_total, elapsed):
+        self.phase = phase
+        self.files_done = files_done
+        self.files_total = files_total
+        self.bytes_done = bytes_done
+        self.bytes_total = bytes_total
+        self.elapsed = elapsed
+
+    @property
+    def files_per_second(self):
+        return self.files_done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes_done / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self):
+        if not self.bytes_done or self.elapsed <= 0:
+            return None
+        return (self.bytes_total - self.bytes_done) / self.bytes_per_second
+
+    def __str__(self):
+        return "%s %d/%d files, %s/%s, %.0f files/s, %s/s, ETA %s" % (
+            self.phase, self.files_done, self.files_total,
+            format_bytes(self.bytes_done), format_bytes(self.bytes_total),
+            self.files_per_second, format_bytes(self.bytes_per_second),
+            format_duration(self.eta))
+
+
+class ProgressReporter:
+    '''
+    Thread safe counter that only calls `callback` once every `interval`
+    seconds so the GUI event queue is not flooded with one event per file.
+    '''
+
+    def __init__(self, files_total, bytes_total, callback=None, interval=0.5, phase="Copying"):
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.callback = callback
+        self.interval = interval
+        self.phase = phase
+        self.files_done = 0
+        self.bytes_done = 0
+        self.started = time.monotonic()
+        self.last_report = 0.0
+        self.lock = threading.Lock()
+
+    def snapshot(self):
+        return BackupProgress(self.phase, self.files_done, self.files_total,
+                              self.bytes_done, self.bytes_total, time.monotonic() - self.started)
+
+    def advance(self, files=0, nbytes=0):
+        with self.lock:
+            self.files_done += files
+            self.bytes_done += nbytes
+            now = time.monotonic()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            progress = self.snapshot()
+        if self.callback:
+            self.callback(progress)
+
+    def finish(self):
+        with self.lock:
+            progress = self.snapshot()
+        if self.callback:
+            self.callback(progress)
+        return progress
+
+
+class ParallelCopier:
+    '''
+    Replacement for shutil.copytree made for trees with lots of small files,
+    all the directories are created up front, file contents are copied by
+    `copy_function` on a thread pool and metadata is applied in a final
+    batch. The result is the same as copytree(copy_function=shutil.copy2).
+    Files `delta` (a backupDelta.DeltaCopier) wants go through it instead.
+    With a `journal` (a backupJournal.BackupJournal) every file backed up is
+    recorded in it and the ones it already has are not copied again.
+    '''
+
+    def __init__(self, workers=DEFAULT_COPY_WORKERS, copy_function=shutil.copyfile):
+        self.workers = max(1, workers)
+        self.copy_function = copy_function
+        self.delta = None
+        self.journal = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.linked = set()
+        self.skipped = set()
+        self.resumed = set()
+        self.copied_files = 0
+        self.copied_bytes = 0
+        self.linked_bytes = 0
+
+    def link_unchanged(self, link_dest, relative_path, size, mtime_ns, destination):
+        '''
+        Hardlinks `relative_path` from the previous backup `link_dest` when it
+        has the same size and mtime as the source, like rsync --link-dest.
+        Returns False when the file has to be copied instead.
+        '''
+        previous = os.path.join(link_dest, relative_path)
+        try:
+            stat = os.stat(previous)
+            if stat.st_size != size or stat.st_mtime_ns != mtime_ns:
+                return False
+            os.link(previous, destination)
+        except OSError:
+            # Missing in the previous backup, or a filesystem without
+            # hardlinks (FAT, some network shares), just copy it.
+            return False
+        with self.lock:
+            self.linked.add(relative_path)
+            self.linked_bytes += size
+        return True
+
+    def make_dirs(self, tree, target, exist_ok=False):
+        os.makedirs(target, exist_ok=exist_ok)
+        for relative_dir in tree.dirs:
+            if not exist_ok or not os.path.isdir(os.path.join(target, relative_dir)):
+                os.mkdir(os.path.join(target, relative_dir))
+
+    def reuse(self, item, destination, link_dest=None):
+        '''
+        True when the file needs no copy, it is already in the journal or
+        was hardlinked from `link_dest`.
+        '''
+        relative_path, size, mtime_ns = item
+        journal = self.journal
+        done = journal.completed_kind(relative_path, size, mtime_ns) if journal is not None else None
+        if done is not None:
+            with self.lock:
+                self.resumed.add(relative_path)
+                if done == "l":
+                    self.linked.add(relative_path)
+            return True
+        if link_dest and self.link_unchanged(link_dest, relative_path, size, mtime_ns, destination):
+            if self.delta is not None and self.delta.wants(size):
+                self.delta.carry_over(relative_path)
+            if journal is not None:
+                journal.record(relative_path, size, mtime_ns, "l", destination)
+            return True
+        return False
+
+    def copied(self, item, destination):
+        relative_path, size, mtime_ns = item
+        with self.lock:
+            self.copied_files += 1
+            self.copied_bytes += size
+        if self.journal is not None:
+            self.journal.record(relative_path, size, mtime_ns, "c", destination)
+
+    def copy_files(self, tree, target, progress=None, cancel_event=None, link_dest=None):
+        errors = []
+
+        def copy_one(item):
+            relative_path, size, mtime_ns = item
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            destination = os.path.join(target, relative_path)
+            delta = self.delta if self.delta is not None and self.delta.wants(size) else None
+            try:
+                if not self.reuse(item, destination, link_dest):
+                    if delta:
+                        delta.copy(os.path.join(tree.root, relative_path), destination, relative_path, mtime_ns)
+                    else:
+                        self.copy_function(os.path.join(tree.root, relative_path), destination)
+                    self.copied(item, destination)
+            except FileNotFoundError as why:
+                if why.filename != os.path.join(tree.root, relative_path):
+                    errors.append((why.filename, destination, str(why)))
+                else:
+                    # Deleted since the scan, games remove temporary files
+                    # while saving, it is not in the backup and that is fine
+                    with self.lock:
+                        self.skipped.add(relative_path)
+            except OSError as why:
+                errors.append((os.path.join(tree.root, relative_path),
+                               os.path.join(target, relative_path), str(why)))
+            if progress:
+                progress.advance(1, size)
+
+        if self.workers == 1:
+            for item in tree.files:
+                copy_one(item)
+        else:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix="copy") as executor:
+                # Consuming the iterator is what waits for every copy to end
+                for _ in executor.map(copy_one, tree.files):
+                    pass
+        if cancel_event is not None and cancel_event.is_set():
+            raise BackupCancelled()
+        return errors
+
+    def copy_metadata(self, tree, target):
+        errors = []
+        for relative_path, size, mtime_ns in tree.files:
+            if relative_path in self.linked or relative_path in self.skipped:
+                # Hardlinks share the inode, metadata is already the same
+                continue
+            try:
+                shutil.copystat(os.path.join(tree.root, relative_path),
+                                os.path.join(target, relative_path))
+            except OSError as why:
+                errors.append((os.path.join(tree.root, relative_path),
+                               os.path.join(target, relative_path), str(why)))
+        # Same as copytree, directory metadata is copied once their contents
+        # are written, deepest first so parents keep their own mtime.
+        for relative_dir in reversed([""] + tree.dirs):
+            try:
+                shutil.copystat(os.path.join(tree.root, relative_dir),
+                                os.path.join(target, relative_dir))
+            except OSError as why:
+                errors.append((os.path.join(tree.root, relative_dir),
+                               os.path.join(target, relative_dir), str(why)))
+        return errors
+
+    def copy_tree(self, tree, target, progress=None, cancel_event=None, link_dest=None):
+        self.reset()
+        self.make_dirs(tree, target)
+        errors = self.copy_files(tree, target, progress, cancel_event, link_dest)
+        errors.extend(self.copy_metadata(tree, target))
+        if errors:
+            raise shutil.Error(errors)
+
+
+class BackupJob(threading.Thread):
+    '''
+    Copies `source` into `backup_dir/target_name` on a worker thread. All the
+    callbacks are called from the worker thread, GUI callers have to marshal
+    them back to their own thread (e.g. with wx.CallAfter).
+    `previous` is the numbered directory of the last backup, incremental and
+    store backups use it to skip the files that did not change.
+    `backup_dir` is created by the job once the source has been scanned, when
+    the source fingerprint equals `previous_fingerprint` nothing is created
+    and the job ends as "skipped", unless `force` is set.
+    With `verify_level` "quick" or "full" the finished backup is checked
+    against the scan it was made from, see backupVerify.
+    Full and incremental backups copy files of `delta_min_size` bytes or
+    more with backupDelta, 0 turns that off.
+    Before writing anything the job checks the backups disk has room for
+    it, when it does not `make_room(missing_bytes)` is called (to prune old
+    backups) and the job fails if there is still not enough.
+    Full and incremental backups are written into a staging folder that is
+    renamed to `backup_dir` once complete, with a journal of the files
+    copied so far. interrupt() stops the job like cancel() but keeps both,
+    a job created later for the same `backup_dir` resumes from there.
+    Jobs backing up the same source to several folders share a `fanout`
+    (a backupFanOut.FanOut) that scans and reads the source once for all.
+    When the backups are on another disk than the source, big files are
+    copied as `pipeline` (a fastCopy.Pipeline) says.
+    Only what `rules` (a backupFilter.FilterRules) keep is backed up.
+    '''
+
+    def __init__(self, source, backup_dir, target_name, *, on_log=None, on_progress=None,
+                 on_finish=None, progress_interval=0.5, workers=DEFAULT_COPY_WORKERS,
+                 mode="full", previous=None, archive_format="zip", compression_threads=0,
+                 previous_fingerprint=None, force=False, verify_level="none", delta_min_size=0,
+                 make_room=None, fanout=None, pipeline=None, rules=None):
+        super().__init__(name="BackupJob", daemon=True)
+        self.source = str(source)
+        self.backup_dir = str(backup_dir)
+        self.target_name = target_name
+        self.target = os.path.join(self.backup_dir, target_name)
+        self.output = self.target
+        self.mode = mode
+        self.previous = str(previous) if previous else None
+        self.workers = workers
+        self.archive_format = archive_format
+        self.compression_threads = compression_threads
+        self.previous_fingerprint = previous_fingerprint
+        self.force = force
+        self.verify_level = verify_level
+        self.delta_min_size = delta_min_size
+        self.make_room = make_room
+        self.fanout = fanout
+        self.pipeline = pipeline
+        self.rules = rules
+        self.staging = None
+        self.journal = None
+        self.keep_partial = False
+        # Bytes the backup added to the backups disk
+        self.disk_bytes = None
+        self.verification = None
+        self.tree = None
+        self.fingerprint = None
+        self.created = False
+        self.on_log = on_log
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.progress_interval = progress_interval
+        self.backend = CopyBackend()
+        self.copier = ParallelCopier(workers, self.backend.copyfile)
+        self.cancel_event = threading.Event()
+        import backupMetrics
+        self.metrics = backupMetrics.BackupMetrics(mode)
+        self.status = "pending"
+        self.error = None
+        self.result = None
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def interrupt(self):
+        '''
+        Stops the job keeping what was copied so the next backup resumes it,
+        for when the app is closing.
+        '''
+        self.keep_partial = True
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def log(self, message, log_type="INFO"):
+        if self.on_log:
+            self.on_log(message, log_type)
+
+    def check_cancelled(self):
+        if self.cancel_event.is_set():
+            raise BackupCancelled()
+
+    def run(self):
+        self.status = "running"
+        try:
+            self.result = self.copy()
+            self.status = "done"
+        except BackupSkipped:
+            self.status = "skipped"
+            self.log("Nothing changed since the last backup, no new backup was made")
+        except BackupCancelled:
+            # Once renamed in place there is nothing left to resume
+            if self.keep_partial and self.journal is not None and os.path.isdir(self.staging):
+                self.status = "interrupted"
+                self.journal.close()
+                self.log("Backup interrupted, it will be resumed by the next backup", "WARN")
+            else:
+                self.status = "cancelled"
+                self.log("Backup cancelled, removing incomplete backup %s" % self.backup_dir, "WARN")
+                self.remove_incomplete()
+        except Exception as excp:
+            self.status = "failed"
+            self.error = excp
+            if isinstance(excp, shutil.Error):
+                self.metrics.errors = len(excp.args[0])
+            else:
+                self.metrics.errors = 1
+            self.log("Backup failed: %s" % excp, "ERROR")
+            self.remove_incomplete()
+        if self.status == "done" and self.verify_level != "none":
+            self.verify()
+        if self.fanout is not None:
+            self.fanout.leave(self)
+        self.metrics.finished = time.time()
+        if self.metrics.phases:
+            self.log("Phases: %s" % self.metrics.summary())
+        if self.on_finish:
+            self.on_finish(self)
+
+    def remove_incomplete(self):
+        if not self.created:
+            # Never delete something this job did not create
+            return
+        if self.journal is not None:
+            self.journal.discard()
+        if os.path.isdir(self.backup_dir):
+            shutil.rmtree(self.backup_dir, ignore_errors=True)
+        elif os.path.exists(self.backup_dir):
+            os.remove(self.backup_dir)
+
+    def copy(self):
+        self.log("Scanning %s" % self.source)
+        with self.metrics.phase("scan") as phase:
+            if self.fanout is not None:
+                tree, self.fingerprint = self.fanout.scan(self)
+                self.tree = tree
+            else:
+                tree = self.tree = scan_tree(self.source, self.cancel_event, self.workers, self.rules)
+                self.fingerprint = tree.fingerprint()
+            phase.files = tree.total_files
+            phase.bytes = tree.total_bytes
+        self.log("Found %d files in %d folders (%s)" % (
+            tree.total_files, len(tree.dirs), format_bytes(tree.total_bytes)))
+        self.metrics.excluded_files = tree.excluded_files
+        self.metrics.excluded_bytes = tree.excluded_bytes
+        if tree.excluded_files or tree.excluded_dirs:
+            self.log("Left out %d files and %d folders, %s" % (
+                tree.excluded_files, tree.excluded_dirs, self.rules))
+        self.metrics.skipped = len(tree.skipped)
+        if tree.skipped:
+            self.log("Skipped %d files or folders that were deleted while scanning or are broken links" % len(
+                tree.skipped), "WARN")
+        if not self.force and self.fingerprint == self.previous_fingerprint:
+            raise BackupSkipped()
+        with self.metrics.phase("space"):
+            self.check_space(tree)
+        if self.mode in ("full", "incremental"):
+            with self.metrics.phase("mkdir"):
+                self.open_staging(tree)
+            self.created = True
+        elif self.mode != "archive":
+            with self.metrics.phase("mkdir"):
+                os.mkdir(self.backup_dir)
+            self.created = True
+        progress = ProgressReporter(tree.total_files, tree.total_bytes,
+                                    self.on_progress, self.progress_interval)
+        if self.mode == "store":
+            self.store(tree, progress)
+            return progress.finish()
+        if self.mode == "archive":
+            self.archive(tree, progress)
+            return progress.finish()
+        link_dest = None
+        if self.mode == "incremental" and self.previous:
+            link_dest = os.path.join(self.previous, self.target_name)
+            self.log("Incremental backup against %s" % link_dest)
+        if self.pipeline is not None and self.pipeline.min_size > 0 and self.other_device():
+            self.backend.pipeline = self.pipeline.sized(self.workers)
+            self.log("Backing up to another disk, %s" % self.backend.pipeline)
+        delta = None
+        if self.delta_min_size > 0:
+            import backupDelta
+            delta = self.copier.delta = backupDelta.DeltaCopier(self.delta_min_size, self.previous,
+                                                                self.target_name)
+        self.copy_tree(tree, progress, link_dest, os.path.join(self.staging, self.target_name))
+        for method, files, nbytes in self.backend.used_methods():
+            self.log("Copied %d files (%s) with %s" % (files, format_bytes(nbytes), method))
+        if self.copier.resumed:
+            self.log("%d files were already copied before the interruption" % len(self.copier.resumed))
+        self.disk_bytes = self.copier.copied_bytes
+        if delta is not None and delta.index:
+            with self.metrics.phase("metadata"):
+                delta.write_index(self.staging)
+            if delta.patched_files or delta.copied_files:
+                self.log(delta)
+            if delta.reflink:
+                self.disk_bytes -= delta.total_bytes - delta.written_bytes
+        with self.metrics.phase("sync"):
+            self.journal.finish()
+            os.rename(self.staging, self.backup_dir)
+            self.journal.remove()
+        if link_dest:
+            self.log("Linked %d unchanged files (%s), copied %d files (%s)" % (
+                len(self.copier.linked), format_bytes(self.copier.linked_bytes),
+                self.copier.copied_files, format_bytes(self.copier.copied_bytes)))
+        return progress.finish()
+
+    def other_device(self):
+        try:
+            return os.stat(self.source).st_dev != os.stat(os.path.dirname(self.backup_dir)).st_dev
+        except OSError:
+            return False
+
+    def check_space(self, tree):
+        import backupSpace
+        backup_path = os.path.dirname(self.backup_dir)
+        needed = backupSpace.estimate_backup_size(tree, self.mode, self.previous, self.target_name, self.workers)
+        free = backupSpace.free_space(backup_path)
+        if free is None:
+            self.log("Can't tell the free space of %s, backing up anyway" % backup_path, "WARN")
+            return
+        self.log("The backup needs up to %s, %s free" % (format_bytes(needed), format_bytes(free)))
+        if needed > free and self.make_room:
+            self.make_room(needed - free)
+            free = backupSpace.free_space(backup_path) or 0
+        if needed > free:
+            raise backupSpace.NotEnoughSpace(needed, free, backup_path)
+
+    def verify(self):
+        '''
+        Checks the backup just made, problems are logged and counted as
+        errors but the backup is kept, it is still the best copy there is.
+        Cancelling or failing to verify does not touch it either.
+        '''
+        import backupVerify
+        self.log("Verifying the backup (%s)" % self.verify_level)
+        try:
+            with self.metrics.phase("verify") as phase:
+                self.verification = backupVerify.verify_backup(
+                    self.source, self.backup_dir, self.mode, self.verify_level, self.workers,
+                    tree=self.tree, cancel_event=self.cancel_event)
+                phase.files = self.verification.checked_files
+                phase.bytes = self.verification.checked_bytes
+        except BackupCancelled:
+            self.log("Verification cancelled, the backup is kept unverified", "WARN")
+            return
+        except Exception as excp:
+            self.metrics.errors += 1
+            self.log("Verification failed: %s, the backup is kept unverified" % excp, "ERROR")
+            return
+        if self.verification.ok:
+            self.log(self.verification)
+            return
+        self.metrics.errors += len(self.verification.problems)
+        self.log(self.verification, "ERROR")
+        for path, problem in sorted(self.verification.problems)[:20]:
+            self.log("%s: %s" % (path, problem), "ERROR")
+
+    def open_staging(self, tree):
+        '''
+        Creates the staging folder and its journal, or picks up the ones an
+        interrupted backup to the same number left.
+        '''
+        import backupJournal
+        self.staging = backupJournal.staging_path(os.path.dirname(self.backup_dir),
+                                                  os.path.basename(self.backup_dir))
+        journal = backupJournal.BackupJournal(self.staging)
+        if journal.exists:
+            if not journal.open():
+                raise RuntimeError("%s is being written by another backup" % self.staging)
+            self.journal = self.copier.journal = journal
+            kept = journal.prepare_resume(tree, os.path.join(self.staging, self.target_name))
+            self.log("Resuming the interrupted backup, %d files of it are still current" % kept)
+            return
+        if os.path.exists(self.staging):
+            # Interrupted before its journal was written, nothing to keep
+            shutil.rmtree(self.staging)
+        journal.create(source=self.source, mode=self.mode, folder=self.target_name)
+        self.journal = self.copier.journal = journal
+
+    def copy_tree(self, tree, progress, link_dest, target=None):
+        '''
+        ParallelCopier.copy_tree split in its timed phases.
+        '''
+        target = target or self.target
+        copier = self.copier
+        copier.reset()
+        with self.metrics.phase("mkdir") as phase:
+            # A staging folder may be resumed before any file was journaled,
+            # prepare_resume keeps its folders either way
+            copier.make_dirs(tree, target, exist_ok=copier.journal is not None)
+            phase.files = len(tree.dirs) + 1
+        with self.metrics.phase("copy") as phase:
+            if self.fanout is not None:
+                errors = self.fanout.copy_files(self, tree, target, progress, link_dest)
+            else:
+                errors = copier.copy_files(tree, target, progress, self.cancel_event, link_dest)
+            phase.files = copier.copied_files
+            phase.bytes = copier.copied_bytes
+        with self.metrics.phase("metadata") as phase:
+            errors.extend(copier.copy_metadata(tree, target))
+            phase.files = tree.total_files - len(copier.linked) - len(copier.skipped) + len(tree.dirs) + 1
+        self.metrics.unchanged = len(copier.linked)
+        self.metrics.skipped += len(copier.skipped)
+        if copier.skipped:
+            self.log("Skipped %d files that were deleted while backing up" % len(copier.skipped), "WARN")
+        if errors:
+            raise shutil.Error(errors)
+
+    def store(self, tree, progress):
+        import backupStore
+        store = backupStore.ObjectStore(os.path.dirname(self.backup_dir))
+        previous = backupStore.find_previous_manifest(self.previous)
+        writer = backupStore.StoreWriter(store, self.workers)
+        with self.metrics.phase("copy") as phase:
+            manifest = writer.write(tree, self.target_name, previous, progress, self.cancel_event)
+            phase.files = writer.stored_files
+            phase.bytes = writer.stored_bytes
+        self.metrics.unchanged = writer.reused_files + writer.deduplicated_files
+        self.metrics.skipped += len(writer.skipped)
+        if writer.skipped:
+            self.log("Skipped %d files that were deleted while backing up" % len(writer.skipped), "WARN")
+        self.output = os.path.join(self.backup_dir, backupStore.MANIFEST_NAME)
+        with self.metrics.phase("metadata") as phase:
+            backupStore.write_manifest(self.output, manifest)
+            phase.files = len(manifest["files"]) + len(manifest["dirs"])
+        self.disk_bytes = writer.stored_bytes + os.path.getsize(self.output)
+        self.log("Stored %d new files (%s), %d already in the store, %d unchanged since the last backup" % (
+            writer.stored_files, format_bytes(writer.stored_bytes),
+            writer.deduplicated_files, writer.reused_files))
+
+    def archive(self, tree, progress):
+        '''
+        In archive mode `backup_dir` is the archive file itself, it is written
+        in META_DIR_NAME/partial and moved in place once complete.
+        '''
+        import backupArchive
+        writer = backupArchive.ArchiveWriter(self.archive_format, self.compression_threads)
+        partial_dir = os.path.join(os.path.dirname(self.backup_dir), META_DIR_NAME, "partial")
+        os.makedirs(partial_dir, exist_ok=True)
+        partial = os.path.join(partial_dir, os.path.basename(self.backup_dir))
+        try:
+            with self.metrics.phase("copy") as phase:
+                writer.write(tree, partial, self.target_name, progress, self.cancel_event)
+                phase.files = tree.total_files
+                phase.bytes = tree.total_bytes
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, self.backup_dir)
+        self.created = True
+        self.output = self.backup_dir
+        self.disk_bytes = os.path.getsize(self.backup_dir)
+        self.metrics.skipped += len(writer.skipped)
+        if writer.skipped:
+            self.log("Skipped %d files that were deleted while backing up" % len(writer.skipped), "WARN")
+        self.log("Archived %d files, %d compressed and %d stored as they were, archive size %s" % (
+            writer.compressed_files + writer.stored_files, writer.compressed_files, writer.stored_files,
+            format_bytes(self.disk_bytes)))
@@ -0,0 +1,424 @@
+import collections
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from backupEngine import BackupCancelled, format_bytes, scan_tree
+
+# Source data waiting to be written to one backups folder, a slow folder
+# only holds back the reads for the others once this is full
+FANOUT_BUFFER_BYTES = 64 * 1024 * 1024
+FANOUT_CHUNK_SIZE = 1024 * 1024
+
+
+class WriteQueue:
+    '''
+    FIFO of writes for one writer thread, put() blocks while more than
+    `limit` bytes are waiting in it.
+    '''
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.items = collections.deque()
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def put(self, item, nbytes=0):
+        with self.condition:
+            while self.size and self.size + nbytes > self.limit:
+                self.condition.wait()
+            self.items.append((item, nbytes))
+            self.size += nbytes
+            self.condition.notify_all()
+
+    def get(self):
+        with self.condition:
+            while not self.items:
+                self.condition.wait()
+            item, nbytes = self.items.popleft()
+            self.size -= nbytes
+            self.condition.notify_all()
+            return item
+
+
+class FanOutDestination:
+    '''
+    The files of one BackupJob during a FanOut pass, written by its own
+    threads from its own queues. Every file goes to the queue picked by its
+    path so its chunks are written in order.
+    '''
+
+    def __init__(self, job, tree, target, progress, link_dest, buffer_bytes):
+        self.job = job
+        self.tree = tree
+        self.target = target
+        self.progress = progress
+        self.link_dest = link_dest
+        self.copier = job.copier
+        self.errors = []
+        self.queues = [WriteQueue(max(FANOUT_CHUNK_SIZE, buffer_bytes // self.copier.workers))
+                       for _ in range(self.copier.workers)]
+        self.threads = []
+        # Set by a writer that hit something other than an OSError, this
+        # backup fails and the rest of its writes are only drained
+        self.broken = False
+
+    @property
+    def cancelled(self):
+        return self.job.cancelled
+
+    def __str__(self):
+        return os.path.dirname(self.job.backup_dir)
+
+    def start(self):
+        for index, writes in enumerate(self.queues):
+            thread = threading.Thread(target=self.write, args=(writes,), daemon=True,
+                                      name="Fan out %s %d" % (self, index))
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        for writes in self.queues:
+            writes.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def put(self, item, nbytes=0):
+        self.queues[hash(item[1][0]) % len(self.queues)].put(item, nbytes)
+
+    def wants(self, item):
+        '''
+        False when the file needs nothing read from the source, it is reused
+        from the journal or the previous backup, or delta copied here.
+        '''
+        relative_path, size, mtime_ns = item
+        destination = os.path.join(self.target, relative_path)
+        copier = self.copier
+        try:
+            if copier.reuse(item, destination, self.link_dest):
+                self.progress.advance(1, size)
+                return False
+            if copier.delta is not None and copier.delta.wants(size):
+                # Hashes and patches against its own previous backup
+                copier.delta.copy(os.path.join(self.tree.root, relative_path), destination,
+                                  relative_path, mtime_ns)
+                copier.copied(item, destination)
+                self.progress.advance(1, size)
+                return False
+        except FileNotFoundError:
+            self.missing(item)
+            return False
+        except OSError as why:
+            self.failed(item, why)
+            return False
+        return True
+
+    def missing(self, item):
+        # Deleted since the scan, same as ParallelCopier
+        with self.copier.lock:
+            self.copier.skipped.add(item[0])
+        self.progress.advance(1, item[1])
+
+    def failed(self, item, why):
+        relative_path = item[0]
+        self.errors.append((os.path.join(self.tree.root, relative_path),
+                            os.path.join(self.target, relative_path), str(why)))
+        self.progress.advance(1, item[1])
+
+    def write(self, writes):
+        files = {}
+        while True:
+            entry = writes.get()
+            if entry is None:
+                return
+            action, item = entry[0], entry[1]
+            relative_path = item[0]
+            destination = os.path.join(self.target, relative_path)
+            if self.cancelled or self.broken:
+                # Keep draining so the reads for the other folders go on
+                file = files.pop(relative_path, None)
+                if file is not None:
+                    file.close()
+                continue
+            try:
+                if action == "whole":
+                    with open(destination, "wb") as file:
+                        file.write(entry[2])
+                    self.copier.copied(item, destination)
+                    self.progress.advance(1, item[1])
+                elif action == "open":
+                    files[relative_path] = open(destination, "wb")
+                elif action == "data":
+                    if relative_path in files:
+                        files[relative_path].write(entry[2])
+                elif action == "close":
+                    file = files.pop(relative_path, None)
+                    if file is not None:
+                        file.close()
+                        self.copier.copied(item, destination)
+                        self.progress.advance(1, item[1])
+                elif action == "abort":
+                    file = files.pop(relative_path, None)
+                    if file is not None:
+                        file.close()
+                        os.remove(destination)
+                        self.failed(item, entry[2])
+            except Exception as why:
+                file = files.pop(relative_path, None)
+                if file is not None:
+                    try:
+                        file.close()
+                    except OSError:
+                        pass
+                if not isinstance(why, OSError):
+                    self.broken = True
+                self.failed(item, why)
+
+
+class FanOut:
+    '''
+    Lets the BackupJobs of the same folder to several backups folders share
+    the work on the source: the first one to scan scans for all of them,
+    and the copy phase waits until every job got there (or ended without
+    copying) to read each file once and queue it to every folder that needs
+    it, each folder writes on its own threads. `expected` is how many jobs
+    will call copy_files() or leave().
+    '''
+
+    def __init__(self, expected=0, workers=1, buffer_bytes=FANOUT_BUFFER_BYTES):
+        self.expected = expected
+        self.workers = max(1, workers)
+        self.buffer_bytes = buffer_bytes
+        self.tree = None
+        self.fingerprint = None
+        self.scan_lock = threading.Lock()
+        self.destinations = []
+        self.accounted = set()
+        self.condition = threading.Condition()
+        self.started = False
+        self.finished = threading.Event()
+        self.read_files = 0
+        self.read_bytes = 0
+
+    def scan(self, job):
+        '''
+        The tree and fingerprint of the source, scanned by the first job
+        that asks. A cancelled scan leaves it to the next one.
+        '''
+        with self.scan_lock:
+            if self.tree is None:
+                tree = scan_tree(job.source, job.cancel_event, job.workers, job.rules)
+                self.fingerprint = tree.fingerprint()
+                self.tree = tree
+            return self.tree, self.fingerprint
+
+    def leave(self, job):
+        '''
+        For jobs that end without copying (skipped, failed, cancelled...),
+        does nothing for the ones that did.
+        '''
+        with self.condition:
+            if job in self.accounted:
+                return
+            self.accounted.add(job)
+            self.expected -= 1
+            self.start_when_ready()
+
+    def start_when_ready(self):
+        if not self.started and self.destinations and len(self.destinations) >= self.expected:
+            self.started = True
+            threading.Thread(target=self.run, name="FanOut", daemon=True).start()
+            self.condition.notify_all()
+
+    def copy_files(self, job, tree, target, progress, link_dest=None):
+        '''
+        ParallelCopier.copy_files for `job` as part of the shared pass,
+        returns its errors once the pass ends.
+        '''
+        destination = FanOutDestination(job, tree, target, progress, link_dest, self.buffer_bytes)
+        with self.condition:
+            self.accounted.add(job)
+            self.destinations.append(destination)
+            self.start_when_ready()
+            while not self.started:
+                if job.cancelled:
+                    # Cancelled while the others are still getting ready
+                    self.destinations.remove(destination)
+                    self.expected -= 1
+                    self.start_when_ready()
+                    raise BackupCancelled()
+                self.condition.wait(0.2)
+        self.finished.wait()
+        if job.cancelled:
+            raise BackupCancelled()
+        return destination.errors
+
+    def run(self):
+        destinations = list(self.destinations)
+        for destination in destinations:
+            destination.start()
+        try:
+            if self.workers == 1:
+                for item in self.tree.files:
+                    self.read_one(item, destinations)
+            else:
+                with ThreadPoolExecutor(self.workers, thread_name_prefix="fanout") as executor:
+                    for _ in executor.map(lambda item: self.read_one(item, destinations), self.tree.files):
+                        pass
+        finally:
+            for destination in destinations:
+                destination.stop()
+            self.finished.set()
+
+    def read_one(self, item, destinations):
+        relative_path, size, mtime_ns = item
+        wanting = [destination for destination in destinations
+                   if not destination.cancelled and destination.wants(item)]
+        if not wanting:
+            return
+        source = os.path.join(self.tree.root, relative_path)
+        try:
+            file = open(source, "rb")
+        except FileNotFoundError:
+            for destination in wanting:
+                destination.missing(item)
+            return
+        except OSError as why:
+            for destination in wanting:
+                destination.failed(item, why)
+            return
+        read = 0
+        with file:
+            try:
+                chunk = file.read(FANOUT_CHUNK_SIZE)
+                read += len(chunk)
+                if len(chunk) < FANOUT_CHUNK_SIZE:
+                    for destination in wanting:
+                        destination.put(("whole", item, chunk), len(chunk))
+                    return
+                for destination in wanting:
+                    destination.put(("open", item))
+                while chunk:
+                    for destination in wanting:
+                        destination.put(("data", item, chunk), len(chunk))
+                    chunk = file.read(FANOUT_CHUNK_SIZE)
+                    read += len(chunk)
+            except OSError as why:
+                for destination in wanting:
+                    destination.put(("abort", item, why))
+                return
+            finally:
+                with self.condition:
+                    self.read_files += 1
+                    self.read_bytes += read
+        for destination in wanting:
+            destination.put(("close", item))
+
+
+class DestinationsProgress:
+    '''
+    The progress of every backups folder of a MultiBackupJob, added up for
+    the callers that only want totals.
+    '''
+
+    def __init__(self, progresses):
+        self.progresses = progresses
+        known = [progress for label, progress in progresses if progress is not None]
+        self.phase = known[0].phase if known else "Copying"
+        self.files_done = sum(progress.files_done for progress in known)
+        self.files_total = sum(progress.files_total for progress in known)
+        self.bytes_done = sum(progress.bytes_done for progress in known)
+        self.bytes_total = sum(progress.bytes_total for progress in known)
+        self.elapsed = max([progress.elapsed for progress in known], default=0.0)
+
+    def __str__(self):
+        return " | ".join("%s: %s" % (label, progress) for label, progress in self.progresses
+                          if progress is not None)
+
+
+class MultiBackupJob(threading.Thread):
+    '''
+    Backs up to several backups folders at once, one BackupJob per folder
+    sharing a FanOut. Looks like a single BackupJob to its callers, it is
+    "done" when every folder is done (or had nothing new to back up).
+    Each folder keeps its own numbering, progress and errors, one failing
+    does not stop the others.
+    '''
+
+    def __init__(self, jobs, labels, *, on_log=None, on_progress=None, on_finish=None):
+        super().__init__(name="MultiBackupJob", daemon=True)
+        self.jobs = jobs
+        self.labels = labels
+        self.on_log = on_log
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.progress_interval = 0.5
+        self.progresses = [None] * len(jobs)
+        self.lock = threading.Lock()
+        self.status = "pending"
+        self.error = None
+        self.result = None
+        for index, job in enumerate(jobs):
+            job.on_progress = self.progress_callback(index)
+
+    def progress_callback(self, index):
+        def progress(job_progress):
+            with self.lock:
+                self.progresses[index] = job_progress
+                combined = DestinationsProgress(list(zip(self.labels, self.progresses)))
+            if self.on_progress:
+                self.on_progress(combined)
+        return progress
+
+    @property
+    def number(self):
+        return self.jobs[0].number
+
+    @property
+    def tree(self):
+        return next((job.tree for job in self.jobs if job.tree is not None), None)
+
+    @property
+    def output(self):
+        return ", ".join(job.output for job in self.jobs if job.status == "done")
+
+    @property
+    def cancelled(self):
+        return all(job.cancelled for job in self.jobs)
+
+    def cancel(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def interrupt(self):
+        for job in self.jobs:
+            job.interrupt()
+
+    def log(self, message, log_type="INFO"):
+        if self.on_log:
+            self.on_log(message, log_type)
+
+    def run(self):
+        self.status = "running"
+        for job in self.jobs:
+            job.progress_interval = self.progress_interval
+            job.start()
+        for job in self.jobs:
+            job.join()
+        statuses = [job.status for job in self.jobs]
+        if all(status in ("done", "skipped") for status in statuses):
+            self.status = "done" if "done" in statuses else "skipped"
+        else:
+            self.status = next(status for status in ("failed", "interrupted", "cancelled") if status in statuses)
+        self.error = next((job.error for job in self.jobs if job.error is not None), None)
+        results = [(label, job.result) for label, job in zip(self.labels, self.jobs) if job.status == "done"]
+        self.result = DestinationsProgress(results) if results else None
+        fanout = self.jobs[0].fanout
+        if fanout is not None and fanout.read_files:
+            self.log("Read %d files (%s) from the source once for every folder" % (
+                fanout.read_files, format_bytes(fanout.read_bytes)))
+        self.log("Backed up to %d folders: %s" % (len(self.jobs), ", ".join(
+            "%s %s" % (label, job.status) for label, job in zip(self.labels, self.jobs))),
+            "INFO" if self.status in ("done", "skipped") else "WARN")
+        if self.on_finish:
+            self.on_finish(self)
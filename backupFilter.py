@@ -0,0 +1,183 @@
+import os
+import re
+import time
+
+# Patterns can be on separate lines (indented continuation lines in the
+# config file) or separated by ;
+RULE_SEPARATORS = re.compile(r"[;\n]")
+SECONDS_PER_DAY = 24 * 60 * 60
+
+
+def glob_to_regex(pattern):
+    '''
+    Regex source for a gitignore style glob: `*` and `?` do not match "/",
+    `**` matches any number of folders, [...] is a character class and a
+    backslash escapes the next character.
+    '''
+    parts = []
+    index = 0
+    while index < len(pattern):
+        character = pattern[index]
+        if pattern.startswith("**/", index):
+            parts.append("(?:.*/)?")
+            index += 3
+        elif pattern.startswith("**", index):
+            parts.append(".*")
+            index += 2
+        elif character == "*":
+            parts.append("[^/]*")
+            index += 1
+        elif character == "?":
+            parts.append("[^/]")
+            index += 1
+        elif character == "[" and pattern.find("]", index + 2) != -1:
+            end = pattern.find("]", index + 2)
+            body = pattern[index + 1:end].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            parts.append("[%s]" % body)
+            index = end + 1
+        elif character == "\\" and index + 1 < len(pattern):
+            parts.append(re.escape(pattern[index + 1]))
+            index += 2
+        else:
+            parts.append(re.escape(character))
+            index += 1
+    return "".join(parts)
+
+
+def parse_rule(line):
+    '''
+    (regex source, negated, folders only) for one gitignore style line,
+    None for blank lines and comments. Patterns without a "/" (other than a
+    trailing one) match at any depth, the others from the top folder.
+    '''
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    negated = line.startswith("!")
+    if negated:
+        line = line[1:]
+    dirs_only = line.endswith("/")
+    line = line.rstrip("/")
+    if not line:
+        return None
+    anchored = "/" in line
+    source = glob_to_regex(line.lstrip("/"))
+    if not anchored:
+        source = "(?:.*/)?" + source
+    return source, negated, dirs_only
+
+
+def compile_rules(rules):
+    '''
+    A single regex for every (source, negated) in `rules` and the negated
+    flag of each of its groups. The alternatives are tried from the last
+    rule to the first, so the group that matches is the last matching rule,
+    the one that decides in gitignore.
+    '''
+    if not rules:
+        return None, {}
+    alternatives = []
+    negated = {}
+    for index in reversed(range(len(rules))):
+        source, negate = rules[index]
+        name = "r%d" % index
+        alternatives.append("(?P<%s>%s)" % (name, source))
+        negated[name] = negate
+    flags = re.DOTALL | (re.IGNORECASE if os.name == "nt" else 0)
+    return re.compile("(?:%s)\\Z" % "|".join(alternatives), flags), negated
+
+
+def split_rules(text):
+    return [line.strip() for line in RULE_SEPARATORS.split(text or "") if line.strip()]
+
+
+class FilterRules:
+    '''
+    Which files of a folder are backed up, compiled once from the settings
+    of a profile and applied by scan_tree as it walks the folder:
+      exclude   gitignore style patterns, the last one that matches a path
+                decides, "!pattern" takes an exclusion back and "name/"
+                only matches folders. Excluded folders are not looked into
+                at all, so nothing inside them can be taken back.
+      include   when there are any, only the files matching one of them or
+                inside a folder matching one of them are backed up
+      max_size  bytes, bigger files are left out, 0 for no limit
+      max_age   seconds, files not modified for longer are left out, 0 for
+                no limit
+    '''
+
+    def __init__(self, exclude=(), include=(), max_size=0, max_age=0):
+        self.exclude = list(exclude)
+        self.include = list(include)
+        self.max_size = max_size
+        self.max_age = max_age
+        excludes = [rule for rule in map(parse_rule, self.exclude) if rule]
+        self.dir_exclude, self.dir_negated = compile_rules(
+            [(source, negated) for source, negated, dirs_only in excludes])
+        self.file_exclude, self.file_negated = compile_rules(
+            [(source, negated) for source, negated, dirs_only in excludes if not dirs_only])
+        # An included folder includes everything inside it
+        includes = [rule for rule in map(parse_rule, self.include) if rule and not rule[1]]
+        self.file_include, _ = compile_rules(
+            [(source + ("/.*" if dirs_only else "(?:/.*)?"), False) for source, negated, dirs_only in includes])
+
+    @classmethod
+    def from_settings(cls, exclude="", include="", max_size_mb=0, max_age_days=0):
+        '''
+        The rules of a profile, None when it does not filter anything.
+        '''
+        rules = cls(split_rules(exclude), split_rules(include), max(0, max_size_mb or 0) * 1024 * 1024,
+                    max(0, max_age_days or 0) * SECONDS_PER_DAY)
+        return rules if rules.active else None
+
+    @property
+    def active(self):
+        return bool(self.dir_exclude or self.file_include or self.max_size or self.max_age)
+
+    @staticmethod
+    def decide(regex, negated, path):
+        if regex is None:
+            return False
+        match = regex.match(path)
+        return match is not None and not negated[match.lastgroup]
+
+    def excludes_dir(self, relative_dir):
+        if os.sep != "/":
+            relative_dir = relative_dir.replace(os.sep, "/")
+        return self.decide(self.dir_exclude, self.dir_negated, relative_dir)
+
+    def keeps_file(self, relative_path, size, mtime_ns):
+        return self.keeps_stat(size, mtime_ns) and self.keeps_path(relative_path)
+
+    def keeps_stat(self, size, mtime_ns):
+        '''
+        keeps_file by the size and age limits alone.
+        '''
+        if self.max_size and size > self.max_size:
+            return False
+        return not self.max_age or mtime_ns >= time.time_ns() - self.max_age * 1000000000
+
+    def keeps_path(self, relative_path):
+        '''
+        keeps_file by the patterns alone, for files that are gone or not
+        stat'ed yet.
+        '''
+        if os.sep != "/":
+            relative_path = relative_path.replace(os.sep, "/")
+        if self.decide(self.file_exclude, self.file_negated, relative_path):
+            return False
+        return self.file_include is None or self.file_include.match(relative_path) is not None
+
+    def __str__(self):
+        parts = []
+        if self.exclude:
+            parts.append("excluding %s" % ", ".join(self.exclude))
+        if self.include:
+            parts.append("only including %s" % ", ".join(self.include))
+        if self.max_size:
+            parts.append("files up to %d MB" % (self.max_size // (1024 * 1024)))
+        if self.max_age:
+            parts.append("files changed in the last %d days" % (self.max_age // SECONDS_PER_DAY))
+        return ", ".join(parts)
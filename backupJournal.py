@@ -0,0 +1,263 @@
+import ctypes
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+
+from backupEngine import META_DIR_NAME
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+
+STAGING_DIR_NAME = "staging"
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_VERSION = 1
+# Copied files are made durable and written to the journal in batches of
+# this many files or seconds, whatever comes first
+CHECKPOINT_FILES = 1000
+CHECKPOINT_SECONDS = 5.0
+# Backup modes written file by file into a staging folder, store backups
+# are resumable by design and archives can't be appended to
+JOURNALED_MODES = ("full", "incremental")
+
+
+def staging_path(backup_path, number):
+    return os.path.join(str(backup_path), META_DIR_NAME, STAGING_DIR_NAME, str(number))
+
+
+def lock_file(file):
+    '''
+    Non blocking exclusive lock on an open file, held until it is closed.
+    False when another process holds it.
+    '''
+    try:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elif msvcrt is not None:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def sync_filesystem(path, files=()):
+    '''
+    Makes what was written under `path` durable. On linux one syncfs of the
+    filesystem does it for every file at once, elsewhere each file in
+    `files` is fsync'ed.
+    '''
+    if sys.platform.startswith("linux"):
+        try:
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if libc.syncfs(fd) == 0:
+                    return
+            finally:
+                os.close(fd)
+        except (OSError, AttributeError):
+            pass
+    for file_path in files:
+        try:
+            fd = os.open(file_path, os.O_RDWR)
+        except OSError:
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+class BackupJournal:
+    '''
+    Record of the files already copied into the staging folder of a backup,
+    META_DIR_NAME/staging/<n>.journal next to META_DIR_NAME/staging/<n>. One
+    JSON line per file, appended only after the file is on disk, so when a
+    backup is interrupted (the app closed, a crash, a power cut) the next
+    one resumes it copying only what the journal does not have.
+    The journal is locked while a job uses it, a locked journal belongs to
+    a backup that is still running in another process.
+    '''
+
+    def __init__(self, staging):
+        self.staging = str(staging)
+        self.path = self.staging + JOURNAL_SUFFIX
+        self.header = None
+        self.completed = {}
+        self.pending = []
+        self.file = None
+        self.lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()
+        self.last_checkpoint = time.monotonic()
+
+    @property
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def create(self, **header):
+        os.makedirs(self.staging)
+        self.header = dict(header, version=JOURNAL_VERSION)
+        self.file = open(self.path, "w", encoding="utf-8")
+        lock_file(self.file)
+        self.file.write(json.dumps(self.header) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def open(self):
+        '''
+        Loads an existing journal to resume it, False when another process
+        is using it.
+        '''
+        self.file = open(self.path, "a+", encoding="utf-8")
+        if not lock_file(self.file):
+            self.file.close()
+            self.file = None
+            return False
+        self.file.seek(0)
+        for number, line in enumerate(self.file):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Cut short by the crash, that file is copied again
+                continue
+            if number == 0:
+                self.header = record
+            else:
+                relative_path, size, mtime_ns, kind = record
+                self.completed[relative_path] = (size, mtime_ns, kind)
+        self.file.seek(0, os.SEEK_END)
+        return True
+
+    def read_header(self):
+        '''
+        The header of the journal without loading or locking it, empty when
+        it can't be read.
+        '''
+        try:
+            with open(self.path, encoding="utf-8") as file:
+                return json.loads(file.readline())
+        except (OSError, ValueError):
+            return {}
+
+    def completed_kind(self, relative_path, size, mtime_ns):
+        '''
+        How the file was already backed up ("c" copied, "l" linked) when it
+        still is what the source has, None when it has to be backed up.
+        '''
+        done = self.completed.get(relative_path)
+        if done is None or done[0] != size or done[1] != mtime_ns:
+            return None
+        return done[2]
+
+    def prepare_resume(self, tree, target):
+        '''
+        Deletes from the staging copy `target` every file the journal does
+        not vouch for, they may be half written, hardlinks that must not be
+        written to, or deleted from the source since. Returns how many
+        files were kept.
+        '''
+        wanted = {relative_path: (size, mtime_ns) for relative_path, size, mtime_ns in tree.files}
+        kept = {}
+        for root, dirs, files in os.walk(target, topdown=False):
+            for name in files:
+                path = os.path.join(root, name)
+                relative_path = os.path.relpath(path, target)
+                done = self.completed.get(relative_path)
+                try:
+                    intact = (done is not None and wanted.get(relative_path) == done[:2]
+                              and os.lstat(path).st_size == done[0])
+                except OSError:
+                    intact = False
+                if intact:
+                    kept[relative_path] = done
+                elif os.path.lexists(path):
+                    os.remove(path)
+            if os.path.relpath(root, target) not in tree.dirs and root != target:
+                try:
+                    os.rmdir(root)
+                except OSError:
+                    pass
+        self.completed = kept
+        return len(kept)
+
+    def record(self, relative_path, size, mtime_ns, kind, destination):
+        with self.lock:
+            self.pending.append((relative_path, size, mtime_ns, kind, destination))
+            due = (len(self.pending) >= CHECKPOINT_FILES
+                   or time.monotonic() - self.last_checkpoint >= CHECKPOINT_SECONDS)
+        if due and self.checkpoint_lock.acquire(blocking=False):
+            # Only one copy thread syncs, the others keep copying
+            try:
+                self.checkpoint()
+            finally:
+                self.checkpoint_lock.release()
+
+    def checkpoint(self):
+        with self.lock:
+            batch = self.pending
+            self.pending = []
+            self.last_checkpoint = time.monotonic()
+        if not batch or self.file is None:
+            return
+        sync_filesystem(self.staging, [item[4] for item in batch])
+        self.file.write("".join(json.dumps(item[:4]) + "\n" for item in batch))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def finish(self):
+        '''
+        Writes what is pending and makes the whole staging folder durable,
+        metadata included, before it is renamed into place.
+        '''
+        with self.checkpoint_lock:
+            self.checkpoint()
+        sync_filesystem(self.staging)
+
+    def close(self):
+        if self.file is not None:
+            with self.checkpoint_lock:
+                self.checkpoint()
+            self.file.close()
+            self.file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def discard(self):
+        '''
+        Deletes the staging folder and the journal.
+        '''
+        self.close()
+        shutil.rmtree(self.staging, ignore_errors=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def find_interrupted(catalog):
+    '''
+    Numbers of the backups of `catalog` that were interrupted and left a
+    journal nobody is using, oldest first.
+    '''
+    interrupted = []
+    backups = catalog.load()["backups"]
+    for number, entry in backups.items():
+        if entry.get("complete", True):
+            continue
+        journal = BackupJournal(staging_path(catalog.backup_path, number))
+        if journal.exists and journal.open():
+            journal.close()
+            interrupted.append(number)
+    return sorted(interrupted, key=int)
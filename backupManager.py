@@ -0,0 +1,222 @@
+import os
+
+from backupCatalog import NumberTaken
+from backupEngine import BackupJob, ARCHIVE_EXTENSIONS, format_bytes
+from backupJournal import JOURNALED_MODES, BackupJournal, find_interrupted, staging_path
+
+
+class BackupError(Exception):
+    pass
+
+
+def last_backup_path(settings):
+    latest = settings.catalog.latest
+    if latest is not None:
+        return settings.catalog.path_of(latest)
+    return False
+
+
+def create_backup_job(settings, *, on_log=None, on_progress=None, on_finish=None, force=False):
+    '''
+    Reserves the next backup number and returns the BackupJob that creates
+    and fills its folder, not started yet. The catalog entry is completed
+    or dropped when the job ends, before `on_finish` is called. Unless
+    `force` is set the job makes no backup when the source did not change
+    since the latest one.
+    With several backups folders it returns a backupFanOut.MultiBackupJob
+    instead, with a BackupJob for each folder numbered by its own catalog,
+    folders that can't be backed up to are only logged.
+    Used by both the window and the command line so they number and register
+    backups the same way.
+    '''
+    destinations = settings.destinations()
+    if len(destinations) == 1:
+        return create_destination_job(settings, on_log=on_log, on_progress=on_progress,
+                                      on_finish=on_finish, force=force)
+    from backupFanOut import FanOut, MultiBackupJob
+    fanout = FanOut(workers=settings.copy_workers)
+    jobs = []
+    labels = []
+    for destination in destinations:
+        label = str(destination.backup_path)
+
+        def log(message, log_type="INFO", label=label):
+            if on_log:
+                on_log("[%s] %s" % (label, message), log_type)
+
+        try:
+            job = create_destination_job(destination, on_log=log, force=force, fanout=fanout)
+        except BackupError as excp:
+            log(excp, "ERROR")
+            continue
+        jobs.append(job)
+        labels.append(label)
+    if not jobs:
+        raise BackupError("None of the backups folders can be backed up to")
+    if settings.backup_mode in JOURNALED_MODES:
+        fanout.expected = len(jobs)
+    return MultiBackupJob(jobs, labels, on_log=on_log, on_progress=on_progress, on_finish=on_finish)
+
+
+def create_destination_job(settings, *, on_log=None, on_progress=None, on_finish=None, force=False,
+                           fanout=None):
+    '''
+    create_backup_job for a single backups folder.
+    '''
+    def log(message, log_type="INFO"):
+        if on_log:
+            on_log(message, log_type)
+
+    catalog = settings.catalog
+    if not os.path.isdir(str(settings.backup_path)):
+        raise BackupError("The backups folder %s is not available" % settings.backup_path)
+    previous = last_backup_path(settings)
+    latest = catalog.get(catalog.latest) if previous else None
+    mode = settings.backup_mode
+    name = interrupted_backup(settings, mode, log)
+    resuming = name is not None
+    if not resuming:
+        name = catalog.next_number
+    while True:
+        entry = name + ARCHIVE_EXTENSIONS[settings.archive_format] if mode == "archive" and not resuming else name
+        new_path = os.path.join(settings.backup_path, entry)
+        if os.path.lexists(new_path):
+            raise BackupError("%s already exists" % new_path)
+        # The folder is created by the job once it knows there is something
+        # to back up, the catalog entry keeps the number reserved meanwhile
+        try:
+            catalog.add(name, mode=mode, entry=entry)
+            break
+        except NumberTaken:
+            if resuming:
+                raise BackupError("Backup %s is being resumed by another backup" % name)
+            # Another process took the same number at the same time
+            name = str(int(name) + 1)
+    if resuming:
+        log("Resuming interrupted Backup Directory %s" % new_path)
+    elif mode == "archive":
+        log("Creating Backup Archive %s" % new_path)
+    else:
+        log("Creating Backup Directory %s" % new_path)
+
+    def make_room(missing):
+        if settings.low_space_action != "prune" or settings.retention_policy == "none":
+            return
+        log("%s more space is needed, deleting old backups first" % format_bytes(missing), "WARN")
+        from backupRetention import prune_backups
+        log(prune_backups(settings, on_log=on_log, reserved=(name,)))
+
+    def finished(job):
+        if job.status == "done":
+            catalog.complete(name, size=job.result.bytes_total, files=job.result.files_total,
+                             fingerprint=job.fingerprint, disk_size=job.disk_bytes)
+        elif job.status == "interrupted":
+            # Its journal keeps the number reserved from now on
+            catalog.release(name)
+        elif job.journal is not None:
+            # Only the job that opened the staging folder may throw it away
+            job.journal.discard()
+            catalog.remove(name)
+        elif not resuming:
+            catalog.remove(name)
+        else:
+            # The interrupted backup was never opened, another process may be
+            # resuming it. When nothing changed since, it is of no use anymore
+            journal = BackupJournal(staging_path(settings.backup_path, name))
+            if job.status == "skipped" and journal.exists and journal.open():
+                journal.discard()
+                catalog.remove(name)
+            else:
+                catalog.release(name)
+        record_run(settings, job, log)
+        if on_finish:
+            on_finish(job)
+
+    job = BackupJob(
+        settings.save_path, new_path, os.path.basename(settings.save_path),
+        on_log=on_log, on_progress=on_progress, on_finish=finished,
+        workers=settings.copy_workers,
+        mode=mode,
+        previous=previous,
+        archive_format=settings.archive_format,
+        compression_threads=settings.COPY.compression_threads,
+        verify_level=settings.verify_level,
+        delta_min_size=settings.delta_min_size,
+        make_room=make_room,
+        fanout=fanout,
+        pipeline=settings.pipeline,
+        rules=settings.filter_rules,
+        # A backup made in another mode is still worth making
+        previous_fingerprint=latest.get("fingerprint") if latest and latest.get("mode") == mode else None,
+        force=force)
+    job.number = name
+    return job
+
+
+def interrupted_backup(settings, mode, log):
+    '''
+    The number of the interrupted backup a new `mode` backup should resume,
+    None when there is none. Interrupted backups that can't be resumed
+    (another mode or source, or older than the latest backup) are deleted.
+    '''
+    catalog = settings.catalog
+    latest = catalog.latest
+    resumable = None
+    for number in reversed(find_interrupted(catalog)):
+        journal = BackupJournal(staging_path(settings.backup_path, number))
+        header = journal.read_header()
+        if (resumable is None and mode in JOURNALED_MODES and header.get("mode") == mode
+                and header.get("source") == str(settings.save_path)
+                and (latest is None or int(number) > int(latest))):
+            resumable = number
+            continue
+        log("Deleting interrupted backup %s, it can't be resumed" % number, "WARN")
+        journal.discard()
+        catalog.remove(number)
+    return resumable
+
+
+def prometheus_textfile(settings):
+    '''
+    The configured textfile, profiles other than the default one write
+    next to it with their name added (backup.prom -> backup.games.prom) as
+    each run replaces the whole file, and so do backups folders after the
+    first one with their position (backup.2.prom).
+    '''
+    from appSettings import DEFAULT_PROFILE_NAME
+    textfile = settings.METRICS.prometheus_textfile
+    if not textfile or (settings.name == DEFAULT_PROFILE_NAME and not settings.destination_index):
+        return textfile
+    base, extension = os.path.splitext(textfile)
+    if settings.name != DEFAULT_PROFILE_NAME:
+        base = "%s.%s" % (base, settings.name)
+    if settings.destination_index:
+        base = "%s.%d" % (base, settings.destination_index + 1)
+    return base + extension
+
+
+def record_run(settings, job, log):
+    '''
+    Appends the metrics of a finished job to the history of the backups
+    directory and updates the Prometheus textfile when one is configured.
+    A backup never fails because of this, problems are only logged.
+    '''
+    import backupMetrics
+    record = job.metrics.to_record(
+        profile=settings.name, number=job.number, status=job.status, source=job.source, output=job.output,
+        error=str(job.error) if job.error else None,
+        verification={
+            "level": job.verification.level,
+            "ok": job.verification.ok,
+            "problems": len(job.verification.problems),
+        } if job.verification else None)
+    try:
+        backupMetrics.append_history(settings.backup_path, record)
+    except OSError as excp:
+        log("Could not write the backup history: %s" % excp, "WARN")
+    textfile = prometheus_textfile(settings)
+    if textfile:
+        try:
+            backupMetrics.write_prometheus(textfile, record, settings.backup_path)
+        except OSError as excp:
+            log("Could not write the Prometheus textfile %s: %s" % (textfile, excp), "WARN")
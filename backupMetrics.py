@@ -0,0 +1,174 @@
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from backupEngine import META_DIR_NAME, format_bytes
+
+HISTORY_NAME = "history.jsonl"
+PROMETHEUS_PREFIX = "folder_backup"
+
+
+class PhaseMetrics:
+    def __init__(self, name):
+        self.name = name
+        self.seconds = 0.0
+        self.files = 0
+        self.bytes = 0
+
+    def to_dict(self):
+        return {
+            "seconds": round(self.seconds, 6),
+            "files": self.files,
+            "bytes": self.bytes,
+            "files_per_second": round(self.files / self.seconds, 1) if self.seconds > 0 else None,
+            "bytes_per_second": round(self.bytes / self.seconds) if self.seconds > 0 else None,
+        }
+
+    def __str__(self):
+        message = "%s %.2fs" % (self.name, self.seconds)
+        if self.bytes and self.seconds > 0:
+            message += " (%s/s)" % format_bytes(self.bytes / self.seconds)
+        return message
+
+
+class BackupMetrics:
+    '''
+    Timings and counters of one backup, filled by BackupJob as it goes
+    through its phases (scan, mkdir, copy, metadata...). Phases a mode does
+    not have are just not recorded.
+    '''
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.phases = OrderedDict()
+        self.started = time.time()
+        self.finished = None
+        self.errors = 0
+        self.skipped = 0
+        self.unchanged = 0
+        # Left out by the filter rules, bytes only of those left out by size
+        # or age
+        self.excluded_files = 0
+        self.excluded_bytes = 0
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Times the block, yields the PhaseMetrics so the block can fill in
+        what it processed.
+        '''
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = PhaseMetrics(name)
+        started = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase.seconds += time.perf_counter() - started
+
+    def summary(self):
+        return ", ".join(str(phase) for phase in self.phases.values())
+
+    def to_record(self, **info):
+        '''
+        The dict appended to the history, `info` adds or overrides fields.
+        '''
+        self.finished = self.finished or time.time()
+        seconds = self.finished - self.started
+        scan = self.phases.get("scan")
+        record = {
+            "started": round(self.started, 3),
+            "finished": round(self.finished, 3),
+            "seconds": round(seconds, 6),
+            "mode": self.mode,
+            "files": scan.files if scan else 0,
+            "bytes": scan.bytes if scan else 0,
+            "unchanged_files": self.unchanged,
+            "skipped_files": self.skipped,
+            "excluded_files": self.excluded_files,
+            "excluded_bytes": self.excluded_bytes,
+            "errors": self.errors,
+            "phases": {name: phase.to_dict() for name, phase in self.phases.items()},
+        }
+        record["files_per_second"] = round(record["files"] / seconds, 1) if seconds > 0 else None
+        record["bytes_per_second"] = round(record["bytes"] / seconds) if seconds > 0 else None
+        record.update(info)
+        return record
+
+
+def history_path(backup_path):
+    return os.path.join(str(backup_path), META_DIR_NAME, HISTORY_NAME)
+
+
+def append_history(backup_path, record):
+    '''
+    Appends `record` as one JSON line, a single write so concurrent writers
+    do not interleave within a line.
+    '''
+    path = history_path(backup_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a", encoding="utf-8") as file:
+        file.write(json.dumps(record, separators=(",", ":"), sort_keys=True) + "\n")
+
+
+def read_history(backup_path, limit=None):
+    '''
+    The last `limit` records (all of them with None), oldest first. Lines
+    that do not parse, like one cut by a crash, are skipped.
+    '''
+    records = []
+    try:
+        with open(history_path(backup_path), encoding="utf-8") as file:
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    except FileNotFoundError:
+        return []
+    return records[-limit:] if limit else records
+
+
+def prometheus_text(record, backup_path):
+    '''
+    The record in the Prometheus text exposition format, for node_exporter's
+    textfile collector.
+    '''
+    label = '{backup_dir="%s"}' % str(backup_path).replace("\\", "\\\\").replace('"', '\\"')
+    lines = []
+
+    def metric(name, kind, help, value, labels=label):
+        full_name = "%s_%s" % (PROMETHEUS_PREFIX, name)
+        if not any(line.startswith("# TYPE %s " % full_name) for line in lines):
+            lines.append("# HELP %s %s" % (full_name, help))
+            lines.append("# TYPE %s %s" % (full_name, kind))
+        lines.append("%s%s %s" % (full_name, labels, value))
+
+    metric("last_run_timestamp_seconds", "gauge", "When the last backup finished.", record["finished"])
+    metric("last_run_success", "gauge", "1 if the last backup completed or had nothing to do.",
+           int(record.get("status") in ("done", "skipped")))
+    metric("last_run_duration_seconds", "gauge", "Wall time of the last backup.", record["seconds"])
+    metric("last_run_files", "gauge", "Files in the backed up folder.", record["files"])
+    metric("last_run_bytes", "gauge", "Bytes in the backed up folder.", record["bytes"])
+    metric("last_run_unchanged_files", "gauge", "Files reused from the previous backup.", record["unchanged_files"])
+    metric("last_run_skipped_files", "gauge", "Files that could not be backed up.", record["skipped_files"])
+    metric("last_run_errors", "gauge", "Errors in the last backup.", record["errors"])
+    if record.get("verification"):
+        metric("last_run_verification_problems", "gauge", "Files of the last backup that did not verify.",
+               record["verification"]["problems"])
+    for name, phase in record["phases"].items():
+        metric("last_run_phase_seconds", "gauge", "Wall time of each phase of the last backup.",
+               phase["seconds"], label[:-1] + ',phase="%s"}' % name)
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path, record, backup_path):
+    '''
+    Atomically replaces the textfile, the collector must never read half of it.
+    '''
+    temporary = "%s.%d.tmp" % (path, os.getpid())
+    with open(temporary, "w", encoding="utf-8") as file:
+        file.write(prometheus_text(record, backup_path))
+    os.replace(temporary, path)
@@ -0,0 +1,393 @@
+import abc
+import os
+import shutil
+import stat
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from backupEngine import (BackupCancelled, DEFAULT_COPY_WORKERS, ARCHIVE_EXTENSIONS, format_bytes,
+                          scan_tree)
+from backupVerify import MTIME_TOLERANCE_NS, hash_path, hash_stream
+from fastCopy import CopyBackend
+
+RESTORE_COMPARISONS = ("mtime", "hash")
+TEMPORARY_SUFFIX = ".restoring"
+
+
+class RestoreError(Exception):
+    pass
+
+
+class RestoreResult:
+    def __init__(self, number):
+        self.number = number
+        self.safety_backup = None
+        self.checked_files = 0
+        self.restored_files = 0
+        self.restored_bytes = 0
+        self.removed_files = 0
+        self.seconds = 0.0
+
+    def __str__(self):
+        message = "Restored %d of %d files (%s) from backup %s in %.1fs" % (
+            self.restored_files, self.checked_files, format_bytes(self.restored_bytes), self.number, self.seconds)
+        if self.removed_files:
+            message += ", removed %d files that were not in the backup" % self.removed_files
+        if self.safety_backup:
+            message += ", the previous state is in backup %s" % self.safety_backup
+        return message
+
+
+class BackupContents(abc.ABC):
+    '''
+    What a backup holds, whatever its mode: `files` maps relative paths to
+    (size, mtime_ns, digest or None) and `dirs` lists relative directories
+    parents first. write(relative_path, destination) writes one file and
+    write_all many of them.
+    '''
+    # Folders and the store keep mtimes to the nanosecond, archives do not
+    mtime_tolerance_ns = 0
+
+    def __init__(self):
+        self.files = {}
+        self.dirs = []
+
+    @abc.abstractmethod
+    def write(self, relative_path, destination):
+        pass
+
+    @abc.abstractmethod
+    def hash(self, relative_path):
+        pass
+
+    def write_all(self, destinations, workers=1, cancelled=None):
+        '''
+        Writes every file of {relative path: destination} on `workers`
+        threads, the ones left when `cancelled()` turns true are not.
+        '''
+        def write_one(item):
+            if cancelled is None or not cancelled():
+                self.write(*item)
+
+        with ThreadPoolExecutor(max(1, workers), thread_name_prefix="restore") as executor:
+            for _ in executor.map(write_one, destinations.items()):
+                pass
+
+    def apply_dir_metadata(self, target):
+        pass
+
+
+class FolderContents(BackupContents):
+    def __init__(self, root, workers):
+        super().__init__()
+        self.root = root
+        self.backend = CopyBackend()
+        tree = scan_tree(root, workers=workers)
+        self.dirs = tree.dirs
+        for relative_path, size, mtime_ns in tree.files:
+            self.files[relative_path] = (size, mtime_ns, None)
+
+    def write(self, relative_path, destination):
+        source = os.path.join(self.root, relative_path)
+        self.backend.copyfile(source, destination)
+        shutil.copystat(source, destination)
+
+    def hash(self, relative_path):
+        return hash_path(os.path.join(self.root, relative_path))
+
+    def apply_dir_metadata(self, target):
+        for relative_dir in reversed([""] + self.dirs):
+            shutil.copystat(os.path.join(self.root, relative_dir), os.path.join(target, relative_dir))
+
+
+class StoreContents(BackupContents):
+    def __init__(self, entry_path):
+        super().__init__()
+        import backupStore
+        self.manifest = backupStore.read_manifest(os.path.join(entry_path, backupStore.MANIFEST_NAME))
+        self.store = backupStore.ObjectStore(os.path.dirname(entry_path))
+        self.hash_name = self.manifest.get("hash")
+        self.entries = {}
+        for key, entry in self.manifest["files"].items():
+            relative_path = os.path.join(*key.split("/"))
+            self.entries[relative_path] = entry
+            self.files[relative_path] = (entry[1], entry[2], entry[0])
+        self.dirs = sorted((os.path.join(*key.split("/")) for key in self.manifest["dirs"] if key),
+                           key=lambda path: path.count(os.sep))
+
+    def write(self, relative_path, destination):
+        digest, size, mtime_ns, mode = self.entries[relative_path]
+        shutil.copyfile(self.store.object_path(digest), destination)
+        os.chmod(destination, mode)
+        os.utime(destination, ns=(mtime_ns, mtime_ns))
+
+    def hash(self, relative_path):
+        return self.entries[relative_path][0]
+
+    def apply_dir_metadata(self, target):
+        for key, (mtime_ns, mode) in sorted(self.manifest["dirs"].items(), key=lambda item: -item[0].count("/")):
+            path = os.path.join(target, *key.split("/")) if key else target
+            os.chmod(path, mode)
+            os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+class ArchiveContents(BackupContents):
+    '''
+    Archives can only be read front to back (tar.zst) so they are not
+    written in parallel, write_all extracts every wanted file in one pass
+    (write goes through the whole archive for one file) and the first
+    hash() hashes all of them in one pass.
+    '''
+    mtime_tolerance_ns = MTIME_TOLERANCE_NS
+
+    def __init__(self, archive_path, folder_name):
+        super().__init__()
+        self.archive_path = archive_path
+        self.prefix = folder_name + "/"
+        self.modes = {}
+        self.hashes = None
+        self.hashes_lock = threading.Lock()
+        dirs = set()
+        for name, info in self.members():
+            relative_path = self.relative(name)
+            if info is None:
+                dirs.add(relative_path)
+                continue
+            size, mtime, mode = info
+            self.files[relative_path] = (size, int(mtime * 1e9), None)
+            self.modes[relative_path] = mode
+            parent = os.path.dirname(relative_path)
+            while parent:
+                dirs.add(parent)
+                parent = os.path.dirname(parent)
+        self.dirs = sorted(dirs, key=lambda path: path.count(os.sep))
+
+    def members(self, handle=None):
+        '''
+        Yields (name, (size, mtime, mode)) for files and (name, None) for
+        folders inside the backed up folder. `handle` is called with the
+        relative path and the open member of every file as they go by.
+        '''
+        if self.archive_path.endswith(ARCHIVE_EXTENSIONS["zip"]):
+            with zipfile.ZipFile(self.archive_path) as archive:
+                for info in archive.infolist():
+                    name = info.filename.rstrip("/")
+                    if not name.startswith(self.prefix):
+                        continue
+                    if info.is_dir():
+                        yield name, None
+                        continue
+                    mtime = time.mktime(info.date_time + (0, 0, -1))
+                    yield name, (info.file_size, mtime, info.external_attr >> 16)
+                    if handle:
+                        with archive.open(info) as member:
+                            handle(self.relative(name), member)
+            return
+        import backupArchive
+        if backupArchive.zstandard is None:
+            raise RestoreError("The zstandard package is needed to read %s" % self.archive_path)
+        with open(self.archive_path, "rb") as raw:
+            stream = backupArchive.zstandard.ZstdDecompressor().stream_reader(raw)
+            with tarfile.open(fileobj=stream, mode="r|") as archive:
+                for info in archive:
+                    if not info.name.startswith(self.prefix):
+                        continue
+                    if info.isdir():
+                        yield info.name, None
+                        continue
+                    if not info.isfile():
+                        continue
+                    yield info.name, (info.size, info.mtime, info.mode)
+                    if handle:
+                        with archive.extractfile(info) as member:
+                            handle(self.relative(info.name), member)
+
+    def relative(self, name):
+        return os.path.join(*name[len(self.prefix):].split("/"))
+
+    def hash(self, relative_path):
+        with self.hashes_lock:
+            if self.hashes is None:
+                hashes = {}
+
+                def handle(member_path, member):
+                    hashes[member_path] = hash_stream(member)
+
+                for _ in self.members(handle):
+                    pass
+                self.hashes = hashes
+        return self.hashes[relative_path]
+
+    def write(self, relative_path, destination):
+        self.write_all({relative_path: destination})
+
+    def write_all(self, destinations, workers=1, cancelled=None):
+        def handle(relative_path, member):
+            destination = destinations.get(relative_path)
+            if destination and (cancelled is None or not cancelled()):
+                with open(destination, "wb") as file:
+                    shutil.copyfileobj(member, file, 1024 * 1024)
+
+        for _ in self.members(handle):
+            pass
+        for relative_path, destination in destinations.items():
+            if not os.path.exists(destination):
+                # Cancelled before it was extracted
+                continue
+            size, mtime_ns, digest = self.files[relative_path]
+            if self.modes.get(relative_path):
+                os.chmod(destination, stat.S_IMODE(self.modes[relative_path]))
+            os.utime(destination, ns=(mtime_ns, mtime_ns))
+
+
+def open_backup(catalog, number, folder_name, workers=DEFAULT_COPY_WORKERS):
+    entry = catalog.get(number)
+    if entry is None or not entry.get("complete", True):
+        raise RestoreError("Backup %s does not exist" % number)
+    path = catalog.path_of(number)
+    mode = entry.get("mode", "full")
+    if mode == "store":
+        return StoreContents(path)
+    if mode == "archive":
+        return ArchiveContents(path, folder_name)
+    root = os.path.join(path, folder_name)
+    if not os.path.isdir(root):
+        raise RestoreError("%s does not exist" % root)
+    return FolderContents(root, workers)
+
+
+class Restorer:
+    '''
+    Makes `target` match a backup by copying back only the files that are
+    missing or differ (by size and mtime, or also by hash), on a thread pool.
+    Every file is written next to its final name and renamed over it, so an
+    interrupted restore never leaves half written files.
+    '''
+
+    def __init__(self, contents, target, workers=DEFAULT_COPY_WORKERS, compare="mtime", cancel_event=None):
+        if compare not in RESTORE_COMPARISONS:
+            raise ValueError("Unknown comparison %s" % compare)
+        self.contents = contents
+        self.target = str(target)
+        self.workers = max(1, workers)
+        self.compare = compare
+        self.cancel_event = cancel_event
+        self.lock = threading.Lock()
+
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def differs(self, relative_path, current):
+        size, mtime_ns, digest = self.contents.files[relative_path]
+        if current is None or current[0] != size:
+            return True
+        if abs(current[1] - mtime_ns) > self.contents.mtime_tolerance_ns:
+            return True
+        if self.compare == "hash":
+            hash_name = getattr(self.contents, "hash_name", None)
+            if hash_name not in (None, "sha256"):
+                return True
+            return self.contents.hash(relative_path) != hash_path(os.path.join(self.target, relative_path))
+        return False
+
+    def changed_files(self, tree):
+        current = {relative_path: (size, mtime_ns) for relative_path, size, mtime_ns in tree.files}
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="restore") as executor:
+            flags = executor.map(lambda path: self.differs(path, current.get(path)), self.contents.files)
+            return [path for path, changed in zip(self.contents.files, flags) if changed]
+
+    def restore(self, tree, result, remove_extras=False):
+        '''
+        `tree` is a scan of the target as it is now.
+        '''
+        changed = self.changed_files(tree)
+        result.checked_files = len(self.contents.files)
+        for relative_dir in self.contents.dirs:
+            path = os.path.join(self.target, relative_dir)
+            if os.path.lexists(path) and not os.path.isdir(path):
+                # A file where the backup has a folder
+                os.remove(path)
+            os.makedirs(path, exist_ok=True)
+        destinations = {path: os.path.join(self.target, path + TEMPORARY_SUFFIX) for path in changed}
+        try:
+            self.contents.write_all(destinations, self.workers, self.cancelled)
+            if self.cancelled():
+                raise BackupCancelled()
+            for relative_path, temporary in destinations.items():
+                final = os.path.join(self.target, relative_path)
+                if os.path.isdir(final) and not os.path.islink(final):
+                    # A folder where the backup has a file
+                    shutil.rmtree(final)
+                os.replace(temporary, final)
+        finally:
+            for temporary in destinations.values():
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+        result.restored_files = len(changed)
+        result.restored_bytes = sum(self.contents.files[path][0] for path in changed)
+        if remove_extras:
+            result.removed_files = self.remove_extras(tree)
+        self.contents.apply_dir_metadata(self.target)
+        return result
+
+    def remove_extras(self, tree):
+        removed = 0
+        for relative_path, size, mtime_ns in tree.files:
+            if relative_path not in self.contents.files:
+                path = os.path.join(self.target, relative_path)
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    os.remove(path)
+                    removed += 1
+        kept = set(self.contents.dirs)
+        for relative_dir in reversed(tree.dirs):
+            if relative_dir not in kept:
+                try:
+                    os.rmdir(os.path.join(self.target, relative_dir))
+                except OSError:
+                    # Still has something the backup has, keep it
+                    pass
+        return removed
+
+
+def restore_backup(settings, number, *, compare="mtime", remove_extras=False, safety_backup=True,
+                   on_log=None, cancel_event=None):
+    '''
+    Restores backup `number` over the configured folder and returns a
+    RestoreResult. Unless `safety_backup` is off, the folder is first backed
+    up as a new numbered backup (or found unchanged since the latest one) so
+    the restore can be undone.
+    '''
+    from backupManager import create_backup_job
+
+    def log(message, log_type="INFO"):
+        if on_log:
+            on_log(message, log_type)
+
+    started = time.monotonic()
+    number = str(number)
+    save_path = str(settings.save_path)
+    folder_name = os.path.basename(save_path)
+    result = RestoreResult(number)
+    contents = open_backup(settings.catalog, number, folder_name, settings.copy_workers)
+    tree = None
+    if safety_backup:
+        log("Backing up the current state of %s before restoring" % save_path)
+        job = create_backup_job(settings, on_log=on_log)
+        job.start()
+        job.join()
+        if job.status == "done":
+            result.safety_backup = job.number
+        elif job.status != "skipped":
+            raise RestoreError("The safety backup did not complete, nothing was restored")
+        tree = job.tree
+    if tree is None:
+        # Files the backups leave out are neither restored over nor deleted
+        tree = scan_tree(save_path, cancel_event, settings.copy_workers, settings.filter_rules)
+    log("Restoring backup %s over %s" % (number, save_path))
+    restorer = Restorer(contents, save_path, settings.copy_workers, compare, cancel_event)
+    restorer.restore(tree, result, remove_extras)
+    result.seconds = time.monotonic() - started
+    return result
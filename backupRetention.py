@@ -0,0 +1,289 @@
+import ctypes
+import os
+import platform
+import stat
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backupEngine import DEFAULT_COPY_WORKERS, format_bytes
+
+RETENTION_POLICIES = ("none", "keep_last", "gfs")
+TRASH_DIR_NAME = "trash"
+# ioprio_set is not exposed by python, syscall numbers by architecture
+IOPRIO_SET_SYSCALLS = {
+    "x86_64": 251,
+    "amd64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "arm64": 30,
+    "armv7l": 314,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+THREAD_MODE_BACKGROUND_BEGIN = 0x00010000
+
+
+def lower_io_priority():
+    '''
+    Puts the calling thread in the idle i/o class (linux) or background mode
+    (windows) so deleting old backups does not slow down everything else.
+    Does nothing where that is not possible.
+    '''
+    try:
+        if sys.platform.startswith("linux"):
+            number = IOPRIO_SET_SYSCALLS.get(platform.machine().lower())
+            if number is not None:
+                libc = ctypes.CDLL(None, use_errno=True)
+                # who 0 with IOPRIO_WHO_PROCESS is the calling thread
+                libc.syscall(number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT)
+        elif sys.platform == "win32":
+            kernel32 = ctypes.windll.kernel32
+            kernel32.SetThreadPriority(kernel32.GetCurrentThread(), THREAD_MODE_BACKGROUND_BEGIN)
+    except (OSError, AttributeError):
+        pass
+
+
+def backups_to_keep(backups, policy="keep_last", keep_last=10, keep_daily=7, keep_weekly=4, keep_monthly=12):
+    '''
+    `backups` is a list of (number, created timestamp), newest first. Returns
+    the set of numbers the policy keeps:
+      keep_last  the `keep_last` newest backups
+      gfs        the `keep_last` newest plus the newest backup of each of the
+                 last `keep_daily` days, `keep_weekly` weeks and
+                 `keep_monthly` months that have backups
+    The newest backup is always kept, the next incremental or store backup
+    is made against it.
+    '''
+    if policy not in ("keep_last", "gfs"):
+        return {number for number, created in backups}
+    keep = {number for number, created in backups[:max(1, keep_last)]}
+    if policy == "gfs":
+        periods = (
+            (keep_daily, lambda day: (day.tm_year, day.tm_yday)),
+            (keep_weekly, lambda day: time.strftime("%G-%V", day)),
+            (keep_monthly, lambda day: (day.tm_year, day.tm_mon)),
+        )
+        for count, period_of in periods:
+            seen = set()
+            for number, created in backups:
+                if len(seen) >= count:
+                    break
+                period = period_of(time.localtime(created))
+                if period not in seen:
+                    seen.add(period)
+                    keep.add(number)
+    return keep
+
+
+class PruneResult:
+    def __init__(self):
+        self.deleted = []
+        self.files = 0
+        self.bytes_reclaimed = 0
+        self.objects = 0
+        self.elapsed = 0.0
+
+    def add(self, other):
+        self.deleted.extend(other.deleted)
+        self.files += other.files
+        self.bytes_reclaimed += other.bytes_reclaimed
+        self.objects += other.objects
+        self.elapsed += other.elapsed
+
+    def __str__(self):
+        message = "Deleted %d backups (%d files) in %.1fs, %s reclaimed" % (
+            len(self.deleted), self.files, self.elapsed, format_bytes(self.bytes_reclaimed))
+        if self.objects:
+            message += ", %d unused objects removed from the store" % self.objects
+        return message
+
+
+class BackupPruner:
+    '''
+    Deletes numbered backups without losing data other backups still use.
+    Doomed backups are first renamed into META_DIR_NAME/trash, which is
+    instant, and then deleted file by file on a thread pool running at idle
+    i/o priority, whatever an interrupted run leaves in the trash is deleted
+    on the next one.
+
+    Incremental backups hardlink unchanged files to each other, unlinking a
+    path there only frees the data when it was the last link, so the space
+    reclaimed only counts inodes whose every link is being deleted. Store
+    backups share objects, after deleting their manifests the objects no
+    remaining manifest uses are removed.
+    '''
+
+    def __init__(self, catalog, workers=DEFAULT_COPY_WORKERS, on_log=None):
+        self.catalog = catalog
+        self.workers = max(1, workers)
+        self.on_log = on_log
+        self.trash_path = os.path.join(catalog.meta_path, TRASH_DIR_NAME)
+        self.lock = threading.Lock()
+
+    def log(self, message, log_type="INFO"):
+        if self.on_log:
+            self.on_log(message, log_type)
+
+    def move_to_trash(self, number):
+        source = self.catalog.path_of(number)
+        os.makedirs(self.trash_path, exist_ok=True)
+        destination = os.path.join(self.trash_path, "%s-%d" % (os.path.basename(source), time.time_ns()))
+        if os.path.lexists(source):
+            os.rename(source, destination)
+        self.catalog.remove(number)
+
+    def scan(self, path):
+        '''
+        Returns (files, dirs) under `path`, files as (path, stat) and dirs
+        deepest last, without following symlinks.
+        '''
+        files = []
+        dirs = []
+        pending = [path]
+        while pending:
+            directory = pending.pop()
+            dirs.append(directory)
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    else:
+                        entry_stat = entry.stat(follow_symlinks=False)
+                        if not entry_stat.st_ino:
+                            # scandir on windows does not fill inode and links
+                            entry_stat = os.lstat(entry.path)
+                        files.append((entry.path, entry_stat))
+        return files, dirs
+
+    def remove_file(self, path):
+        try:
+            os.unlink(path)
+        except PermissionError:
+            # Read only files can not be deleted on windows
+            os.chmod(path, stat.S_IWRITE)
+            os.unlink(path)
+
+    def empty_trash(self, result):
+        try:
+            entries = [os.path.join(self.trash_path, name) for name in os.listdir(self.trash_path)]
+        except FileNotFoundError:
+            return
+        folders = [entry for entry in entries if os.path.isdir(entry) and not os.path.islink(entry)]
+        singles = [entry for entry in entries if entry not in folders]
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="prune",
+                                initializer=lower_io_priority) as executor:
+            scans = list(executor.map(self.scan, folders))
+            files = [(path, os.lstat(path)) for path in singles]
+            all_dirs = []
+            for folder_files, folder_dirs in scans:
+                files.extend(folder_files)
+                all_dirs.extend(folder_dirs)
+            # Only inodes that lose every link free their space
+            links = {}
+            for path, file_stat in files:
+                key = (file_stat.st_dev, file_stat.st_ino)
+                links[key] = links.get(key, 0) + 1
+            for path, file_stat in files:
+                key = (file_stat.st_dev, file_stat.st_ino)
+                if links.get(key, 0) >= max(1, file_stat.st_nlink):
+                    result.bytes_reclaimed += file_stat.st_size
+                    del links[key]
+            for _ in executor.map(self.remove_file, [path for path, file_stat in files]):
+                pass
+        result.files += len(files)
+        for directory in reversed(all_dirs):
+            os.rmdir(directory)
+
+    def collect_objects(self, result):
+        '''
+        Removes the store objects no remaining manifest refers to.
+        '''
+        import backupStore
+        store = backupStore.ObjectStore(self.catalog.backup_path)
+        if not os.path.isdir(store.path):
+            return
+        used = set()
+        for number in self.catalog.numbers():
+            manifest = backupStore.find_previous_manifest(self.catalog.path_of(number))
+            if manifest:
+                used.update(entry[0] for entry in manifest["files"].values())
+        unused = []
+        with os.scandir(store.path) as prefixes:
+            for prefix in prefixes:
+                if not prefix.is_dir():
+                    continue
+                with os.scandir(prefix.path) as objects:
+                    for entry in objects:
+                        if not entry.name.startswith(".") and prefix.name + entry.name not in used:
+                            unused.append((entry.path, entry.stat().st_size))
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="prune",
+                                initializer=lower_io_priority) as executor:
+            for _ in executor.map(self.remove_file, [path for path, size in unused]):
+                pass
+        result.objects += len(unused)
+        result.bytes_reclaimed += sum(size for path, size in unused)
+
+    def prune(self, numbers, reserved=()):
+        '''
+        Deletes the backups in `numbers` and returns a PruneResult.
+        `reserved` are incomplete backups known not to have written anything
+        yet, they do not stop unused store objects from being removed.
+        '''
+        started = time.monotonic()
+        result = PruneResult()
+        for number in numbers:
+            self.move_to_trash(number)
+            result.deleted.append(number)
+        self.empty_trash(result)
+        backups = self.catalog.load()["backups"]
+        if any(not entry.get("complete", True) and number not in reserved and self.catalog.writing(number)
+               for number, entry in backups.items()):
+            # A store backup being written may be using objects its manifest
+            # does not list yet, one that was killed won't use them anymore
+            self.log("A backup is being written, unused store objects will be removed next time", "WARN")
+        else:
+            self.collect_objects(result)
+        result.elapsed = time.monotonic() - started
+        return result
+
+
+def prune_backups(settings, keep_last=None, on_log=None, reserved=()):
+    '''
+    Applies the retention policy of `settings`, or keeps the `keep_last`
+    newest backups when given, and returns a PruneResult. `reserved`
+    backups about to be written count as the newest ones, so pruning before
+    a backup deletes what pruning after it would.
+    With several backups folders each one is pruned on its own.
+    '''
+    destinations = settings.destinations()
+    if len(destinations) > 1:
+        result = PruneResult()
+        for destination in destinations:
+            if not os.path.isdir(str(destination.backup_path)):
+                # Not plugged in, it is pruned the next time it is
+                continue
+
+            def log(message, log_type="INFO", label=str(destination.backup_path)):
+                on_log("[%s] %s" % (label, message), log_type)
+            result.add(prune_backups(destination, keep_last, log if on_log else None, reserved))
+        return result
+    catalog = settings.catalog
+    backups = [(number, time.time()) for number in reserved]
+    backups += [(number, catalog.get(number)["created"]) for number in catalog.numbers()]
+    if keep_last is not None:
+        keep = backups_to_keep(backups, "keep_last", keep_last)
+    else:
+        retention = settings.RETENTION
+        keep = backups_to_keep(backups, settings.retention_policy, retention.keep_last,
+                               retention.keep_daily, retention.keep_weekly, retention.keep_monthly)
+    if reserved and len(backups) > len(reserved):
+        # The one the reserved backup is going to be made against
+        keep.add(backups[len(reserved)][0])
+    doomed = [number for number, created in backups if number not in keep and number not in reserved]
+    if on_log and doomed:
+        on_log("Deleting backups %s" % ", ".join(reversed(doomed)))
+    return BackupPruner(catalog, settings.copy_workers, on_log).prune(doomed, reserved)
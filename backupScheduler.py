@@ -0,0 +1,230 @@
+import os
+import threading
+import time
+
+from backupEngine import format_bytes
+
+
+def device_of(path):
+    '''
+    st_dev of `path`, or of its nearest existing parent for backup folders
+    that are not created yet.
+    '''
+    path = os.path.abspath(str(path))
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except FileNotFoundError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                raise
+            path = parent
+
+
+class ProfileRun:
+    '''
+    The backup of one profile inside a BackupScheduler.
+    '''
+
+    def __init__(self, profile):
+        self.profile = profile
+        self.name = profile.name
+        self.devices = ()
+        self.job = None
+        self.status = "pending"
+        self.error = None
+        self.progress = None
+        self.thread = None
+
+    def __str__(self):
+        message = "%s: %s" % (self.name, self.status)
+        if self.error:
+            message += " (%s)" % self.error
+        return message
+
+
+class SchedulerProgress:
+    '''
+    The progress of every profile added up, only counts the profiles that
+    already know how much they have to copy.
+    '''
+
+    def __init__(self, runs):
+        self.profiles_total = len(runs)
+        self.profiles_finished = sum(run.status not in ("pending", "waiting", "running") for run in runs)
+        self.profiles_running = sum(run.status == "running" for run in runs)
+        progresses = [run.progress for run in runs if run.progress is not None]
+        self.files_done = sum(progress.files_done for progress in progresses)
+        self.files_total = sum(progress.files_total for progress in progresses)
+        self.bytes_done = sum(progress.bytes_done for progress in progresses)
+        self.bytes_total = sum(progress.bytes_total for progress in progresses)
+
+    @property
+    def percent(self):
+        return 100.0 * self.bytes_done / self.bytes_total if self.bytes_total else 0.0
+
+    def __str__(self):
+        return "%d/%d profiles done, %d running, %d/%d files, %s/%s (%.0f%%)" % (
+            self.profiles_finished, self.profiles_total, self.profiles_running,
+            self.files_done, self.files_total,
+            format_bytes(self.bytes_done), format_bytes(self.bytes_total), self.percent)
+
+
+class BackupScheduler(threading.Thread):
+    '''
+    Backs up several profiles at the same time, one thread per profile.
+    While its backup runs a profile holds a slot of every disk (st_dev) it
+    reads or writes, each disk has `jobs_per_device` slots, so backups on
+    separate disks run in parallel and the ones sharing a disk take turns
+    instead of seeking against each other. Slots are always taken in st_dev
+    order so two profiles can never wait on each other.
+    Callbacks are called from the worker threads, like BackupJob's.
+    '''
+
+    def __init__(self, profiles, *, on_log=None, on_progress=None, on_finish=None, force=False,
+                 jobs_per_device=1, progress_interval=0.5):
+        super().__init__(name="BackupScheduler", daemon=True)
+        self.runs = [ProfileRun(profile) for profile in profiles]
+        self.on_log = on_log
+        self.on_progress = on_progress
+        self.on_finish = on_finish
+        self.force = force
+        self.jobs_per_device = max(1, jobs_per_device)
+        self.progress_interval = progress_interval
+        self.device_slots = {}
+        self.lock = threading.Lock()
+        self.cancel_event = threading.Event()
+        self.started = None
+        self.seconds = 0.0
+
+    def cancel(self, keep_partial=False):
+        self.cancel_event.set()
+        with self.lock:
+            jobs = [run.job for run in self.runs if run.job is not None]
+        for job in jobs:
+            if keep_partial:
+                job.interrupt()
+            else:
+                job.cancel()
+
+    def interrupt(self):
+        '''
+        BackupJob.interrupt() for every profile.
+        '''
+        self.cancel(keep_partial=True)
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def ok(self):
+        return all(run.status in ("done", "skipped") for run in self.runs)
+
+    def log(self, message, log_type="INFO"):
+        if self.on_log:
+            self.on_log(message, log_type)
+
+    def profile_logger(self, run):
+        def log(message, log_type="INFO"):
+            self.log("[%s] %s" % (run.name, message), log_type)
+        return log
+
+    def progress(self):
+        with self.lock:
+            return SchedulerProgress(self.runs)
+
+    def report_progress(self):
+        if self.on_progress:
+            self.on_progress(self.progress())
+
+    def prepare(self):
+        '''
+        Finds the disks of every profile, profiles whose paths are wrong or
+        that share a backups folder with an earlier one are not run.
+        '''
+        backup_paths = {}
+        for run in self.runs:
+            profile = run.profile
+            profile.invalidate_paths()
+            path_correct, warn_message = profile.init_paths()
+            if not path_correct:
+                run.status, run.error = "failed", warn_message
+                continue
+            folders = [os.path.normcase(str(backup_path)) for backup_path in profile.backup_paths]
+            shared = [folder for folder in folders if folder in backup_paths]
+            if shared:
+                run.status = "failed"
+                run.error = "uses the same backups folder as %s" % backup_paths[shared[0]]
+                continue
+            backup_paths.update((folder, run.name) for folder in folders)
+            run.devices = tuple(sorted({device_of(profile.save_path)} | {
+                device_of(backup_path) for backup_path in profile.backup_paths}))
+            for device in run.devices:
+                if device not in self.device_slots:
+                    self.device_slots[device] = threading.BoundedSemaphore(self.jobs_per_device)
+        for run in self.runs:
+            if run.status == "failed":
+                self.log("Profile %s not backed up: %s" % (run.name, run.error), "ERROR")
+
+    def run(self):
+        self.started = time.monotonic()
+        self.prepare()
+        for run in self.runs:
+            if run.status == "pending":
+                run.thread = threading.Thread(target=self.run_profile, args=(run,),
+                                              name="Backup %s" % run.name, daemon=True)
+                run.thread.start()
+        for run in self.runs:
+            if run.thread is not None:
+                run.thread.join()
+        self.seconds = time.monotonic() - self.started
+        self.log("Backed up %d profiles in %.1fs: %s" % (
+            len(self.runs), self.seconds, ", ".join(str(run) for run in self.runs)),
+            "INFO" if self.ok else "WARN")
+        if self.on_finish:
+            self.on_finish(self)
+
+    def run_profile(self, run):
+        run.status = "waiting"
+        acquired = []
+        try:
+            for device in run.devices:
+                self.device_slots[device].acquire()
+                acquired.append(device)
+            if self.cancelled:
+                run.status = "cancelled"
+                return
+            self.backup_profile(run)
+        except Exception as excp:
+            run.status, run.error = "failed", excp
+            self.log("[%s] Backup failed: %s" % (run.name, excp), "ERROR")
+        finally:
+            for device in reversed(acquired):
+                self.device_slots[device].release()
+            self.report_progress()
+
+    def backup_profile(self, run):
+        from backupManager import create_backup_job
+        log = self.profile_logger(run)
+
+        def progress(job_progress):
+            run.progress = job_progress
+            self.report_progress()
+
+        job = create_backup_job(run.profile, on_log=log, on_progress=progress, force=self.force)
+        job.progress_interval = self.progress_interval
+        with self.lock:
+            run.job = job
+            run.status = "running"
+        if self.cancelled:
+            job.cancel()
+        job.start()
+        job.join()
+        run.status = job.status
+        run.error = job.error
+        if job.status == "done":
+            log(job.result)
+            if run.profile.retention_policy != "none":
+                from backupRetention import prune_backups
+                log(prune_backups(run.profile, None, on_log=log))
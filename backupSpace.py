@@ -0,0 +1,145 @@
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+from backupEngine import DEFAULT_COPY_WORKERS, format_bytes
+
+LOW_SPACE_ACTIONS = ("refuse", "prune")
+# Every file and folder takes at least part of a block and an entry, counted
+# on top of the bytes so lots of small files are not underestimated
+ENTRY_OVERHEAD_BYTES = 4096
+
+
+class NotEnoughSpace(Exception):
+    def __init__(self, needed, free, path):
+        super().__init__("Not enough space in %s, the backup needs about %s and there is %s free" % (
+            path, format_bytes(needed), format_bytes(free)))
+        self.needed = needed
+        self.free = free
+
+
+def free_space(path):
+    '''
+    Free bytes in the volume of `path`, None when it can't be known.
+    '''
+    try:
+        return shutil.disk_usage(str(path)).free
+    except OSError:
+        return None
+
+
+def changed_bytes(tree, link_dest, workers=DEFAULT_COPY_WORKERS):
+    '''
+    Bytes of the files an incremental backup against `link_dest` can not
+    hardlink, the same size and mtime test ParallelCopier does, stat'ed on
+    a thread pool.
+    '''
+    def needed(item):
+        relative_path, size, mtime_ns = item
+        try:
+            stat = os.stat(os.path.join(link_dest, relative_path))
+        except OSError:
+            return size
+        return 0 if stat.st_size == size and stat.st_mtime_ns == mtime_ns else size
+
+    with ThreadPoolExecutor(max(1, workers), thread_name_prefix="space") as executor:
+        return sum(executor.map(needed, tree.files, chunksize=256))
+
+
+def estimate_backup_size(tree, mode, previous=None, target_name="", workers=DEFAULT_COPY_WORKERS):
+    '''
+    Upper bound of the bytes a backup of `tree` adds to the backups disk:
+    everything for full and archive backups (compression is not guessed),
+    only what can not be reused from the `previous` backup for incremental
+    and store ones.
+    '''
+    entries = tree.total_files + len(tree.dirs) + 1
+    if mode == "incremental" and previous:
+        return changed_bytes(tree, os.path.join(str(previous), target_name), workers) + entries * ENTRY_OVERHEAD_BYTES
+    if mode == "store":
+        import backupStore
+        manifest = backupStore.find_previous_manifest(previous)
+        known = manifest["files"] if manifest else {}
+        needed = 0
+        for relative_path, size, mtime_ns in tree.files:
+            entry = known.get(backupStore.manifest_key(relative_path))
+            if not entry or entry[1] != size or entry[2] != mtime_ns:
+                needed += size + ENTRY_OVERHEAD_BYTES
+        # The manifest itself, compressed it is far smaller than this
+        return needed + entries * 64
+    return tree.total_bytes + entries * ENTRY_OVERHEAD_BYTES
+
+
+def measure_backups(catalog, numbers):
+    '''
+    Space each backup in `numbers` added when it was made, for backups made
+    before that was recorded. Goes through every backup oldest first and
+    counts each inode (or store object) for the first backup that has it,
+    so hardlinked and shared data is only counted once. Returns
+    {number: bytes} for `numbers`.
+    '''
+    import backupStore
+    seen = set()
+    sizes = {}
+    for number in sorted(catalog.numbers(), key=int):
+        path = catalog.path_of(number)
+        added = 0
+        if os.path.isfile(path):
+            added = os.path.getsize(path)
+        elif os.path.isfile(os.path.join(path, backupStore.MANIFEST_NAME)):
+            manifest = backupStore.find_previous_manifest(path)
+            added = os.path.getsize(os.path.join(path, backupStore.MANIFEST_NAME))
+            for digest, size, mtime_ns, mode in manifest["files"].values():
+                if digest not in seen:
+                    seen.add(digest)
+                    added += size
+        else:
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    stat = os.lstat(os.path.join(root, name))
+                    key = (stat.st_dev, stat.st_ino) if stat.st_ino else os.path.join(root, name)
+                    if key not in seen:
+                        seen.add(key)
+                        added += stat.st_size
+        if number in numbers:
+            sizes[number] = added
+    return sizes
+
+
+class BackupUsage:
+    def __init__(self, backup_path):
+        self.backup_path = str(backup_path)
+        self.backups = []
+        self.free = free_space(backup_path)
+
+    @property
+    def total(self):
+        return sum(disk_size for number, entry, disk_size in self.backups)
+
+    def __str__(self):
+        lines = ["%d backups in %s use %s, %s free" % (
+            len(self.backups), self.backup_path, format_bytes(self.total),
+            format_bytes(self.free) if self.free is not None else "unknown")]
+        for number, entry, disk_size in self.backups:
+            size = entry.get("size")
+            lines.append("%s: %s on disk, %s backed up (%s)" % (
+                number, format_bytes(disk_size), format_bytes(size) if size is not None else "?",
+                entry.get("mode", "full")))
+        return "\n".join(lines)
+
+
+def backup_usage(catalog):
+    '''
+    The cached size of every backup, backups without one are measured once
+    and the result is saved in the catalog.
+    '''
+    numbers = catalog.numbers()
+    missing = [number for number in numbers if catalog.get(number).get("disk_size") is None]
+    if missing:
+        for number, disk_size in measure_backups(catalog, set(missing)).items():
+            catalog.update(number, disk_size=disk_size)
+    usage = BackupUsage(catalog.backup_path)
+    for number in numbers:
+        entry = catalog.get(number)
+        usage.backups.append((number, entry, entry.get("disk_size") or 0))
+    return usage
@@ -0,0 +1,204 @@
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backupEngine import BackupCancelled, META_DIR_NAME, DEFAULT_COPY_WORKERS
+
+MANIFEST_NAME = "manifest.json.gz"
+HASH_NAME = "sha256"
+HASH_BUFFER_SIZE = 1024 * 1024
+
+
+def manifest_key(relative_path):
+    # Manifests always use "/" so a store written on windows reads on linux
+    return relative_path.replace(os.sep, "/")
+
+
+class ObjectStore:
+    '''
+    Content addressed storage for file contents, every distinct content is
+    stored once under objects/<first 2 hex chars>/<rest of the hash>.
+    '''
+
+    def __init__(self, backup_path):
+        self.path = os.path.join(str(backup_path), META_DIR_NAME, "objects")
+
+    def object_path(self, digest):
+        return os.path.join(self.path, digest[:2], digest[2:])
+
+    def has(self, digest):
+        return os.path.isfile(self.object_path(digest))
+
+    def add(self, path):
+        '''
+        Stores the contents of `path`, returns (digest, stored) where stored is
+        False when the contents were already in the store. The file is read
+        once, hashed while it is copied to a temporary file that is then
+        named after its hash, or dropped when the store already had it.
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        # Unique across the processes sharing the store, and next to the
+        # object folders so collect_objects does not see it
+        fd, temporary = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=self.path)
+        try:
+            hasher = hashlib.new(HASH_NAME)
+            with open(path, "rb") as source, open(fd, "wb") as destination:
+                while True:
+                    data = source.read(HASH_BUFFER_SIZE)
+                    if not data:
+                        break
+                    hasher.update(data)
+                    destination.write(data)
+            digest = hasher.hexdigest()
+            if self.has(digest):
+                os.remove(temporary)
+                return digest, False
+            os.makedirs(os.path.dirname(self.object_path(digest)), exist_ok=True)
+            os.replace(temporary, self.object_path(digest))
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return digest, True
+
+
+def read_manifest(path):
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_manifest(path, manifest):
+    temporary = path + ".tmp"
+    with gzip.open(temporary, "wt", encoding="utf-8") as file:
+        json.dump(manifest, file, separators=(",", ":"))
+    os.replace(temporary, path)
+
+
+class StoreWriter:
+    '''
+    Writes a SourceTree into an ObjectStore and builds the manifest for it.
+    Files with the same size and mtime as in `previous` (the manifest of the
+    last backup) reuse its hash without being read at all, everything else
+    is hashed on a thread pool.
+    '''
+
+    def __init__(self, store, workers=DEFAULT_COPY_WORKERS):
+        self.store = store
+        self.workers = max(1, workers)
+        self.lock = threading.Lock()
+        self.reused_files = 0
+        self.stored_files = 0
+        self.stored_bytes = 0
+        self.deduplicated_files = 0
+        self.skipped = set()
+
+    def write(self, tree, folder_name, previous=None, progress=None, cancel_event=None):
+        previous_files = previous["files"] if previous else {}
+        files = {}
+        errors = []
+
+        def store_one(item):
+            relative_path, size, mtime_ns = item
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            key = manifest_key(relative_path)
+            known = previous_files.get(key)
+            try:
+                if known and known[1] == size and known[2] == mtime_ns and self.store.has(known[0]):
+                    entry = known
+                    with self.lock:
+                        self.reused_files += 1
+                else:
+                    path = os.path.join(tree.root, relative_path)
+                    digest, stored = self.store.add(path)
+                    entry = [digest, size, mtime_ns, os.stat(path).st_mode]
+                    with self.lock:
+                        if stored:
+                            self.stored_files += 1
+                            self.stored_bytes += size
+                        else:
+                            self.deduplicated_files += 1
+                with self.lock:
+                    files[key] = entry
+            except FileNotFoundError as why:
+                if why.filename != os.path.join(tree.root, relative_path):
+                    errors.append((why.filename, key, str(why)))
+                else:
+                    # Deleted since the scan, left out of the manifest
+                    with self.lock:
+                        self.skipped.add(relative_path)
+            except OSError as why:
+                errors.append((os.path.join(tree.root, relative_path), key, str(why)))
+            if progress:
+                progress.advance(1, size)
+
+        if self.workers == 1:
+            for item in tree.files:
+                store_one(item)
+        else:
+            with ThreadPoolExecutor(self.workers, thread_name_prefix="hash") as executor:
+                for _ in executor.map(store_one, tree.files):
+                    pass
+        if cancel_event is not None and cancel_event.is_set():
+            raise BackupCancelled()
+        if errors:
+            raise shutil.Error(errors)
+        dirs = {}
+        for relative_dir in [""] + tree.dirs:
+            stat = os.stat(os.path.join(tree.root, relative_dir))
+            dirs[manifest_key(relative_dir)] = [stat.st_mtime_ns, stat.st_mode]
+        return {
+            "version": 1,
+            "folder": folder_name,
+            "created": time.time(),
+            "hash": HASH_NAME,
+            "dirs": dirs,
+            "files": files,
+        }
+
+
+def find_previous_manifest(backup_dir):
+    if not backup_dir:
+        return None
+    path = os.path.join(str(backup_dir), MANIFEST_NAME)
+    if not os.path.isfile(path):
+        return None
+    return read_manifest(path)
+
+
+def materialize(backup_dir, target=None, workers=DEFAULT_COPY_WORKERS):
+    '''
+    Rebuilds the normal folder layout of a store backup, by default in
+    backup_dir/<folder> so it looks like any other numbered backup.
+    '''
+    backup_dir = str(backup_dir)
+    manifest = read_manifest(os.path.join(backup_dir, MANIFEST_NAME))
+    store = ObjectStore(os.path.dirname(os.path.abspath(backup_dir)))
+    target = target or os.path.join(backup_dir, manifest["folder"])
+    dirs = sorted(manifest["dirs"].items(), key=lambda item: item[0].count("/") if item[0] else -1)
+    os.makedirs(target)
+    for key, (mtime_ns, mode) in dirs:
+        if key:
+            os.mkdir(os.path.join(target, *key.split("/")))
+
+    def restore_one(item):
+        key, (digest, size, mtime_ns, mode) = item
+        destination = os.path.join(target, *key.split("/"))
+        shutil.copyfile(store.object_path(digest), destination)
+        os.chmod(destination, mode)
+        os.utime(destination, ns=(mtime_ns, mtime_ns))
+
+    with ThreadPoolExecutor(max(1, workers), thread_name_prefix="materialize") as executor:
+        for _ in executor.map(restore_one, manifest["files"].items()):
+            pass
+    for key, (mtime_ns, mode) in reversed(dirs):
+        path = os.path.join(target, *key.split("/")) if key else target
+        os.chmod(path, mode)
+        os.utime(path, ns=(mtime_ns, mtime_ns))
+    return target
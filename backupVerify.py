@@ -0,0 +1,331 @@
+import hashlib
+import json
+import mmap
+import os
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from backupEngine import (BackupCancelled, META_DIR_NAME, DEFAULT_COPY_WORKERS, ARCHIVE_EXTENSIONS,
+                          format_bytes, scan_tree)
+
+VERIFY_LEVELS = ("none", "quick", "full")
+VERIFICATION_NAME = "verification.json"
+HASH_NAME = "sha256"
+# Files this big are hashed straight from a memory map, smaller ones are
+# read in one go, neither makes intermediate copies in python
+MMAP_THRESHOLD = 4 * 1024 * 1024
+READ_BUFFER_SIZE = 4 * 1024 * 1024
+# FAT stores mtimes with 2 second precision, a backup on a usb stick made
+# from an NTFS or ext4 folder is not off by more than that
+MTIME_TOLERANCE_NS = 2 * 10 ** 9
+
+
+def hash_path(path):
+    digest = hashlib.new(HASH_NAME)
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        if size >= MMAP_THRESHOLD:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                digest.update(mapped)
+        else:
+            digest.update(file.read())
+    return digest.hexdigest()
+
+
+def hash_stream(file):
+    digest = hashlib.new(HASH_NAME)
+    buffer = bytearray(READ_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        read = file.readinto(buffer)
+        if not read:
+            return digest.hexdigest()
+        digest.update(view[:read])
+
+
+class VerificationResult:
+    def __init__(self, level):
+        self.level = level
+        self.checked_files = 0
+        self.checked_bytes = 0
+        self.problems = []
+        self.changed_in_source = []
+        self.seconds = 0.0
+        self.created = time.time()
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def to_dict(self):
+        return {
+            "version": 1,
+            "created": round(self.created, 3),
+            "level": self.level,
+            "ok": self.ok,
+            "seconds": round(self.seconds, 6),
+            "checked_files": self.checked_files,
+            "checked_bytes": self.checked_bytes,
+            "problems": [{"path": path, "problem": problem} for path, problem in sorted(self.problems)],
+            "changed_in_source": sorted(self.changed_in_source),
+        }
+
+    def __str__(self):
+        message = "%s verification of %d files (%s) in %.1fs: %s" % (
+            self.level, self.checked_files, format_bytes(self.checked_bytes), self.seconds,
+            "OK" if self.ok else "%d problems" % len(self.problems))
+        if self.changed_in_source:
+            message += ", %d files changed in the source since and could not be compared" % len(
+                self.changed_in_source)
+        return message
+
+
+class BackupVerifier:
+    '''
+    Checks a backup against the SourceTree it was made from. The "quick"
+    level compares sizes and mtimes, "full" also hashes the backup and the
+    source on a thread pool (hashlib releases the GIL, so threads hash in
+    parallel). Store backups are checked against the hashes in their
+    manifest instead, that needs no source at all.
+    '''
+
+    def __init__(self, level="quick", workers=DEFAULT_COPY_WORKERS, cancel_event=None, created=None):
+        if level not in VERIFY_LEVELS[1:]:
+            raise ValueError("Unknown verification level %s" % level)
+        self.level = level
+        self.workers = max(1, workers)
+        self.cancel_event = cancel_event
+        # When the backup was made, files modified later are not compared
+        self.created_ns = int(created * 10 ** 9) if created is not None else None
+        self.lock = threading.Lock()
+
+    def edited_since(self, mtime_ns):
+        return self.created_ns is not None and mtime_ns > self.created_ns
+
+    def cancelled(self):
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def run(self, check, items, result):
+        started = time.monotonic()
+
+        def check_one(item):
+            if self.cancelled():
+                return
+            try:
+                problem = check(item)
+            except OSError as why:
+                problem = str(why)
+            with self.lock:
+                if problem is None:
+                    return
+                if problem is False:
+                    result.changed_in_source.append(item[0])
+                else:
+                    result.problems.append((item[0], problem))
+
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="verify") as executor:
+            for _ in executor.map(check_one, items):
+                pass
+        if self.cancelled():
+            raise BackupCancelled()
+        result.checked_files += len(items) - len(result.changed_in_source)
+        result.seconds += time.monotonic() - started
+        return result
+
+    def source_unchanged(self, source, size, mtime_ns):
+        stat = os.stat(source)
+        return stat.st_size == size and stat.st_mtime_ns == mtime_ns
+
+    def verify_folder(self, tree, backup_root):
+        '''
+        `backup_root` is the copy of tree.root, backup_path/<n>/<folder>.
+        '''
+        result = VerificationResult(self.level)
+
+        def check(item):
+            # None when fine, False when the source changed since the backup
+            # and can not be compared, or the problem found
+            relative_path, size, mtime_ns = item
+            if self.edited_since(mtime_ns):
+                return False
+            source = os.path.join(tree.root, relative_path)
+            try:
+                stat = os.stat(os.path.join(backup_root, relative_path))
+            except FileNotFoundError:
+                # Deleted while backing up, the backup skips those
+                return "missing" if os.path.exists(source) else False
+            if stat.st_size != size:
+                return "size is %d instead of %d" % (stat.st_size, size)
+            if abs(stat.st_mtime_ns - mtime_ns) > MTIME_TOLERANCE_NS:
+                return "modification time differs"
+            if self.level == "full":
+                backup_hash = hash_path(os.path.join(backup_root, relative_path))
+                if backup_hash != hash_path(source):
+                    if not self.source_unchanged(source, size, mtime_ns):
+                        return False
+                    return "contents differ"
+            return None
+
+        result.checked_bytes = tree.total_bytes
+        return self.run(check, tree.files, result)
+
+    def verify_store(self, manifest, store):
+        result = VerificationResult(self.level)
+
+        def check(item):
+            key, (digest, size, mtime_ns, mode) = item
+            path = store.object_path(digest)
+            try:
+                stored_size = os.path.getsize(path)
+            except FileNotFoundError:
+                return "object %s is missing" % digest
+            if stored_size != size:
+                return "object %s is %d bytes instead of %d" % (digest, stored_size, size)
+            if self.level == "full" and hash_path(path) != digest:
+                return "object %s is corrupt" % digest
+            return None
+
+        items = list(manifest["files"].items())
+        result.checked_bytes = sum(entry[1] for key, entry in items)
+        return self.run(check, items, result)
+
+    def verify_archive(self, tree, archive_path, folder_name):
+        '''
+        Compares the members of a zip or tar.zst archive with the source. The
+        archive is read on a single thread, the source is hashed on the pool
+        meanwhile.
+        '''
+        import backupArchive
+        started = time.monotonic()
+        result = VerificationResult(self.level)
+        expected = {}
+        for relative_path, size, mtime_ns in tree.files:
+            if self.edited_since(mtime_ns):
+                result.changed_in_source.append(relative_path)
+            else:
+                expected[backupArchive.archive_name(relative_path, folder_name)] = (relative_path, size, mtime_ns)
+        found = {}
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="verify") as executor:
+            source_hashes = {}
+            if self.level == "full":
+                source_hashes = {name: executor.submit(hash_path, os.path.join(tree.root, relative_path))
+                                 for name, (relative_path, size, mtime_ns) in expected.items()}
+            for name, size, open_member in self.archive_members(archive_path):
+                if self.cancelled():
+                    raise BackupCancelled()
+                if name not in expected:
+                    continue
+                found[name] = size
+                if name in source_hashes:
+                    with open_member() as member:
+                        found[name] = (size, hash_stream(member))
+        for name, (relative_path, size, mtime_ns) in expected.items():
+            if name not in found:
+                if os.path.exists(os.path.join(tree.root, relative_path)):
+                    result.problems.append((relative_path, "missing"))
+                else:
+                    result.changed_in_source.append(relative_path)
+                continue
+            member_size, member_hash = found[name] if name in source_hashes else (found[name], None)
+            if member_size != size:
+                result.problems.append((relative_path, "size is %d instead of %d" % (member_size, size)))
+                continue
+            if member_hash is None:
+                continue
+            try:
+                source_hash = source_hashes[name].result()
+            except OSError:
+                # Deleted or unreadable since the backup, nothing to compare
+                result.changed_in_source.append(relative_path)
+                continue
+            if member_hash != source_hash:
+                if self.source_unchanged(os.path.join(tree.root, relative_path), size, mtime_ns):
+                    result.problems.append((relative_path, "contents differ"))
+                else:
+                    result.changed_in_source.append(relative_path)
+        result.checked_files = len(tree.files) - len(result.changed_in_source)
+        result.checked_bytes = tree.total_bytes
+        result.seconds = time.monotonic() - started
+        return result
+
+    def archive_members(self, archive_path):
+        '''
+        Yields (name, size, open function) for every file in the archive.
+        '''
+        if archive_path.endswith(ARCHIVE_EXTENSIONS["zip"]):
+            with zipfile.ZipFile(archive_path) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        yield info.filename, info.file_size, lambda info=info: archive.open(info)
+            return
+        import backupArchive
+        if backupArchive.zstandard is None:
+            raise RuntimeError("The zstandard package is needed to read %s" % archive_path)
+        with open(archive_path, "rb") as raw:
+            stream = backupArchive.zstandard.ZstdDecompressor().stream_reader(raw)
+            with tarfile.open(fileobj=stream, mode="r|") as archive:
+                for info in archive:
+                    if info.isfile():
+                        yield info.name, info.size, lambda info=info: archive.extractfile(info)
+
+
+def verification_path(entry_path):
+    '''
+    Where the verification record of the backup at `entry_path` goes: inside
+    numbered folders, and in META_DIR_NAME/verification for archives so the
+    backups directory itself is not touched.
+    '''
+    entry_path = str(entry_path)
+    if os.path.isdir(entry_path):
+        return os.path.join(entry_path, VERIFICATION_NAME)
+    backup_path, name = os.path.split(entry_path)
+    return os.path.join(backup_path, META_DIR_NAME, "verification", name + ".json")
+
+
+def write_verification(entry_path, result):
+    path = verification_path(entry_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + ".tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        json.dump(result.to_dict(), file, indent=1)
+    os.replace(temporary, path)
+    return path
+
+
+def read_verification(entry_path):
+    try:
+        with open(verification_path(entry_path), encoding="utf-8") as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def verify_backup(source, entry_path, mode, level="quick", workers=DEFAULT_COPY_WORKERS,
+                  tree=None, cancel_event=None, rules=None, created=None):
+    '''
+    Verifies the backup at `entry_path` (the numbered folder or the archive)
+    of the folder `source`, writes the record next to it and returns the
+    VerificationResult. `tree` is the scan the backup was made from, when not
+    given the source is scanned now leaving out what `rules` exclude, and
+    files modified after `created` (the time the backup was made) count as
+    changed in the source instead of being compared.
+    '''
+    source = str(source)
+    entry_path = str(entry_path)
+    folder_name = os.path.basename(source)
+    verifier = BackupVerifier(level, workers, cancel_event, created if tree is None else None)
+    if mode == "store":
+        import backupStore
+        manifest = backupStore.read_manifest(os.path.join(entry_path, backupStore.MANIFEST_NAME))
+        result = verifier.verify_store(manifest, backupStore.ObjectStore(os.path.dirname(entry_path)))
+    else:
+        tree = tree or scan_tree(source, cancel_event, workers, rules)
+        if mode == "archive":
+            result = verifier.verify_archive(tree, entry_path, folder_name)
+        else:
+            result = verifier.verify_folder(tree, os.path.join(entry_path, folder_name))
+    write_verification(entry_path, result)
+    return result
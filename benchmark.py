@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the parts of the app that do not need a display, run it with
+python benchmark.py, or python benchmark.py --help for the options.
+
+Every result is a flat "group/case" key with a few numbers, --json writes
+them together with the commit they were measured on so two runs can be
+compared with --compare.
+'''
+
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from appSettings import Settings
+
+COUNTED_SYSCALLS = (
+    "stat", "lstat", "access", "listdir", "scandir", "mkdir", "open", "getcwd",
+    "read", "readv", "write", "copy_file_range", "sendfile", "link", "unlink",
+    "rename", "replace", "utime", "chmod",
+)
+TREE_KINDS = ("tiny", "large", "deep", "mixed")
+BACKUP_CASES = ("full", "incremental", "store", "zip", "tar.zst")
+CATALOG_SIZES = (10, 1000, 10000)
+# Filter rules of the scan benchmark, what a game folder usually has to leave out
+SCAN_EXCLUDE = ("ShaderCache/", "cache/", "*.log", "*.tmp")
+# Metrics --compare shows, and whether a bigger number is better
+COMPARED_METRICS = {
+    "seconds": False,
+    "files_per_second": True,
+    "bytes_per_second": True,
+    "syscalls": False,
+    "peak_memory": False,
+    "us_per_call": False,
+}
+WRITE_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class SyscallCounter:
+    '''
+    Counts the calls made through the os module while active, os.path helpers
+    like exists and isdir end up in os.stat so they are counted too. Calls
+    made from C (builtin open, scandir entry stats) are not seen.
+    '''
+
+    def __init__(self, names=COUNTED_SYSCALLS):
+        self.names = [name for name in names if hasattr(os, name)]
+        self.counts = Counter()
+        self.originals = {}
+        self.lock = threading.Lock()
+
+    def wrap(self, name, function):
+        def counted(*args, **kwargs):
+            with self.lock:
+                self.counts[name] += 1
+            return function(*args, **kwargs)
+        return counted
+
+    def __enter__(self):
+        for name in self.names:
+            self.originals[name] = getattr(os, name)
+            setattr(os, name, self.wrap(name, self.originals[name]))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, function in self.originals.items():
+            setattr(os, name, function)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+
+def peak_memory():
+    '''
+    Peak resident memory of this process in bytes, None where unknown.
+    '''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports KB, macos bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_isolated(function, *args):
+    '''
+    Runs `function` in a fresh process so its peak memory is its own.
+    '''
+    with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def write_random_file(path, size, rng):
+    with open(path, "wb") as file:
+        while size > 0:
+            chunk = rng.randbytes(min(size, WRITE_CHUNK_SIZE))
+            file.write(chunk)
+            size -= len(chunk)
+
+
+def write_text_file(path, size, rng):
+    words = ("level", "player", "inventory", "health", "position", "true", "false", "null")
+    parts = []
+    written = 0
+    while written < size:
+        word = '"%s":%d,' % (rng.choice(words), rng.randrange(100000))
+        parts.append(word)
+        written += len(word)
+    with open(path, "w") as file:
+        file.write("".join(parts)[:size])
+
+
+def build_tree(root, kind, scale=1.0, seed=0):
+    '''
+    Creates a synthetic source tree in `root`:
+      tiny   100k files of up to 1 KB, 100 per folder
+      large  3 files of 2 GB
+      deep   3 chains of 100 nested folders with 5 small files on each level
+      mixed  something like a game save folder, mostly small text files, some
+             binary ones up to 20 MB and a few duplicates
+    `scale` multiplies the number of files, or the sizes for large.
+    '''
+    rng = random.Random(seed)
+    os.makedirs(root)
+    if kind == "tiny":
+        count = max(1, int(100000 * scale))
+        for index in range(count):
+            directory = os.path.join(root, "%03d" % (index // 10000), "%03d" % (index // 100 % 100))
+            if index % 100 == 0:
+                os.makedirs(directory, exist_ok=True)
+            write_random_file(os.path.join(directory, "%d.dat" % index), rng.randrange(1025), rng)
+    elif kind == "large":
+        for index in range(3):
+            write_random_file(os.path.join(root, "large%d.bin" % index), max(1, int(2 * 1024 ** 3 * scale)), rng)
+    elif kind == "deep":
+        for chain in range(3):
+            directory = os.path.join(root, "chain%d" % chain)
+            os.mkdir(directory)
+            for level in range(max(1, int(100 * min(scale, 1.0)))):
+                directory = os.path.join(directory, "level%d" % level)
+                os.mkdir(directory)
+                for index in range(5):
+                    write_random_file(os.path.join(directory, "file%d" % index), rng.randrange(4096), rng)
+    elif kind == "mixed":
+        count = max(10, int(5000 * scale))
+        folders = [os.path.join(root, name) for name in ("profiles", "slots", "screenshots", "cache", "mods")]
+        for folder in folders:
+            os.makedirs(os.path.join(folder, "old"))
+        previous = None
+        for index in range(count):
+            directory = os.path.join(rng.choice(folders), "old" if rng.random() < 0.2 else "")
+            path = os.path.join(directory, "file%d" % index)
+            roll = rng.random()
+            if roll < 0.6:
+                write_text_file(path + ".json", rng.randrange(64, 16384), rng)
+            elif roll < 0.9:
+                write_random_file(path + ".sav", rng.randrange(65536, 1024 * 1024), rng)
+            elif roll < 0.98:
+                write_random_file(path + ".png", rng.randrange(1024 * 1024, 20 * 1024 * 1024), rng)
+            elif previous:
+                shutil.copyfile(previous, path + ".bak")
+            if roll < 0.9:
+                previous = path + (".json" if roll < 0.6 else ".sav")
+    else:
+        raise ValueError("Unknown tree kind %s" % kind)
+
+
+def backup_case(source, backups, case, number, previous, workers):
+    '''
+    One backup of `source` into `backups`/`number`, runs in its own process.
+    '''
+    from backupEngine import BackupJob, ARCHIVE_EXTENSIONS
+    archive_format = case if case in ARCHIVE_EXTENSIONS else "zip"
+    mode = "archive" if case in ARCHIVE_EXTENSIONS else case
+    target = os.path.join(backups, str(number))
+    # The job creates the numbered folder itself
+    if mode == "archive":
+        target += ARCHIVE_EXTENSIONS[archive_format]
+    job = BackupJob(source, target, os.path.basename(source), mode=mode, previous=previous,
+                    archive_format=archive_format, workers=workers, progress_interval=3600)
+    with SyscallCounter() as counter:
+        started = time.perf_counter()
+        job.start()
+        job.join()
+        elapsed = time.perf_counter() - started
+    if job.status != "done":
+        raise RuntimeError("%s backup failed: %s" % (case, job.error))
+    return {
+        "seconds": elapsed,
+        "files": job.result.files_total,
+        "bytes": job.result.bytes_total,
+        "files_per_second": job.result.files_total / elapsed,
+        "bytes_per_second": job.result.bytes_total / elapsed,
+        "syscalls": counter.total,
+        "syscalls_by_name": dict(counter.counts),
+        "peak_memory": peak_memory(),
+    }
+
+
+def available_backup_cases():
+    from backupArchive import available_formats
+    return [case for case in BACKUP_CASES if case not in ("zip", "tar.zst") or case in available_formats()]
+
+
+def bench_backups(work_dir, scale=1.0, kinds=TREE_KINDS, cases=None, workers=None):
+    '''
+    Backs up every tree kind with every backup mode twice, "first" into an
+    empty backups directory and "repeat" right after with nothing changed,
+    which is what incremental and store modes are made for. Caches are warm,
+    the trees were just written.
+    '''
+    from backupEngine import DEFAULT_COPY_WORKERS
+    results = {}
+    cases = cases or available_backup_cases()
+    for kind in kinds:
+        source = os.path.join(work_dir, "source-%s" % kind, "save")
+        started = time.perf_counter()
+        build_tree(source, kind, scale)
+        print("built %s tree in %.1fs" % (kind, time.perf_counter() - started))
+        for case in cases:
+            backups = os.path.join(work_dir, "backups")
+            os.makedirs(backups)
+            previous = None
+            for number, run in enumerate(("first", "repeat")):
+                result = run_isolated(backup_case, source, backups, case, number, previous,
+                                      workers or DEFAULT_COPY_WORKERS)
+                previous = os.path.join(backups, str(number))
+                key = "backup/%s/%s/%s" % (kind, case, run)
+                results[key] = result
+                print("%s: %.2fs, %.0f files/s, %.1f MB/s, %d syscalls, peak %s MB" % (
+                    key, result["seconds"], result["files_per_second"],
+                    result["bytes_per_second"] / 1024 ** 2, result["syscalls"],
+                    "%.0f" % (result["peak_memory"] / 1024 ** 2) if result["peak_memory"] else "?"))
+            shutil.rmtree(backups)
+        shutil.rmtree(os.path.dirname(source))
+    return results
+
+
+def build_cluttered_tree(root, scale=1.0, seed=0):
+    '''
+    A save folder buried in clutter: 100 game folders with a few saves each
+    next to a shader cache and a cache folder holding most of the files,
+    and some logs and temporary files everywhere. Files are empty, only the
+    walk is measured.
+    '''
+    rng = random.Random(seed)
+    games = max(1, int(100 * scale))
+    for game in range(games):
+        game_dir = os.path.join(root, "game%d" % game)
+        for folder, count in (("saves", 20), ("ShaderCache", 400), (os.path.join("cache", "textures"), 400)):
+            directory = os.path.join(game_dir, folder)
+            os.makedirs(directory)
+            for index in range(count):
+                extension = rng.choice((".dat", ".dat", ".log", ".tmp"))
+                open(os.path.join(directory, "%d%s" % (index, extension)), "wb").close()
+
+
+def bench_scan(work_dir, scale=1.0, workers=None, runs=3):
+    '''
+    Scanning a big cluttered tree with and without SCAN_EXCLUDE, excluded
+    folders are not walked so the filtered scan should take a fraction of
+    the time.
+    '''
+    from backupEngine import DEFAULT_COPY_WORKERS, scan_tree
+    from backupFilter import FilterRules
+    root = os.path.join(work_dir, "source-cluttered")
+    started = time.perf_counter()
+    build_cluttered_tree(root, scale)
+    print("built cluttered tree in %.1fs" % (time.perf_counter() - started))
+    rules = FilterRules(SCAN_EXCLUDE)
+    results = {}
+    for name, case_rules in (("unfiltered", None), ("filtered", rules)):
+        for case_workers in (1, workers or DEFAULT_COPY_WORKERS):
+            seconds = []
+            for _ in range(runs):
+                started = time.perf_counter()
+                tree = scan_tree(root, workers=case_workers, rules=case_rules)
+                seconds.append(time.perf_counter() - started)
+            elapsed = statistics.median(seconds)
+            key = "scan/%s/%d-workers" % (name, case_workers)
+            results[key] = {
+                "seconds": elapsed,
+                "files": tree.total_files,
+                "files_per_second": tree.total_files / elapsed if elapsed > 0 else None,
+                "excluded_files": tree.excluded_files,
+                "excluded_dirs": tree.excluded_dirs,
+            }
+            print("%s: %.3fs, %d files kept, %d files and %d folders left out" % (
+                key, elapsed, tree.total_files, tree.excluded_files, tree.excluded_dirs))
+    shutil.rmtree(root)
+    return results
+
+
+def simulate_backup_click(settings):
+    '''
+    Everything MainWindow.createBackup does with the settings before the
+    copy starts.
+    '''
+    settings.invalidate_paths()
+    if not settings.paths_configured_correctly:
+        raise RuntimeError("Paths not configured correctly")
+    settings.catalog.latest
+    settings.catalog.next_number
+    os.path.basename(settings.save_path)
+    str(settings.backup_path)
+
+
+def timed_calls(function, calls):
+    with SyscallCounter() as counter:
+        function()
+    started = time.perf_counter()
+    for _ in range(calls):
+        function()
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds": elapsed,
+        "us_per_call": elapsed / calls * 1e6,
+        "syscalls": counter.total,
+        "syscalls_by_name": dict(counter.counts),
+    }
+
+
+def bench_catalog(work_dir, sizes=CATALOG_SIZES, calls=1000):
+    '''
+    Backups directories holding 10, 1k and 10k numbered backups: building the
+    catalog from scratch, and then what a backup click and listing cost.
+    '''
+    from backupCatalog import BackupCatalog
+    results = {}
+    for size in sizes:
+        root = os.path.join(work_dir, "catalog-%d" % size)
+        save_path = os.path.join(root, "save")
+        backup_path = os.path.join(root, "backups")
+        os.makedirs(save_path)
+        for number in range(size):
+            os.makedirs(os.path.join(backup_path, str(number), "save"))
+        settings = Settings(os.path.join(root, "settings.ini"))
+        with settings.transaction():
+            settings.PATHS.save_directory_path = save_path
+            settings.PATHS.backups_directory_path = backup_path
+
+        def rebuild():
+            catalog = BackupCatalog(backup_path)
+            if os.path.exists(catalog.path):
+                os.remove(catalog.path)
+            catalog.load()
+
+        def check_paths():
+            settings.invalidate_paths()
+            settings.paths_configured_correctly
+
+        for name, function, count in (
+                ("rebuild", rebuild, max(1, calls // 100)),
+                ("click", lambda: simulate_backup_click(settings), calls),
+                ("list", settings.catalog.numbers, calls),
+                ("paths_configured_correctly", check_paths, calls)):
+            key = "catalog/%d/%s" % (size, name)
+            results[key] = timed_calls(function, count)
+            print("%s: %d syscalls, %.1f us per call" % (key, results[key]["syscalls"], results[key]["us_per_call"]))
+        shutil.rmtree(root)
+    return results
+
+
+def bench_cli_startup(work_dir, runs=10):
+    '''
+    Wall time of whole cli.py processes, what a hook calling it pays.
+    '''
+    results = {}
+    cli = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cli.py")
+    root = os.path.join(work_dir, "startup")
+    save_path = os.path.join(root, "save")
+    os.makedirs(save_path)
+    config = os.path.join(root, "settings.ini")
+    settings = Settings(config)
+    with settings.transaction():
+        settings.PATHS.save_directory_path = save_path
+        settings.PATHS.backups_directory_path = os.path.join(root, "backups")
+    os.makedirs(settings.backup_path)
+    for arguments in (["--help"], ["--config", config, "list"]):
+        timings = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, cli] + arguments, stdout=subprocess.DEVNULL, check=True)
+            timings.append(time.perf_counter() - started)
+        key = "startup/%s" % arguments[-1].lstrip("-")
+        results[key] = {"seconds": statistics.median(timings), "best_seconds": min(timings)}
+        print("%s: median %.1f ms, best %.1f ms" % (key, statistics.median(timings) * 1e3, min(timings) * 1e3))
+    modules = subprocess.run(
+        [sys.executable, "-c", "import sys, cli; cli.main(sys.argv[1:]); print('wx' in sys.modules)",
+         "--config", config, "list"],
+        capture_output=True, text=True, check=True, cwd=os.path.dirname(cli))
+    imports_wx = modules.stdout.strip().splitlines()[-1] == "True"
+    results["startup/imports_wx"] = {"value": imports_wx}
+    print("cli imports wx: %s" % imports_wx)
+    shutil.rmtree(root)
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(baseline, results, scale):
+    print("\ncompared with %s (%s):" % (baseline["meta"].get("commit"), baseline["meta"].get("created")))
+    if baseline["meta"].get("scale") != scale:
+        print("warning: that run used --scale %s, backup results are not comparable" % baseline["meta"].get("scale"))
+    for key, result in results.items():
+        old = baseline["results"].get(key)
+        if not old:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if not old.get(metric) or result.get(metric) is None:
+                continue
+            change = result[metric] / old[metric] - 1
+            better = change > 0 if higher_is_better else change < 0
+            print("%s %s: %.4g -> %.4g (%+.1f%%%s)" % (
+                key, metric, old[metric], result[metric], change * 100,
+                "" if abs(change) < 0.05 else ", better" if better else ", worse"))
+
+
+BENCHMARKS = {
+    "backup": bench_backups,
+    "catalog": bench_catalog,
+    "startup": bench_cli_startup,
+    "scan": bench_scan,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmarks", nargs="*", metavar="benchmark",
+                        help="any of %s, all of them by default" % ", ".join(BENCHMARKS))
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiplies the file counts and sizes of the synthetic trees, "
+                             "0.01 makes a quick run (default 1)")
+    parser.add_argument("--trees", default=",".join(TREE_KINDS),
+                        help="comma separated tree kinds to back up (default %(default)s)")
+    parser.add_argument("--modes", help="comma separated backup modes, any of %s (default all available)"
+                        % ", ".join(BACKUP_CASES))
+    parser.add_argument("--workers", type=int, help="copy workers, the app default when not given")
+    parser.add_argument("--work-dir", help="where to build the trees, the disk being measured, "
+                                           "a temporary folder by default")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results file of an earlier run to compare with")
+    arguments = parser.parse_args()
+    for name in arguments.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %s" % name)
+    kinds = [kind for kind in arguments.trees.split(",") if kind]
+    for kind in kinds:
+        if kind not in TREE_KINDS:
+            parser.error("unknown tree kind %s" % kind)
+    cases = [case for case in (arguments.modes or "").split(",") if case] or None
+    for case in cases or ():
+        if case not in BACKUP_CASES:
+            parser.error("unknown backup mode %s" % case)
+
+    results = {}
+    with tempfile.TemporaryDirectory(dir=arguments.work_dir) as work_dir:
+        for name in arguments.benchmarks or BENCHMARKS:
+            if name == "backup":
+                results.update(bench_backups(work_dir, arguments.scale, kinds, cases, arguments.workers))
+            elif name == "scan":
+                results.update(bench_scan(work_dir, arguments.scale, arguments.workers))
+            else:
+                results.update(BENCHMARKS[name](work_dir))
+    output = {
+        "meta": {
+            "commit": current_commit(),
+            "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "scale": arguments.scale,
+        },
+        "results": results,
+    }
+    if arguments.json:
+        with open(arguments.json, "w") as file:
+            json.dump(output, file, indent=1, sort_keys=True)
+    if arguments.compare:
+        with open(arguments.compare) as file:
+            compare(json.load(file), results, arguments.scale)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+'''
+Command line interface of Folder Backup Creator, uses the same settings file
+and backups as the window but never imports wx, so it can run from cron,
+hooks or a server.
+'''
+
+import argparse
+import sys
+import time
+
+# Everything else is imported by the commands that need it, this runs many
+# times a minute from hooks so startup time matters
+
+
+def log(message, log_type="INFO"):
+    stream = sys.stderr if log_type != "INFO" else sys.stdout
+    print("[%s](%s): %s" % (log_type, time.strftime("%Y-%m-%d %H:%M:%S"), message), file=stream, flush=True)
+
+
+def load_settings(arguments):
+    '''
+    The Settings, or the profile chosen with --profile, both work the same
+    for every command.
+    '''
+    from appSettings import Settings, CONFIG_FILE_NAME
+    settings = Settings(arguments.config or CONFIG_FILE_NAME)
+    if not arguments.profile:
+        return settings
+    profile = settings.profile(arguments.profile)
+    if profile is None:
+        log("There is no profile called %s" % arguments.profile, "ERROR")
+        sys.exit(1)
+    return profile
+
+
+def check_paths(settings):
+    path_correct, warn_message = settings.init_paths()
+    if not path_correct:
+        log(warn_message, "ERROR")
+    return path_correct
+
+
+def run_prune(settings, keep_last=None):
+    from backupRetention import prune_backups
+    log(prune_backups(settings, keep_last, on_log=log))
+
+
+def run_backup(settings, quiet=False, force=False):
+    from backupManager import BackupError, create_backup_job
+    settings.invalidate_paths()
+    if not check_paths(settings):
+        return False
+    try:
+        job = create_backup_job(settings, on_log=log, force=force,
+                                on_progress=None if quiet else lambda progress: log(progress))
+    except BackupError as excp:
+        log(excp, "ERROR")
+        return False
+    job.progress_interval = 5.0
+    job.start()
+    try:
+        job.join()
+    except KeyboardInterrupt:
+        job.interrupt()
+        job.join()
+    if job.status == "skipped":
+        return True
+    if job.status != "done":
+        return False
+    log(job.result)
+    log("Files copied successfully in to %s" % job.output)
+    if settings.retention_policy != "none":
+        run_prune(settings)
+    return True
+
+
+def run_all_profiles(settings, quiet=False, force=False):
+    from backupScheduler import BackupScheduler
+    profiles = settings.profiles()
+    if not profiles:
+        log("There are no profiles configured", "ERROR")
+        return False
+    scheduler = BackupScheduler(profiles, on_log=log, force=force, jobs_per_device=settings.jobs_per_device,
+                                on_progress=None if quiet else lambda progress: log(progress),
+                                progress_interval=5.0)
+    scheduler.start()
+    try:
+        scheduler.join()
+    except KeyboardInterrupt:
+        scheduler.interrupt()
+        scheduler.join()
+    return scheduler.ok
+
+
+def command_backup(arguments):
+    settings = load_settings(arguments)
+    if arguments.all:
+        return 0 if run_all_profiles(settings, arguments.quiet, arguments.force) else 1
+    return 0 if run_backup(settings, arguments.quiet, arguments.force) else 1
+
+
+def command_profiles(arguments):
+    for profile in load_settings(arguments).profiles():
+        print("%s\t%s\t%s" % (profile.name, profile.save_path, profile.backup_path))
+    return 0
+
+
+def command_list(arguments):
+    settings = load_settings(arguments)
+    if not check_paths(settings):
+        return 1
+    catalog = settings.catalog
+    for number in catalog.numbers():
+        entry = catalog.get(number)
+        size = entry.get("size")
+        disk_size = entry.get("disk_size")
+        print("%s\t%s\t%s\t%s\t%s" % (
+            number,
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["created"])),
+            size if size is not None else "-",
+            entry.get("mode", "full"),
+            disk_size if disk_size is not None else "-"))
+    return 0
+
+
+def command_usage(arguments):
+    from backupSpace import backup_usage
+    settings = load_settings(arguments)
+    if not check_paths(settings):
+        return 1
+    print(backup_usage(settings.catalog))
+    return 0
+
+
+def command_last(arguments):
+    from backupManager import last_backup_path
+    settings = load_settings(arguments)
+    if not check_paths(settings):
+        return 1
+    path = last_backup_path(settings)
+    if not path:
+        log("There are no backups yet", "ERROR")
+        return 1
+    print(path)
+    return 0
+
+
+def command_prune(arguments):
+    settings = load_settings(arguments)
+    if arguments.keep is None and settings.retention_policy == "none":
+        log("No retention policy configured, set one in the RETENTION section or use --keep", "ERROR")
+        return 1
+    run_prune(settings, arguments.keep)
+    return 0
+
+
+def command_restore(arguments):
+    from backupRestore import RestoreError, restore_backup
+    settings = load_settings(arguments)
+    if not check_paths(settings):
+        return 1
+    try:
+        result = restore_backup(settings, arguments.number, compare="hash" if arguments.hash else "mtime",
+                                remove_extras=arguments.delete, safety_backup=not arguments.no_safety_backup,
+                                on_log=log)
+    except RestoreError as excp:
+        log(excp, "ERROR")
+        return 1
+    log(result)
+    return 0
+
+
+def command_verify(arguments):
+    from backupVerify import verify_backup, verification_path
+    settings = load_settings(arguments)
+    if not check_paths(settings):
+        return 1
+    catalog = settings.catalog
+    number = arguments.number or catalog.latest
+    entry = catalog.get(number) if number is not None else None
+    if entry is None or not entry.get("complete", True):
+        log("Backup %s does not exist" % number, "ERROR")
+        return 1
+    path = catalog.path_of(number)
+    log("Verifying backup %s (%s)" % (number, arguments.level))
+    result = verify_backup(settings.save_path, path, entry.get("mode", "full"), arguments.level,
+                           settings.copy_workers, rules=settings.filter_rules, created=entry.get("created"))
+    log(result, "INFO" if result.ok else "ERROR")
+    for problem_path, problem in sorted(result.problems):
+        log("%s: %s" % (problem_path, problem), "ERROR")
+    log("Verification record written to %s" % verification_path(path))
+    return 0 if result.ok else 1
+
+
+def command_history(arguments):
+    import json
+    from backupMetrics import read_history
+    for record in read_history(load_settings(arguments).backup_path, arguments.limit):
+        if arguments.json:
+            print(json.dumps(record, sort_keys=True))
+            continue
+        print("%s\t%s\t%s\t%s\t%.1fs\t%d files\t%d errors" % (
+            record.get("number"),
+            time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record["started"])),
+            record.get("status"), record.get("mode"), record["seconds"], record["files"], record["errors"]))
+    return 0
+
+
+def command_watch(arguments):
+    from watcher import create_watcher, wait_until_quiet
+    settings = load_settings(arguments)
+    if not check_paths(settings):
+        return 1
+    watcher = create_watcher(settings.save_path, arguments.poll_interval, settings.filter_rules)
+    log("Watching %s with %s, backing up %.0f seconds after the last change" % (
+        settings.save_path, type(watcher).__name__, arguments.debounce))
+    try:
+        while True:
+            wait_until_quiet(watcher, arguments.debounce)
+            run_backup(settings, quiet=True)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        watcher.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--config", help="settings file, folder_backup_creator.ini in the current folder by default")
+    parser.add_argument("--profile", help="use the folders of this profile instead of the PATHS section")
+    commands = parser.add_subparsers(dest="command", required=True)
+    backup = commands.add_parser("backup", help="create a new backup and wait for it")
+    backup.add_argument("--quiet", action="store_true", help="do not print progress")
+    backup.add_argument("--force", action="store_true",
+                        help="make a new backup even when nothing changed since the last one")
+    backup.add_argument("--all", action="store_true", help="back up every profile, at the same time when on separate disks")
+    backup.set_defaults(function=command_backup)
+    commands.add_parser("profiles", help="list the profiles and their folders").set_defaults(function=command_profiles)
+    commands.add_parser("list", help="list the backups, newest first").set_defaults(function=command_list)
+    commands.add_parser("last", help="print the path of the last backup").set_defaults(function=command_last)
+    commands.add_parser("usage", help="show the space each backup uses").set_defaults(function=command_usage)
+    prune = commands.add_parser("prune", help="delete old backups following the retention policy")
+    prune.add_argument("--keep", type=int, help="keep only this many of the newest backups instead")
+    prune.set_defaults(function=command_prune)
+    restore = commands.add_parser("restore", help="put the files of a backup back in the original folder")
+    restore.add_argument("number", help="backup number")
+    restore.add_argument("--hash", action="store_true",
+                         help="also compare contents, not only sizes and dates, to find what changed")
+    restore.add_argument("--delete", action="store_true", help="delete files that are not in the backup")
+    restore.add_argument("--no-safety-backup", action="store_true",
+                         help="do not back up the current state first")
+    restore.set_defaults(function=command_restore)
+    verify = commands.add_parser("verify", help="check a backup against the original folder")
+    verify.add_argument("number", nargs="?", help="backup number, the latest by default")
+    verify.add_argument("--level", choices=("quick", "full"), default="full",
+                        help="quick compares sizes and dates, full also compares contents (default)")
+    verify.set_defaults(function=command_verify)
+    history = commands.add_parser("history", help="show how the last backups went")
+    history.add_argument("--limit", type=int, default=20, help="how many runs to show, 0 for all (default 20)")
+    history.add_argument("--json", action="store_true", help="print the raw JSON records")
+    history.set_defaults(function=command_history)
+    watch = commands.add_parser("watch", help="back up every time the folder stops changing")
+    watch.add_argument("--debounce", type=float, default=10.0,
+                       help="seconds without changes before backing up (default 10)")
+    watch.add_argument("--poll-interval", type=float, default=5.0,
+                       help="seconds between scans when inotify is not available (default 5)")
+    watch.set_defaults(function=command_watch)
+    return parser
+
+
+def main(argv=None):
+    arguments = build_parser().parse_args(argv)
+    return arguments.function(arguments)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,16 @@
 from config_file import ConfigFile, ParsingError
 from collections import OrderedDict
+import configparser
+from contextlib import contextmanager
 from typing import Callable
 
 import os
+import threading
+import time
+
+# How often, in seconds, the configuration file is checked for changes made
+# by somebody else (an editor, another instance of the app)
+RELOAD_CHECK_INTERVAL = 1.0
 
 
 
@@ -24,8 +32,33 @@ class Field:
         if instance:
             instance.set_var(self.key, value)
 
+    def to_python(self, value):
+        return value
+
+    def to_config(self, value):
+        return value
+
 class StringField(Field):
     pass
+
+class IntField(Field):
+    def to_python(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return int(self.default)
+
+    def to_config(self, value):
+        return str(int(value))
+
+class BoolField(Field):
+    def to_python(self, value):
+        if isinstance(value, bool):
+            return value
+        return str(value).strip().lower() in ("1", "true", "yes", "on")
+
+    def to_config(self, value):
+        return "true" if self.to_python(value) else "false"
 class DeclarativeValuesMetaclass(type):
     """
     Collect Value objects declared on the base classes
@@ -67,17 +100,18 @@ class SettingsSection(metaclass=DeclarativeValuesMetaclass):
         self.section_name = section_name
         self.configuration_file = configuration_file
         self.config: ConfigFile = None
+        self.controller: "SettingsController" = None
 
     def get_var(self, key):
-        value = self.config.get("%s.%s" % (self.section_name, key), default=False)
-        if not value and self._declared_values[key].default:
-            self.set_var(key, self._declared_values[key].default)
-            value = self.config.get("%s.%s" % (self.section_name, key), default=False)
-        return value
+        field = self._declared_values[key]
+        value = self.controller.get_value(self.section_name, key)
+        if not value and field.default:
+            return field.to_python(field.default)
+        return field.to_python(value) if value else value
 
     def set_var(self, key, value):
-        self.config.set("%s.%s" % (self.section_name, key), value)
-        self.config.save()
+        field = self._declared_values[key]
+        self.controller.set_value(self.section_name, key, field.to_config(value))
 
 
 class DeclarativeValuesMetaclassSections(type):
@@ -117,21 +151,137 @@ class DeclarativeValuesMetaclassSections(type):
         return OrderedDict()
 
 class SettingsController(metaclass=DeclarativeValuesMetaclassSections):
+    '''
+    Keeps every declared field in memory, reads only go to the file again
+    when its mtime changed and writes are saved right away unless they are
+    made inside `with controller.transaction():`, then they are saved once
+    when the outermost transaction ends.
+    Besides the declared sections, sections only known at runtime (one per
+    profile, say) can be registered with add_section.
+    '''
     def __init__(self,configuration_file):
         self.configuration_file = configuration_file
+        self.lock = threading.RLock()
+        self.cache = {}
+        self.sections = OrderedDict()
+        self.file_sections = []
+        self.file_mtime_ns = None
+        self.last_reload_check = 0.0
+        self.transaction_depth = 0
+        self.dirty = False
         if not os.path.isfile(configuration_file):
             newfile = open(configuration_file, 'a+')
             newfile.write("")
             newfile.close()
-        self.config = ConfigFile(configuration_file)
-        for key in self._declared_values.keys():
-            value = self._declared_values[key]
-            value.config = self.config
-            value.configuration_file = configuration_file
-            for key2 in value._declared_values.keys():
-                value2 = value._declared_values[key2]
-                value2.config = self.config
-                value2.configuration_file = self.configuration_file
-                if not value2 and value2.default:
-                    value.set_var(key2, value2.default)
+        self.load()
+        with self.transaction():
+            for key in self._declared_values.keys():
+                value = self._declared_values[key]
+                value.controller = self
+                value.configuration_file = configuration_file
+                for key2 in value._declared_values.keys():
+                    value2 = value._declared_values[key2]
+                    value2.configuration_file = self.configuration_file
+                    if not self.cache.get((key, key2)) and value2.default:
+                        value.set_var(key2, value2.default)
+
+    def load(self):
+        with self.lock:
+            self.config = ConfigFile(self.configuration_file)
+            self.file_mtime_ns = os.stat(self.configuration_file).st_mtime_ns
+            self.last_reload_check = time.monotonic()
+            self.cache = {}
+            parser = configparser.ConfigParser(interpolation=None)
+            parser.read_string(str(self.config))
+            self.file_sections = parser.sections()
+            for key, value in list(self._declared_values.items()) + list(self.sections.items()):
+                value.config = self.config
+                for key2 in value._declared_values.keys():
+                    self.cache[(key, key2)] = self.config.get("%s.%s" % (key, key2), default=False)
+
+    def add_section(self, section_name, section):
+        '''
+        Registers `section`, a SettingsSection instance, under `section_name`.
+        Nothing is written to the file until one of its fields is set.
+        '''
+        if "." in section_name:
+            raise ValueError("Section names can't have dots: %s" % section_name)
+        with self.lock:
+            section.section_name = section_name
+            section.controller = self
+            section.configuration_file = self.configuration_file
+            section.config = self.config
+            self.sections[section_name] = section
+            for key in section._declared_values.keys():
+                self.cache[(section_name, key)] = self.config.get("%s.%s" % (section_name, key), default=False)
+        return section
+
+    def section_names(self, prefix=""):
+        '''
+        Names of the sections in the file starting with `prefix`, declared or not.
+        '''
+        self.reload_if_changed()
+        return [name for name in self.file_sections if name.startswith(prefix)]
+
+    def reload_if_changed(self):
+        with self.lock:
+            if self.transaction_depth or self.dirty:
+                return
+            now = time.monotonic()
+            if now - self.last_reload_check < RELOAD_CHECK_INTERVAL:
+                return
+            self.last_reload_check = now
+            try:
+                file_mtime_ns = os.stat(self.configuration_file).st_mtime_ns
+            except FileNotFoundError:
+                return
+            if file_mtime_ns != self.file_mtime_ns:
+                self.load()
+
+    def get_value(self, section_name, key):
+        self.reload_if_changed()
+        return self.cache.get((section_name, key), False)
+
+    def set_value(self, section_name, key, value):
+        with self.lock:
+            self.cache[(section_name, key)] = value
+            if section_name not in self.file_sections:
+                self.file_sections.append(section_name)
+            self.config.set("%s.%s" % (section_name, key), value)
+            self.dirty = True
+            if not self.transaction_depth:
+                self.save()
+
+    def save(self):
+        '''
+        Writes the file to a temporary file next to it and renames it over the
+        old one, so a crash never leaves a half written configuration.
+        '''
+        with self.lock:
+            temporary = "%s.tmp" % self.configuration_file
+            with open(temporary, "w") as newfile:
+                newfile.write(str(self.config))
+            os.replace(temporary, self.configuration_file)
+            self.file_mtime_ns = os.stat(self.configuration_file).st_mtime_ns
+            self.dirty = False
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Groups several assignments in a single save, if the block raises the
+        changes are thrown away and the file is read again.
+        '''
+        with self.lock:
+            self.transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.transaction_depth -= 1
+                if not self.transaction_depth:
+                    self.dirty = False
+                    self.load()
+                raise
+            self.transaction_depth -= 1
+            if not self.transaction_depth and self.dirty:
+                self.save()
 
@@ -0,0 +1,300 @@
+import errno
+import os
+import queue
+import sys
+import threading
+from collections import Counter, deque
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl(dest_fd, FICLONE, src_fd) shares the source extents with the
+# destination (btrfs, xfs, bcachefs, ocfs2...)
+FICLONE = 0x40049409
+# Anything bigger than that goes through copy_file_range/sendfile in pieces
+KERNEL_COPY_CHUNK = 1024 * 1024 * 1024
+READ_WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+# Files at least this big are copied by copy_pipelined when the source and
+# the backups are on different disks
+PIPELINE_MIN_SIZE = 64 * 1024 * 1024
+PIPELINE_BUFFERS = 4
+PIPELINE_MIN_BUFFER_SIZE = 1024 * 1024
+PIPELINE_MAX_BUFFER_SIZE = 16 * 1024 * 1024
+# Share of the available memory all the pipelined copies may use together
+PIPELINE_MEMORY_SHARE = 64
+PIPELINED_METHOD = "pipelined"
+# Errors that mean "this filesystem or kernel can not do it", anything else
+# (no space left, i/o errors...) is a real error and is raised
+UNSUPPORTED_ERRNOS = frozenset(
+    code for code in (
+        errno.EXDEV, errno.EOPNOTSUPP, getattr(errno, "ENOTSUP", None), errno.EINVAL,
+        errno.ENOSYS, errno.ENOTTY, errno.EBADF, errno.EPERM,
+    ) if code is not None)
+
+if sys.platform.startswith("linux"):
+    COPY_METHODS = ("reflink", "copy_file_range", "sendfile", "readwrite")
+else:
+    COPY_METHODS = ("readwrite",)
+
+
+class UnsupportedCopy(Exception):
+    pass
+
+
+def unsupported(excp):
+    return isinstance(excp, OSError) and excp.errno in UNSUPPORTED_ERRNOS
+
+
+def copy_reflink(source_fd, destination_fd, size):
+    if fcntl is None:
+        raise UnsupportedCopy()
+    fcntl.ioctl(destination_fd, FICLONE, source_fd)
+
+
+def copy_file_range(source_fd, destination_fd, size):
+    if not hasattr(os, "copy_file_range"):
+        raise UnsupportedCopy()
+    while True:
+        copied = os.copy_file_range(source_fd, destination_fd, KERNEL_COPY_CHUNK)
+        if not copied:
+            return
+
+
+def copy_sendfile(source_fd, destination_fd, size):
+    offset = 0
+    while True:
+        sent = os.sendfile(destination_fd, source_fd, offset, KERNEL_COPY_CHUNK)
+        if not sent:
+            return
+        offset += sent
+
+
+def write_all(destination_fd, data):
+    written = 0
+    while written < len(data):
+        written += os.write(destination_fd, data[written:])
+
+
+def copy_readwrite(source_fd, destination_fd, size):
+    if not hasattr(os, "readv"):
+        while True:
+            data = os.read(source_fd, READ_WRITE_BUFFER_SIZE)
+            if not data:
+                return
+            write_all(destination_fd, data)
+    # One buffer reused for the whole file instead of a new bytes per read
+    buffer = bytearray(min(READ_WRITE_BUFFER_SIZE, max(size, 1)))
+    view = memoryview(buffer)
+    while True:
+        read = os.readv(source_fd, [buffer])
+        if not read:
+            return
+        write_all(destination_fd, view[:read])
+
+
+def available_memory():
+    '''
+    Bytes of memory that can be used without swapping, None when unknown.
+    '''
+    try:
+        with open("/proc/meminfo") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def advise(fd, offset, length, advice):
+    '''
+    posix_fadvise where there is one, it is only a hint so errors are ignored.
+    '''
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+def read_into(fd, buffer):
+    if hasattr(os, "readv"):
+        return os.readv(fd, [buffer])
+    data = os.read(fd, len(buffer))
+    buffer[:len(data)] = data
+    return len(data)
+
+
+def copy_pipelined(source_fd, destination_fd, size, buffer_size=PIPELINE_MIN_BUFFER_SIZE,
+                   buffers=PIPELINE_BUFFERS, fadvise=True):
+    '''
+    Copies with a reader thread filling a pool of `buffers` reusable buffers
+    while the calling thread writes the ones already filled, so the source
+    disk is reading while the destination one writes instead of taking
+    turns. With `fadvise` the kernel is told the source is read once from
+    start to end and the copied pages are dropped from the page cache as
+    the copy goes, a backup of a huge file does not push everything else
+    out of it.
+    '''
+    free = queue.Queue()
+    filled = queue.Queue()
+    for _ in range(max(2, buffers)):
+        free.put(bytearray(buffer_size))
+    failure = []
+    if fadvise:
+        advise(source_fd, 0, 0, getattr(os, "POSIX_FADV_SEQUENTIAL", 0))
+
+    def read():
+        offset = 0
+        try:
+            while True:
+                buffer = free.get()
+                if buffer is None:
+                    # The writer stopped
+                    return
+                read = read_into(source_fd, buffer)
+                filled.put((buffer, read))
+                if not read:
+                    return
+                if fadvise:
+                    advise(source_fd, offset, read, getattr(os, "POSIX_FADV_DONTNEED", 0))
+                offset += read
+        except BaseException as excp:
+            failure.append(excp)
+            filled.put((None, 0))
+
+    reader = threading.Thread(target=read, name="Pipelined read", daemon=True)
+    reader.start()
+    written = deque()
+    offset = 0
+    try:
+        while True:
+            buffer, read = filled.get()
+            if buffer is None:
+                raise failure[0]
+            if not read:
+                return
+            write_all(destination_fd, memoryview(buffer)[:read])
+            free.put(buffer)
+            if fadvise:
+                # DONTNEED starts writing dirty pages back but only drops the
+                # clean ones, so each range gets it again a few buffers later
+                advise(destination_fd, offset, read, getattr(os, "POSIX_FADV_DONTNEED", 0))
+                written.append((offset, read))
+                if len(written) > buffers:
+                    advise(destination_fd, *written.popleft(), getattr(os, "POSIX_FADV_DONTNEED", 0))
+            offset += read
+    finally:
+        free.put(None)
+        reader.join()
+
+
+class Pipeline:
+    '''
+    How CopyBackend copies files of `min_size` bytes or more with
+    copy_pipelined, 0 for `buffer_size` or `buffers` picks them from the
+    available memory.
+    '''
+
+    def __init__(self, min_size=PIPELINE_MIN_SIZE, buffer_size=0, buffers=0, fadvise=True):
+        self.min_size = min_size
+        self.buffer_size = buffer_size
+        self.buffers = buffers
+        self.fadvise = fadvise
+
+    def sized(self, copies=1):
+        '''
+        A copy with the buffers picked, for `copies` files copied at once.
+        '''
+        buffers = self.buffers or PIPELINE_BUFFERS
+        buffer_size = self.buffer_size
+        if not buffer_size:
+            memory = available_memory()
+            if memory is None:
+                buffer_size = READ_WRITE_BUFFER_SIZE
+            else:
+                buffer_size = memory // PIPELINE_MEMORY_SHARE // max(1, copies) // buffers
+            buffer_size = min(PIPELINE_MAX_BUFFER_SIZE, max(PIPELINE_MIN_BUFFER_SIZE, buffer_size))
+            buffer_size -= buffer_size % PIPELINE_MIN_BUFFER_SIZE
+        return Pipeline(self.min_size, buffer_size, buffers, self.fadvise)
+
+    def __str__(self):
+        return "files of %d MB or more copied with %d buffers of %d MB%s" % (
+            self.min_size // (1024 * 1024), self.buffers, self.buffer_size // (1024 * 1024),
+            ", page cache hints on" if self.fadvise and hasattr(os, "posix_fadvise") else "")
+
+
+METHOD_FUNCTIONS = {
+    "reflink": copy_reflink,
+    "copy_file_range": copy_file_range,
+    "sendfile": copy_sendfile,
+    "readwrite": copy_readwrite,
+}
+
+
+class CopyBackend:
+    '''
+    File copy function that lets the kernel do the work when it can, trying
+    reflink, copy_file_range, sendfile and finally a plain read/write loop
+    with a big buffer. What the source and destination filesystems support is
+    found out on the first files and remembered for the rest of the backup,
+    so every later file goes straight to the best method that worked.
+    With a `pipeline` (a Pipeline) big files go to copy_pipelined instead,
+    for copies between two disks where the kernel methods can't help.
+    '''
+
+    def __init__(self, methods=COPY_METHODS, pipeline=None):
+        self.methods = list(methods)
+        self.pipeline = pipeline
+        self.lock = threading.Lock()
+        self.files_by_method = Counter()
+        self.bytes_by_method = Counter()
+
+    def disable(self, method):
+        with self.lock:
+            if method in self.methods and len(self.methods) > 1:
+                self.methods.remove(method)
+
+    def copyfile(self, source, destination):
+        with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+            source_fd = source_file.fileno()
+            destination_fd = destination_file.fileno()
+            size = os.fstat(source_fd).st_size
+            pipeline = self.pipeline
+            if pipeline is not None and 0 < pipeline.min_size <= size:
+                copy_pipelined(source_fd, destination_fd, size, pipeline.buffer_size, pipeline.buffers,
+                               pipeline.fadvise)
+                with self.lock:
+                    self.files_by_method[PIPELINED_METHOD] += 1
+                    self.bytes_by_method[PIPELINED_METHOD] += size
+                return destination
+            for method in list(self.methods):
+                try:
+                    METHOD_FUNCTIONS[method](source_fd, destination_fd, size)
+                except (UnsupportedCopy, OSError) as excp:
+                    if not isinstance(excp, UnsupportedCopy) and not unsupported(excp):
+                        raise
+                    if method == "readwrite":
+                        raise
+                    self.disable(method)
+                    # Start again from scratch with the next method
+                    os.ftruncate(destination_fd, 0)
+                    os.lseek(destination_fd, 0, os.SEEK_SET)
+                    os.lseek(source_fd, 0, os.SEEK_SET)
+                    continue
+                with self.lock:
+                    self.files_by_method[method] += 1
+                    self.bytes_by_method[method] += size
+                return destination
+
+    def used_methods(self):
+        '''
+        (method, files, bytes) for every method that copied something.
+        '''
+        return [(method, self.files_by_method[method], self.bytes_by_method[method])
+                for method in [PIPELINED_METHOD] + list(METHOD_FUNCTIONS) if self.files_by_method[method]]
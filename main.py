@@ -1,16 +1,27 @@
 #!/usr/bin/env python3
 
-import shutil
+import threading
 import time
-from datetime import datetime
 
 import wx
 import os
-import errno, sys
-from configLibrary import Field, SettingsSection, SettingsController
+import sys
+from appSettings import ValidPath, Settings, CONFIG_FILE_PATH
+from appLogging import LOG_TYPES, get_logger, setup_logging
+from backupStore import materialize
+from backupManager import BackupError, create_backup_job, last_backup_path
+from backupRetention import prune_backups
+from backupVerify import verify_backup
+from backupRestore import restore_backup
+from backupScheduler import BackupScheduler
+from backupSpace import backup_usage
+from backupJournal import find_interrupted
+
+
+# Messages are written to the window at most this often
+LOG_FLUSH_INTERVAL_MS = 200
 
 
-ERROR_INVALID_NAME = 123
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
     try:
@@ -20,171 +31,6 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
 
     return os.path.join(base_path, relative_path)
-def getDirs(path):
-    def innerIsDir(name):
-        return os.path.isdir(os.path.join(path, name))
-    return innerIsDir, os.listdir(path)
-
-class ValidPath(str):
-    def __new__(cls, content):
-        return str.__new__(cls,  os.path.abspath(content))
-
-    def __init__(self, path):
-        self.valid = self.is_pathname_valid(path)
-        self.exists_or_creatable = False
-        self.exists = False
-        self.type = False
-        self.path = False
-        self.absolute_path = False
-        self.after_init(path)
-        path = self.absolute_path or path
-        super().__init__()
-
-    def after_init(self,path):
-        if self.valid:
-            self.exists_or_creatable = self.is_path_exists_or_creatable(path)
-            if self.exists_or_creatable:
-                self.exists = os.path.exists(path)
-                if self.exists:
-                    is_directory = os.path.isdir(path)
-                    if is_directory:
-                        self.type = "dir"
-                    else:
-                        self.type = "file"
-            else:
-                self.exists = False
-                self.type = False
-            self.path = path
-            self.absolute_path = os.path.abspath(path)
-
-    def __abs__(self):
-        return self.absolute_path
-
-    def __str__(self):
-        return self.absolute_path
-
-    def __repr__(self):
-        return self.absolute_path
-
-    def get_folder_list(self,path):
-        filter_method, iterable = getDirs(path)
-        return list(map(ValidPath,map(lambda x: os.path.join(path,x),iterable)))
-
-    def getContent(self):
-        if not self.exists:
-            return False
-        if self.type == "dir":
-            return self.get_folder_list(self.absolute_path)
-        else:
-            file = open(self.absolute_path)
-            data = file.read()
-            file.close()
-            return data
-
-    def create(self, path_type, default=False):
-        if self.exists_or_creatable and not self.exists:
-            if path_type == "dir":
-                try:
-                    os.mkdir(self.absolute_path)
-                    self.after_init(self.path)
-                except Exception as excp:
-                    raise excp
-            elif path_type == "file":
-                try:
-                    newfile = open(self.absolute_path, 'a+')  # open file in append mode
-                    if default:
-                        newfile.write(default)
-                    else:
-                        newfile.write("")
-                    newfile.close()
-                    self.after_init(self.path)
-                except Exception as excp:
-                    raise excp
-
-    def is_pathname_valid(self,pathname):
-        '''
-        `True` if the passed pathname is a valid pathname for the current OS;
-        `False` otherwise.
-        '''
-        try:
-            if not isinstance(pathname, str) or not pathname:
-                return False
-            _, pathname = os.path.splitdrive(pathname)
-            root_dirname = os.environ.get('HOMEDRIVE', 'C:') \
-                if sys.platform == 'win32' else os.path.sep
-            assert os.path.isdir(root_dirname)
-            root_dirname = root_dirname.rstrip(os.path.sep) + os.path.sep
-            for pathname_part in pathname.split(os.path.sep):
-                try:
-                    os.lstat(root_dirname + pathname_part)
-                except OSError as exc:
-                    if hasattr(exc, 'winerror'):
-                        if exc.winerror == ERROR_INVALID_NAME:
-                            return False
-                    elif exc.errno in {errno.ENAMETOOLONG, errno.ERANGE}:
-                        return False
-        except TypeError as exc:
-            return False
-        else:
-            return True
-
-    def is_path_creatable(self,pathname):
-        '''
-        `True` if the current user has sufficient permissions to create the passed
-        pathname; `False` otherwise.
-        '''
-        dirname = os.path.dirname(pathname) or os.getcwd()
-        return os.access(dirname, os.W_OK)
-
-    def is_path_exists_or_creatable(self,pathname):
-        '''
-        `True` if the passed pathname is a valid pathname for the current OS _and_
-        either currently exists or is hypothetically creatable; `False` otherwise.
-
-        This function is guaranteed to _never_ raise exceptions.
-        '''
-        try:
-            return self.is_pathname_valid(pathname) and (
-                os.path.exists(pathname) or self.is_path_creatable(pathname))
-        except OSError:
-            return False
-
-
-CONFIG_FILE_NAME = "folder_backup_creator.ini"
-CONFIG_FILE_PATH = ValidPath(CONFIG_FILE_NAME)
-
-class PathSettings(SettingsSection):
-    save_directory_path = Field(default="None")
-    backups_directory_path = Field(default="./saveBackups")
-
-class Settings(SettingsController):
-    PATHS = PathSettings()
-    @property
-    def save_path(self):
-        return ValidPath(self.PATHS.save_directory_path)
-
-    @property
-    def backup_path(self):
-        return ValidPath(self.PATHS.backups_directory_path)
-
-    def init_paths(self):
-        if self.backup_path.exists_or_creatable and not self.backup_path.exists:
-            self.backup_path.create("dir")
-        if self.paths_configured_correctly:
-            return True, ""
-        elif not self.save_path.exists:
-            return False, "Save directory path does not exists"
-        else:
-            return False, "Unknown error"
-
-    @property
-    def paths_configured_correctly(self):
-        return self.save_path.exists and self.save_path.type == "dir" and self.backup_path.exists and self.backup_path.type == "dir"
-
-
-
-
-
 
 
 class SettingsDialog(wx.Dialog):
@@ -229,10 +75,11 @@ class SettingsDialog(wx.Dialog):
     def save(self, event):
         save = ValidPath(self.settingsSaveDataField.Path)
         backups = ValidPath(self.settingsBackupDirField.Path)
-        if self.settingsSaveDataField.Path and save.exists:
-            self.Parent.settings.PATHS.save_directory_path = str(save)
-        if self.settingsBackupDirField.Path and backups.exists:
-            self.Parent.settings.PATHS.backups_directory_path = str(backups)
+        with self.Parent.settings.transaction():
+            if self.settingsSaveDataField.Path and save.exists:
+                self.Parent.settings.PATHS.save_directory_path = str(save)
+            if self.settingsBackupDirField.Path and backups.exists:
+                self.Parent.settings.PATHS.backups_directory_path = str(backups)
         self.Close()
 
     def __del__( self ):
@@ -241,6 +88,10 @@ class SettingsDialog(wx.Dialog):
 class MainWindow(wx.Frame):
     def __init__(self, *args, **kwds):
         self.settings = Settings(str(CONFIG_FILE_PATH))
+        self.backup_job = None
+        self.scheduler = None
+        self.maintenance_task = None
+        self.last_progress_log = 0.0
         # begin wxGlade: MainWindow.__init__
         kwds["style"] = kwds.get("style", 0) | wx.CAPTION | wx.CLIP_CHILDREN | wx.CLOSE_BOX | wx.ICONIZE | wx.MINIMIZE_BOX | wx.SYSTEM_MENU
         wx.Frame.__init__(self, *args, **kwds)
@@ -258,12 +109,26 @@ class MainWindow(wx.Frame):
         self.Bind(wx.EVT_MENU, self.openLastBackupFolderMenuButton, item)
         item = self.open.Append(wx.ID_ANY, "Open Config File", "")
         self.Bind(wx.EVT_MENU, self.openConfigFileMenuButton, item)
+        item = self.open.Append(wx.ID_ANY, "Backups Disk Usage", "Show the space used by each backup")
+        self.Bind(wx.EVT_MENU, self.backupUsageMenuButton, item)
+        item = self.open.Append(wx.ID_ANY, "Restore Backup", "Put the files of a backup back in the original folder")
+        self.Bind(wx.EVT_MENU, self.restoreBackupMenuButton, item)
         self.FolderBackupData_menubar.Append(self.open, "Open")
         wxglade_tmp_menu = wx.Menu()
         item = wxglade_tmp_menu.Append(wx.ID_ANY, "Edit Settings", "")
         self.Bind(wx.EVT_MENU, self.openSettingsDialogMenuButton, item)
         item = wxglade_tmp_menu.Append(wx.ID_ANY, "Create Backup", "")
         self.Bind(wx.EVT_MENU, self.createBackupMenuButton, item)
+        item = wxglade_tmp_menu.Append(wx.ID_ANY, "Force Backup", "Create a backup even if nothing changed")
+        self.Bind(wx.EVT_MENU, self.forceBackupMenuButton, item)
+        item = wxglade_tmp_menu.Append(wx.ID_ANY, "Backup All Profiles", "Back up every profile of the config file")
+        self.Bind(wx.EVT_MENU, self.backupAllProfilesMenuButton, item)
+        item = wxglade_tmp_menu.Append(wx.ID_ANY, "Cancel Backup", "")
+        self.Bind(wx.EVT_MENU, self.cancelBackupMenuButton, item)
+        item = wxglade_tmp_menu.Append(wx.ID_ANY, "Materialize Backup", "")
+        self.Bind(wx.EVT_MENU, self.materializeBackupMenuButton, item)
+        item = wxglade_tmp_menu.Append(wx.ID_ANY, "Verify Backup", "Hash a backup and compare it with the original folder")
+        self.Bind(wx.EVT_MENU, self.verifyBackupMenuButton, item)
         self.FolderBackupData_menubar.Append(wxglade_tmp_menu, "Edit")
         wxglade_tmp_menu = wx.Menu()
         item = wxglade_tmp_menu.Append(wx.ID_ANY, "Close Window", "")
@@ -274,6 +139,11 @@ class MainWindow(wx.Frame):
 
         self.FolderBackupData_statusbar = self.CreateStatusBar(2)
         self.FolderBackupData_statusbar.SetStatusWidths([-1, 30])
+        self.log_flush_scheduled = False
+        self.log_lines_shown = 0
+        self.log_handler = setup_logging(self.settings.LOG.view_messages, self.onLogPending,
+                                         self.settings.LOG.file or None)
+        self.logger = get_logger()
         # statusbar fields
         FolderBackupData_statusbar_fields = [self.settings.save_path, "Loaded"]
         for i in range(len(FolderBackupData_statusbar_fields)):
@@ -310,14 +180,12 @@ class MainWindow(wx.Frame):
         path_correct, warn_message = self.settings.init_paths()
         if not path_correct:
             self.error(warn_message)
+        elif find_interrupted(self.settings.catalog):
+            self.warn("The last backup was interrupted, the next backup will resume it")
         #self.settingsDialog = SettingsDialog(self)
         # end wxGlade
 
 
-    def get_folder_list(self,path):
-        filter_method, iterable = getDirs(path)
-        return list(map(str,sorted(map(int,filter(filter_method, iterable)), reverse=True)))
-
     @property
     def save_path(self):
         return self.settings.save_path
@@ -332,22 +200,52 @@ class MainWindow(wx.Frame):
 
     @property
     def backupFolderList(self):
-        return self.get_folder_list(self.backup_path)
+        return self.settings.catalog.numbers()
 
     @property
     def last_backup_path(self):
-        backupFolders = self.backupFolderList
-        if len(backupFolders):
-            return "%s/%s" % (self.backup_path, backupFolders[0])
-        else:
-            return False
+        return last_backup_path(self.settings)
 
     def openFolder(self, path):
         os.startfile(path)
 
     def print(self,val, log_type="INFO"):
-        self.text_ctrl_1.write("\n[%s](%s):\n%s\n" % (log_type, datetime.now().strftime("%Y-%m-%d %H:%M:%S") ,val))
-        print(val)
+        # Only queues the message, flushLog writes it in the window
+        self.logger.log(LOG_TYPES.get(log_type, LOG_TYPES["INFO"]), val)
+
+    def threadSafePrint(self, val, log_type="INFO"):
+        # logging is thread safe, kept for the callers that run on workers
+        self.print(val, log_type)
+
+    def onLogPending(self):
+        # Called from any thread on the first message after a flush
+        wx.CallAfter(self.scheduleLogFlush)
+
+    def scheduleLogFlush(self):
+        if not self.log_flush_scheduled:
+            self.log_flush_scheduled = True
+            wx.CallLater(LOG_FLUSH_INTERVAL_MS, self.flushLog)
+
+    def flushLog(self):
+        '''
+        Writes every message queued since the last flush in one go, the text
+        control never holds more than the ring buffer's lines.
+        '''
+        self.log_flush_scheduled = False
+        lines, dropped = self.log_handler.drain()
+        if not lines:
+            return
+        self.text_ctrl_1.Freeze()
+        try:
+            if dropped or self.log_lines_shown + len(lines) > self.log_handler.capacity:
+                lines = self.log_handler.snapshot()
+                self.text_ctrl_1.ChangeValue("".join(lines))
+                self.log_lines_shown = len(lines)
+            else:
+                self.text_ctrl_1.AppendText("".join(lines))
+                self.log_lines_shown += len(lines)
+        finally:
+            self.text_ctrl_1.Thaw()
 
     def warn(self, val):
         self.print(val, "WARN")
@@ -355,42 +253,173 @@ class MainWindow(wx.Frame):
     def error(self, val):
         self.print(val, "ERROR")
 
-    def createDirGen(self,path):
-        def createDir(directory_name):
-            total_path = "%s/%s" % (path, directory_name)
-            try:
-                os.mkdir(total_path)
-            except OSError:
-                self.error("Creation of the directory %s failed" % total_path)
-                return False
-            else:
-                self.print("Successfully created the directory %s " % total_path)
-                return total_path
-        return createDir
-
-    def getNewName(self):
-        folderList = self.backupFolderList
-        name = "0"
-        if len(folderList):
-            name = str(int(folderList[0])+1)
-        return name
-
-    def createBackup(self):
+    @property
+    def backup_running(self):
+        return (self.backup_job is not None and self.backup_job.is_alive()) or (
+            self.scheduler is not None and self.scheduler.is_alive())
+
+    @property
+    def maintenance_running(self):
+        return self.maintenance_task is not None and self.maintenance_task.is_alive()
+
+    def createBackup(self, force=False):
+        if self.backup_running:
+            self.warn("A backup is already running, wait for it to finish or cancel it")
+            return
+        if self.maintenance_running:
+            self.warn("%s is still running, try again when it finishes" % self.maintenance_task.name)
+            return
         if self.check_if_config_is_correct():
             self.print("Creating Backup")
-            name = self.getNewName()
-            createDir = self.createDirGen(self.backup_path)
-            self.print("Creating Backup Directory")
-            new_dir_path = createDir(name)
-            if not new_dir_path:
-                self.error("Can't create new backup directory")
+            try:
+                self.backup_job = create_backup_job(
+                    self.settings,
+                    force=force,
+                    on_log=self.threadSafePrint,
+                    on_progress=lambda progress: wx.CallAfter(self.onBackupProgress, progress),
+                    on_finish=lambda job: wx.CallAfter(self.onBackupFinished, job))
+            except BackupError as excp:
+                self.error(excp)
+                self.error("Can't create new backup")
                 return
             self.print("Coping files from save folder to backup folder")
-            newBackupPath = "%s/%s" % (new_dir_path,self.save_data_folder_name)
-            shutil.copytree(self.save_path, newBackupPath)
-            self.print("Files copied successfully in to %s" % newBackupPath)
+            self.FolderBackupData_statusbar.SetStatusText("Busy", 1)
+            self.backup_job.start()
+
+    def backupAllProfiles(self):
+        if self.backup_running:
+            self.warn("A backup is already running, wait for it to finish or cancel it")
+            return
+        if self.maintenance_running:
+            self.warn("%s is still running, try again when it finishes" % self.maintenance_task.name)
+            return
+        profiles = self.settings.profiles()
+        if not profiles:
+            self.error("There are no profiles configured")
+            return
+        self.print("Backing up %d profiles: %s" % (len(profiles), ", ".join(profile.name for profile in profiles)))
+        self.scheduler = BackupScheduler(
+            profiles,
+            on_log=self.threadSafePrint,
+            on_progress=lambda progress: wx.CallAfter(self.onSchedulerProgress, progress),
+            on_finish=lambda scheduler: wx.CallAfter(self.onSchedulerFinished, scheduler),
+            jobs_per_device=self.settings.jobs_per_device)
+        self.FolderBackupData_statusbar.SetStatusText("Busy", 1)
+        self.scheduler.start()
+
+    def onSchedulerProgress(self, progress):
+        self.FolderBackupData_statusbar.SetStatusText(str(progress), 0)
+
+    def onSchedulerFinished(self, scheduler):
+        self.FolderBackupData_statusbar.SetStatusText(self.settings.save_path, 0)
+        self.FolderBackupData_statusbar.SetStatusText("Loaded", 1)
+
+    def cancelBackup(self):
+        if not self.backup_running:
+            self.warn("There is no backup running")
+            return
+        self.print("Cancelling backup")
+        for task in (self.backup_job, self.scheduler):
+            if task is not None and task.is_alive():
+                task.cancel()
+
+    def onBackupProgress(self, progress):
+        self.FolderBackupData_statusbar.SetStatusText(str(progress), 0)
+        if progress.elapsed - self.last_progress_log >= 5:
+            self.last_progress_log = progress.elapsed
+            self.print(progress)
+
+    def onBackupFinished(self, job):
+        self.last_progress_log = 0.0
+        self.FolderBackupData_statusbar.SetStatusText(self.settings.save_path, 0)
+        self.FolderBackupData_statusbar.SetStatusText("Loaded", 1)
+        if job.status == "done":
+            self.print(job.result)
+            self.print("Files copied successfully in to %s" % job.output)
+            if self.settings.retention_policy != "none":
+                self.maintenance_task = self.runTask("Deleting old backups", prune_backups,
+                                               self.settings, None, self.threadSafePrint)
+
+    def runTask(self, description, function, *args):
+        def task():
+            try:
+                result = function(*args)
+            except Exception as excp:
+                wx.CallAfter(self.error, "%s failed: %s" % (description, excp))
+            else:
+                wx.CallAfter(self.print, "%s finished: %s" % (description, result))
+        self.print(description)
+        thread = threading.Thread(target=task, name=description, daemon=True)
+        thread.start()
+        return thread
+
+    def askBackupNumber(self, message, title):
+        '''
+        Asks for the number of an existing backup, the latest by default,
+        returns None if cancelled or it does not exist.
+        '''
+        if not self.check_if_config_is_correct():
+            return None
+        with wx.TextEntryDialog(self, message, title, self.settings.catalog.latest or "") as dialog:
+            if dialog.ShowModal() != wx.ID_OK:
+                return None
+            number = dialog.GetValue().strip()
+        if number not in self.backupFolderList:
+            self.error("Backup %s does not exist" % number)
+            return None
+        return number
+
+    def restoreBackup(self):
+        if self.backup_running or self.maintenance_running:
+            self.warn("Wait for the running backup or task to finish before restoring")
+            return
+        number = self.askBackupNumber("Number of the backup to restore", "Restore Backup")
+        if number is None:
+            return
+        with wx.MessageDialog(self, "Restore backup %s over %s?\n\nThe folder is backed up first so this can be "
+                              "undone. Delete the files that are not in backup %s?" % (number, self.save_path, number),
+                              "Restore Backup", wx.YES_NO | wx.CANCEL | wx.NO_DEFAULT | wx.ICON_QUESTION) as dialog:
+            dialog.SetYesNoLabels("Restore and delete", "Restore and keep")
+            answer = dialog.ShowModal()
+        if answer == wx.ID_CANCEL:
+            return
+        self.maintenance_task = self.runTask("Restoring backup %s" % number, self.runRestore,
+                                             number, answer == wx.ID_YES)
+
+    def runRestore(self, number, remove_extras):
+        return restore_backup(self.settings, number, remove_extras=remove_extras, on_log=self.threadSafePrint)
+
+    def verifyBackup(self):
+        if self.backup_running or self.maintenance_running:
+            self.warn("Wait for the running backup or task to finish before verifying")
+            return
+        number = self.askBackupNumber("Number of the backup to verify", "Verify Backup")
+        if number is None:
+            return
+        entry = self.settings.catalog.get(number)
+        self.maintenance_task = self.runTask("Verifying backup %s" % number, verify_backup,
+                                             self.save_path, self.settings.catalog.path_of(number),
+                                             entry.get("mode", "full"), "full", self.settings.copy_workers,
+                                             None, None, self.settings.filter_rules, entry.get("created"))
+
+    def showBackupUsage(self):
+        if self.check_if_config_is_correct():
+            # Only slow the first time, for backups made before sizes were kept
+            self.runTask("Measuring backups", backup_usage, self.settings.catalog)
+
+    def materializeBackup(self):
+        if self.backup_running or self.maintenance_running:
+            self.warn("Wait for the running backup or task to finish before materializing")
+            return
+        number = self.askBackupNumber("Number of the backup to rebuild", "Materialize Backup")
+        if number is None:
+            return
+        self.maintenance_task = self.runTask("Materializing backup %s" % number, materialize,
+                                             os.path.join(self.backup_path, number), None,
+                                             self.settings.copy_workers)
 
     def check_if_config_is_correct(self):
+        self.settings.invalidate_paths()
         if not self.settings.paths_configured_correctly:
             self.error("Paths not configured correctly")
             return False
@@ -442,8 +471,41 @@ class MainWindow(wx.Frame):
         self.createBackup()
         event.Skip()
 
+    def forceBackupMenuButton(self, event):
+        self.createBackup(force=True)
+        event.Skip()
+
+    def backupAllProfilesMenuButton(self, event):
+        self.backupAllProfiles()
+        event.Skip()
+
+    def cancelBackupMenuButton(self, event):
+        self.cancelBackup()
+        event.Skip()
+
+    def backupUsageMenuButton(self, event):
+        self.showBackupUsage()
+        event.Skip()
+
+    def restoreBackupMenuButton(self, event):
+        self.restoreBackup()
+        event.Skip()
+
+    def verifyBackupMenuButton(self, event):
+        self.verifyBackup()
+        event.Skip()
+
+    def materializeBackupMenuButton(self, event):
+        self.materializeBackup()
+        event.Skip()
+
     def closeMenuButton(self, event):  # wxGlade: MainWindow.<event_handler>
         self.print("Closing Application")
+        for task in (self.backup_job, self.scheduler):
+            if task is not None and task.is_alive():
+                # Kept to be resumed by the next backup
+                task.interrupt()
+                task.join()
         time.sleep(1)
         self.Close(force=True)
         event.Skip()
@@ -0,0 +1,178 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from backupEngine import scan_tree
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class InotifyWatcher:
+    '''
+    Watches a whole tree with inotify, new subdirectories are watched as they
+    are created. Linux only, create_watcher falls back to polling elsewhere.
+    Folders `rules` (a backupFilter.FilterRules) exclude are not watched and
+    changes to files they leave out are ignored, as they are not backed up.
+    '''
+
+    def __init__(self, root, rules=None):
+        self.root = str(root)
+        self.rules = rules
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+        try:
+            self.add_tree(self.root)
+        except OSError:
+            self.close()
+            raise
+
+    def add_watch(self, path):
+        descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if descriptor < 0:
+            # Running out of watches (fs.inotify.max_user_watches) can not be
+            # worked around here, the caller falls back to polling
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for %s" % path)
+        self.watches[descriptor] = path
+
+    def excluded_dir(self, path):
+        return self.rules is not None and self.rules.excludes_dir(os.path.relpath(path, self.root))
+
+    def add_tree(self, path):
+        if self.excluded_dir(path):
+            return
+        self.add_watch(path)
+        for directory, dirs, files in os.walk(path):
+            dirs[:] = [name for name in dirs if not self.excluded_dir(os.path.join(directory, name))]
+            for name in dirs:
+                self.add_watch(os.path.join(directory, name))
+
+    def relevant(self, path, mask):
+        '''
+        False for changes to what the backup leaves out.
+        '''
+        if self.rules is None or path == self.root:
+            return True
+        if mask & IN_ISDIR:
+            return not self.excluded_dir(path)
+        relative_path = os.path.relpath(path, self.root)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return self.rules.keeps_path(relative_path)
+        return self.rules.keeps_file(relative_path, stat.st_size, stat.st_mtime_ns)
+
+    def wait_for_change(self, timeout=None):
+        '''
+        Blocks up to `timeout` seconds (forever with None) and returns True if
+        anything in the tree changed meanwhile.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            readable, _, _ = select.select([self.fd], [], [], wait)
+            if not readable:
+                return False
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            changed = False
+            offset = 0
+            while offset < len(data):
+                descriptor, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+                offset += EVENT_HEADER.size + length
+                directory = self.watches.get(descriptor)
+                if directory is None or mask & IN_Q_OVERFLOW:
+                    changed = True
+                    continue
+                path = os.path.join(directory, os.fsdecode(name)) if name else directory
+                if not self.relevant(path, mask):
+                    continue
+                changed = True
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    try:
+                        self.add_tree(path)
+                    except OSError:
+                        pass
+            if changed:
+                return True
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    '''
+    Fallback that notices changes by comparing a signature of every path,
+    size and mtime in the tree every `interval` seconds, leaving out what
+    `rules` exclude.
+    '''
+
+    def __init__(self, root, interval=5.0, rules=None):
+        self.root = str(root)
+        self.interval = interval
+        self.rules = rules
+        self.signature = self.compute_signature()
+
+    def compute_signature(self):
+        tree = scan_tree(self.root, rules=self.rules)
+        return hash((tuple(tree.dirs), tuple(tree.files)))
+
+    def wait_for_change(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.interval if deadline is None else min(self.interval, deadline - time.monotonic())
+            if wait > 0:
+                time.sleep(wait)
+            signature = self.compute_signature()
+            if signature != self.signature:
+                self.signature = signature
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+
+    def close(self):
+        pass
+
+
+def create_watcher(root, poll_interval=5.0, rules=None):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root, rules)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(root, poll_interval, rules)
+
+
+def wait_until_quiet(watcher, debounce):
+    '''
+    Blocks until something changes and then nothing else changes for
+    `debounce` seconds, so a game saving many files triggers a single backup.
+    '''
+    watcher.wait_for_change(None)
+    while watcher.wait_for_change(debounce):
+        pass